@@ -1,3 +1,6 @@
+__version__ = '1.2.0'
+
 from hypertag.core.run_html import Runtime, HyperHTML
+from hypertag.core.runtime import Template
 from hypertag.core.tag import Tag, TagFunction, Markup
 from hypertag.core.dom import DOM
@@ -5,21 +5,22 @@
 
 from __future__ import unicode_literals
 
-import sys, re, codecs, operator
+import sys, re, codecs, operator, pickle, io, threading
+from functools import wraps
 from collections import OrderedDict
 from six import reraise, text_type
 
 from parsimonious.grammar import Grammar as Parsimonious
-from parsimonious.exceptions import IncompleteParseError
+from parsimonious.exceptions import ParseError, IncompleteParseError
 
-from hypertag.nifty.util import ObjDict
+from hypertag.nifty.util import ObjDict, flatten
 from hypertag.nifty.parsing import ParsimoniousTree as BaseTree
 
 from hypertag.core.errors import SyntaxErrorEx, ValueErrorEx, TypeErrorEx, FalseValueEx, NameErrorEx, \
     UnboundLocalEx, UndefinedTagEx, NotATagEx, NoneStringEx, VoidTagEx, ImportErrorEx
 from hypertag.core.grammar import grammar, MARK_TAG, MARK_VAR, TAG, VAR, IS_TAG
 from hypertag.core.xml_chars import XML_StartChar, XML_Char, XML_EndChar
-from hypertag.core.structs import Context, State, Slot, ValueSlot
+from hypertag.core.structs import Context, State, Slot, ValueSlot, MISSING, UNDEFINED
 from hypertag.core.dom import del_indent, get_indent, DOM
 from hypertag.core.tag import Tag, null
 
@@ -31,6 +32,42 @@ DEBUG = False
 #####  UTILITIES
 #####
 
+class RecursionLimit:
+    """
+    Context manager, or a decorator of functions, that raises Python's recursion limit to at least `limit`
+    for the time of its use. Re-entrant and shared between threads: the original limit is restored when the last
+    of nested or concurrent users exits, so the rest of the process keeps running with its own limit.
+    """
+    def __init__(self, limit):
+        self.limit    = limit
+        self.lock     = threading.Lock()
+        self.active   = 0           # no. of users currently inside the context
+        self.previous = None        # the limit to be restored when the last user exits
+        
+    def __enter__(self):
+        with self.lock:
+            if not self.active:
+                self.previous = sys.getrecursionlimit()
+                if self.previous < self.limit: sys.setrecursionlimit(self.limit)
+            self.active += 1
+            
+    def __exit__(self, *exc):
+        with self.lock:
+            self.active -= 1
+            if not self.active: sys.setrecursionlimit(self.previous)
+
+    def __call__(self, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with self: return func(*args, **kwargs)
+        return wrapper
+    
+# Parsing (by Parsimonious or the native parser), analysis, translation, compilation, rendering of a DOM and pickling
+# recurse once or several times per nesting level of a script, so they run with a raised recursion limit;
+# rewriting and setup of the tree are iterative and don't need it
+deep_recursion = RecursionLimit(20000)
+
+
 _re_decode_escapes = re.compile(r'''
     ( \\U........               # 8-digit hex escapes
     | \\u....                   # 4-digit hex escapes
@@ -62,6 +99,32 @@ def STR(value, node = None, msg = "expression to be embedded in markup text eval
     if value is None: raise NoneStringEx(msg, node)
     return text_type(value)
 
+def format_text(body, lead):
+    """
+    Fix indentation of a rendered `body` of a text block whose first line begins at column `lead` in the script.
+    Used by NODES.block_text and by the compiled code.
+    """
+    output = ' ' * lead + body          # in the headline, spaces are prepended to replace leading tag(s) and a marker character /|!
+    
+    # fast path for a single non-empty line: max 1 initial space/tab after the lead is dropped
+    if '\n' not in output and output.strip():
+        return output[min(len(output) - len(output.lstrip()), lead + 1):]
+    
+    sub_indent = get_indent(output)
+    sub_indent = sub_indent[:lead+1]        # max 1 initial space/tab after the lead is dropped; remaining sub-indentation is preserved in `output`
+    output = del_indent(output, sub_indent)
+
+    # if tail lines have shorter indent than the headline, drop all the lead + 1 space (gap)
+    if len(sub_indent) < lead:
+        drop = lead - len(sub_indent)
+        if output[drop:drop+1] == ' ': drop += 1
+        output = output[drop:]
+        
+    return output
+
+def contains(x, d):      return x in d              # operator.contains() is not suitable bcs it takes operands in reversed order
+def not_contains(x, d):  return x not in d
+
 def partial(func, *args, **kwargs):
     """
     Create a partial function during processing of a filter pipeline, like in x:fun(a,b)
@@ -80,6 +143,8 @@ class Native(Tag):
     An already-expanded tag created by NODES.xblock_def for insertion into a DOM. Expansion of native tags is done
     before DOM creation, hence expand() - called after DOM creation - only performs body rendering and nothing else.
     """
+    dom = False
+    
     def __init__(self, name):
         self.name = name
         
@@ -110,11 +175,8 @@ class ImportedHypertag(Hypertag):
         
     def expand(self, body, attrs, kwattrs, state, caller):
         
-        # module_state = State(self.module_state.values)          # module's terminal state is copied anew on every tag expansion
-
-        # module's terminal state is NOT copied on subsequent expansions, which means that
-        # stored values of local symbols may change after the call below;
-        # TODO: make sure that values of local variables are cleared after expansion of an <xblock_def> block
+        # module's terminal state is shared by all expansions, possibly in concurrent threads, but it is NOT modified:
+        # values of attributes and local symbols are assigned in a new frame created on top of it by the hypertag
         return self.hypertag.expand(body, attrs, kwattrs, self.module_state, caller)
 
 class EmbeddedHypertag:
@@ -139,6 +201,65 @@ class EmbeddedHypertag:
         dom.set_indent('')
         return dom.render()
 
+class Binding:
+    """
+    Precomputed plan of binding the actual attributes of a native hypertag's call to the slots of its frame,
+    for a given no. of positional attributes and given names of keyword attributes. Created once per such combination
+    (see NODES.xblock_def.binding()), when the attributes are checked against the hypertag's signature,
+    so that a call only copies values to the frame, with no name lookups and no checks.
+    """
+    hypertag  = None    # <xblock_def> node of the hypertag
+    positions = None    # positions in hypertag.attr_regul of the actual attributes: positional ones, then keyword ones
+    targets   = None    # indices in State.values of the frame where the actual attributes are assigned, in the same order
+    names     = None    # names of the actual attributes, in the same order; keys of the attributes of the hypertag's DOM node
+    missing   = None    # list of (target, default, expr) of the attributes not passed: `default` is a constant, or MISSING
+                        # if the default-value expression, `expr`, must be evaluated on every call
+    body      = None    # index in State.values of the body attribute; None for a void hypertag
+    
+    def __init__(self, hypertag, npos, names, caller):
+        
+        name  = hypertag.name
+        regul = hypertag.attr_regul
+        index = hypertag.index
+        
+        # verify no. of positional attributes & names of keyword attributes
+        if npos > len(regul):
+            raise TypeErrorEx("hypertag '%s' takes %s positional attributes but %s were given" % (name, len(regul), npos), caller)
+        if hypertag.attr_body and hypertag.attr_body.name in names:
+            raise TypeErrorEx("direct assignment to body attribute '%s' of hypertag '%s' is not allowed" % (hypertag.attr_body.name, name), caller)
+        for attr in names:
+            if attr not in index: raise TypeErrorEx("hypertag '%s' got an unexpected keyword attribute '%s'" % (name, attr), caller)
+        for attr in names:
+            if index[attr] < npos: raise TypeErrorEx("hypertag '%s' got multiple values for attribute '%s'" % (name, attr), caller)
+        
+        self.hypertag  = hypertag
+        self.positions = list(range(npos)) + [index[attr] for attr in names]
+        self.targets   = [hypertag.slots[pos] for pos in self.positions]
+        self.names     = [attr.name for attr in regul[:npos]] + list(names)
+        self.missing   = []
+        
+        # find attributes to be imputed with defaults
+        for pos, attr in enumerate(regul):
+            if pos in self.positions: continue
+            if attr.expr is None: raise TypeErrorEx("hypertag '%s' missing a required positional attribute '%s'" % (name, attr.name), caller)
+            self.missing.append((hypertag.slots[pos], hypertag.defaults[pos], attr.expr))
+        
+        if hypertag.attr_body:
+            self.body = hypertag.attr_body.slot.index
+    
+    def bind(self, frame, body, values, caller):
+        """Assign actual `values` of attributes, defaults of the missing ones, and the `body`, in a new `frame` of the hypertag."""
+        slots = frame.values
+        for target, value in zip(self.targets, values):
+            slots[target] = value
+        for target, default, expr in self.missing:
+            slots[target] = default if default is not MISSING else expr.evaluate(frame)
+        
+        if self.body is not None:
+            slots[self.body] = body
+        elif body:
+            raise VoidTagEx("non-empty body passed to a void hypertag '%s'" % self.hypertag.name, caller)
+
 
 #####################################################################################################################################################
 #####
@@ -151,10 +272,16 @@ class Grammar(Parsimonious):
                         # can be used for parsing of a given text only if the text doesn't contain any of
                         # special characters that are used in the parser for indent / dedent
     
+    cache   = OrderedDict() # alternative instances (non-default special chars) created so far, keyed by tuple(special_chars);
+                            # kept in least-recently-used order, at most CACHE_SIZE of them
+    CACHE_SIZE = 16
+    _lock = threading.Lock()    # guards the `cache` in concurrent threads
+    
     SPECIAL_SYMBOLS = ['INDENT_S', 'DEDENT_S', 'INDENT_T', 'DEDENT_T']
     CHARS_DEFAULT   = [u'\u2768', u'\u2769', u'\u276A', u'\u276B']              # indent/dedent special chars to be used in `default` parser
     
     symbols = None      # dict of special symbols: {symbol_name: character}
+    actions = None      # dispatch table of HypertagAST.rewrite() for this grammar, {rule name: (action, NODES class)}, see HypertagAST._actions()
     
     def __init__(self, special_chars):
         """
@@ -181,9 +308,33 @@ class Grammar(Parsimonious):
         The grammar must be created with a proper choice of special characters,
         ones that don't collide with character set of `text`.
         """
-        if not (set(Grammar.CHARS_DEFAULT) & set(text)):
+        return Grammar.get(Grammar.special_chars(text))
+        
+    @staticmethod
+    def get(special_chars):
+        """
+        Return a Grammar instance for a given list of special characters: the default one, or an alternative one
+        from the cache. Compiling the grammar is costly, so alternative instances are created once and reused
+        by all scripts that need the same characters.
+        """
+        if special_chars == Grammar.CHARS_DEFAULT:
             return Grammar.default
         
+        key   = tuple(special_chars)
+        cache = Grammar.cache
+        with Grammar._lock:
+            parser = cache.pop(key, None) or Grammar(special_chars)
+            cache[key] = parser                         # (re)inserted at the end as the most recently used
+            while len(cache) > Grammar.CACHE_SIZE:
+                cache.popitem(last = False)
+        return parser
+        
+    @staticmethod
+    def special_chars(text):
+        """Return a list of 4 special characters for encoding INDENT_* and DEDENT_* symbols that don't occur in `text`."""
+        if not (set(Grammar.CHARS_DEFAULT) & set(text)):
+            return Grammar.CHARS_DEFAULT
+        
         chars = []
         
         # find 4 unicode characters that are not in `text`; start with CHARS_DEFAULT[0]
@@ -194,7 +345,7 @@ class Grammar(Parsimonious):
             chars.append(chr(code))
             code += 1
             
-        return Grammar(chars)
+        return chars
         
     
     def preprocess(self, text, verbose = False):
@@ -305,32 +456,40 @@ class NODES(object):
         ispure       = None         # True if this node's render() is a pure constant function: will always return the exact same value
                                     # regardless of the context of execution and without side effects.
                                     # Is set in analyse() or compactify(), not __init__()!
-        
-        def check_pure(self):
+
+        def __init__(self, tree, astnode):
+            super(NODES.node, self).__init__(tree, astnode)
+            self.astnode = None     # the raw AST is not needed after rewriting; dropped so that it can be freed block by block
+
+        def check_pure(self, state):
             """Calculate, set and return self.ispure on the basis of check_pure() of children nodes;
-            or return self.ispure if it's already set.
+            or return self.ispure if it's already set. `state` contains values of built-in symbols, for resolution of tags.
             """
             if self.ispure is not None: return self.ispure
-            npure = sum(n.check_pure() for n in self.children)      # sum up the no. of True values among children
+            npure = sum(n.check_pure(state) for n in self.children) # sum up the no. of True values among children
             self.ispure = (npure == len(self.children))             # is pure only when all children have pure=True
             return self.ispure
         
-        def compactify(self, state):
-            """Replace pure nodes in the subtree rooted at 'self' with static string/value nodes containg pre-computed render() result
-            of a given node, so that this pre-computed string/value is returned on all future render() calls on the new node.
+        def compactify(self, state, exposed = False):
+            """Replace pure blocks in the subtree rooted at 'self' with <merged> nodes containing pre-computed output
+            of a given block, so that this pre-computed string is returned on all future translate() calls on the new node.
             Compactification is a kind of pre-rendering: whatever can be rendered in the tree before runtime variable values are known,
-            is rendered and stored in the tree as static values.
-            'state' is needed for render() calls because the subtree may need to push some local variables internally.
+            is rendered and stored in the tree as static values. Performed once, after analysis.
+            'state' is needed for translate() calls because the subtree may need to push some local variables internally.
+            'exposed' is True if a DOM of the subtree may be inspected during translation, by a hypertag or a tag that needs a DOM.
             """
             # push compactification down the tree
-            for c in self.children: c.compactify(state)
+            for c in self.children: c.compactify(state, exposed)
             
-        def compactify_self(self, state):
-            "If 'self' is pure and not static, compactify it, otherwise try to compactify children. Return the new node or self."
-            if self.isstatic: return self
-            if self.check_pure(): return NODES.merged(self, state)
-            self.compactify(state)
-            return self
+        def __getstate__(self):
+            """
+            Links to the raw AST and to neighboring nodes are dropped during pickling. The latter are restored
+            by _enrich() after unpickling; this avoids deep recursion in pickle when a node has many siblings.
+            """
+            state = self.__dict__.copy()
+            for attr in ('astnode', 'parent', 'sibling_prev', 'sibling_next'):
+                state.pop(attr, None)
+            return state
             
         def analyse(self, ctx):
             """
@@ -378,26 +537,29 @@ class NODES(object):
 
     class xdocument(node):
         
-        slots_in  = None    # dict of slots created for each default value to be imported into `ctx` upon startup
+        slots_in  = None    # dict of slots created for each global symbol to be imported into `ctx` upon startup
         slots_out = None    # dict of top-level symbols defined by this document, and their Slots: {symbol: slot}
-        globals   = None    # dict of global symbols to be automatically imported into `ctx` when analysis begins
+        globals   = None    # list of global symbols to be automatically imported into `ctx` when analysis begins;
+                            # only the names are needed here, actual values are passed in `state` during translation
+        size      = None    # no. of slots in the document's frame (State), known after analysis
         
         # def setup(self):
         #     self.predefined = {}
         
         def predefine(self, globals):
             """
-            Append `symbols` to a dict of predefined symbols that will be available to child blocks
+            Set a list of predefined (global) symbols that will be available to child blocks
             right from the beginning of document parsing.
             """
-            if globals: self.globals = globals
+            self.globals = list(globals or ())
         
         def analyse(self, ctx):
-            self.slots_in = {symbol: ValueSlot(symbol, value, ctx) for symbol, value in self.globals.items()}
-            # ctx.pushall(self.slots_in)   -- not needed because each symbol is pushed to `ctx` during ValueSlot() creation
+            self.slots_in = {symbol: Slot(symbol, ctx) for symbol in self.globals}
+            # ctx.pushall(self.slots_in)   -- not needed because each symbol is pushed to `ctx` during Slot() creation
             position = ctx.position()
             for c in self.children: c.analyse(ctx)
             self.slots_out = ctx.asdict(position)           # pull newly defined top-level symbols from the tree
+            self.size = ctx.frames[0]
 
         def translate(self, state):
             """
@@ -405,7 +567,10 @@ class NODES(object):
             - DOM.Root node of the final DOM generated as a result of translation of the entire AST
             - dict of top-level symbols indexed by their names: {symbol_name: value}
             """
-            for slot in self.slots_in.values(): slot.set_value(state)
+            for symbol, slot in self.slots_in.items():
+                if symbol not in state.globals: raise NameErrorEx("global symbol '%s' is missing in translation" % symbol, self)
+                slot.set(state, state.globals[symbol])
+                
             nodes = [c.translate(state) for c in self.children]
             hroot = DOM.Root(body = nodes, indent = '\n')
             hroot.indent = ''       # fix indent to '' instead of '\n' after all child indents have been relativized
@@ -430,8 +595,12 @@ class NODES(object):
 
     class xblock(node):
         """Wrapper around all specific types of blocks: adds top margin and marks "outline" mode for the first returned DOM node."""
-        modifier = None         # optional modifier of layout  ("<", "...") that preceeds the block
-        block    = None         # the actual inner block of a specific type
+        modifier  = None        # optional modifier of layout  ("<", "...") that preceeds the block
+        block     = None        # the actual inner block of a specific type
+        cache     = None        # (level, index) of a frame slot reserved during analysis for the output of this block, if it's a candidate
+                                # for a loop invariant; see <loop_block>
+        invariant = False       # True if the block's output doesn't change during execution of an enclosing loop
+        hoisted   = False       # True if the block's output is actually cached: it's invariant and its DOM is never inspected
         
         def setup(self):
             assert 2 <= len(self.children) <= 3 and self.children[0].type == 'margin_out'
@@ -448,8 +617,22 @@ class NODES(object):
 
             super(NODES.xblock, self).analyse(ctx)
 
+        def compactify(self, state, exposed = False):
+            self.hoisted = self.invariant and not exposed
+            block = self.block
+            if isinstance(block, NODES.xblock_struct) and self.tree.runtime.compact and block.check_pure(state):
+                merged = NODES.merged(block, state, exposed)
+                if merged.value is not None:
+                    self.block = self.children[-1] = merged
+                    self.hoisted = False
+                    return
+            block.compactify(state, exposed)
+
         def translate(self, state):
-            margin, block = (c.translate(state) for c in self.children)
+            if self.hoisted and state.flat and state.level == self.cache[0]:
+                margin, block = self.children[0].translate(state), self._translate_cached(state)
+            else:
+                margin, block = (c.translate(state) for c in self.children)
             if not block: return margin
             
             append = (self.modifier == '...')
@@ -460,9 +643,35 @@ class NODES(object):
             if dedent:
                 block.set_indent('')
             return DOM(margin, block)
+
+        def _translate_cached(self, state):
+            """
+            Output of a loop-invariant block: pre-rendered on the first translation during an execution of the loop,
+            like in <merged>, and then taken from the frame's cache. Blocks that don't render to a single node are
+            translated anew each time.
+            """
+            index = self.cache[1]
+            value = state.values[index]
+            if value is UNDEFINED:
+                indentation = state.indentation
+                state.indentation = '\n'
+                try:
+                    dom = self.block.translate(state)
+                finally:
+                    state.indentation = indentation
+                value = state.values[index] = dom[0]._render_body() if len(dom) == 1 else None
+                if value is None:
+                    dom.set_indent(state.indentation)
+                    return dom
+            if value is None: return self.block.translate(state)
+            return DOM.text(value, indent = state.indentation)
             
     class block_text(node):
+        column = None           # column of the block's start in the script, computed once in setup() as it's needed on every render()
 
+        def setup(self):
+            self.column = self.locate(self.pos[0])[1]
+            
         def translate(self, state):
             return DOM.text(self.render(state), indent = state.indentation)
             
@@ -472,32 +681,12 @@ class NODES(object):
             indent = state.indentation
             state.indentation = ''
             
-            lead = self.column          # horizontal position where the block's first line begins in the script
             try:
                 body = self._render_all(self.children, state)
-                # if body.startswith('\n'):
-                #     output = body[1:]                   # no headline? drop the leading newline
-                # else:
-                output = ' ' * lead + body          # in the headline, spaces are prepended to replace leading tag(s) and a marker character /|!
             finally:
                 state.indentation = indent
 
-            sub_indent = get_indent(output)
-            sub_indent = sub_indent[:lead+1]        # max 1 initial space/tab after the lead is dropped; remaining sub-indentation is preserved in `output`
-            output = del_indent(output, sub_indent)
-            # print('sub_indent: "{sub_indent}"')
-
-            # if tail lines have shorter indent than the headline, drop all the lead + 1 space (gap)
-            if len(sub_indent) < lead:
-                drop = lead - len(sub_indent)
-                if output[drop:drop+1] == ' ': drop += 1
-                output = output[drop:]
-                
-            # # drop the 1st line (headline) if empty
-            # if output.split('\n', 1)[0].strip() == '':
-            #     output =
-            
-            return output
+            return format_text(body, self.column)
 
     class xblock_markup(block_text): pass
     class xblock_normal(block_text): pass
@@ -509,6 +698,7 @@ class NODES(object):
     class xblock_embed(node):
         """Embedding of DOM nodes through @... type of expression."""
         expr = None
+        ispure = False
         
         def setup(self):
             self.expr = self.children[0]
@@ -544,6 +734,15 @@ class NODES(object):
             ctx.reset(position)             # tagged node defines a local namespace, hence need to drop symbols defined inside
             ctx.regular_depth -= 1
             
+        def compactify(self, state, exposed = False):
+            # the body's DOM is only rendered, never inspected, if all tags are known in advance and don't need a DOM
+            tags = [tag.static_tag(state) if tag.type == 'tag_expand' else null for tag in self.tags.children]
+            rendered = [isinstance(tag, Tag) and not tag.dom for tag in tags]
+            for pos, tag in enumerate(self.tags.children):
+                tag.compactify(state, exposed or not all(rendered[:pos]))       # output of a tag is the body of preceding tags
+            exposed = exposed or not all(rendered)
+            self.body.compactify(state, exposed)
+            
         def translate(self, state):
             body = self.body.translate(state)
             body = self.tags.apply_tags(state, body)
@@ -560,6 +759,14 @@ class NODES(object):
         body       = None
         slot       = None
         native     = None           # a Native tag instance that will be inserted into all DOMs
+        level      = None           # level of the frame (State) where this hypertag is defined, see Slot.level
+        size       = None           # no. of slots in the frame of every expansion of this hypertag: attributes and local symbols
+        index      = None           # positions of regular attributes in `attr_regul`, as a dict {name: position}
+        slots      = None           # indices of regular attributes in the frame of expansion (State.values), in the order of `attr_regul`
+        defaults   = None           # default values of regular attributes, in the order of `attr_regul`: constants for literal defaults,
+                                    # MISSING for defaults that must be computed on every call, and for required attributes
+        bindings   = None           # cache of Binding instances for all combinations of attributes used in calls: {(npos, names): Binding}
+        ispure     = False
         
         def setup(self):
             self.name  = self.children[0].value
@@ -592,6 +799,9 @@ class NODES(object):
             ctx.hypertag_depth += 1
             position = ctx.position()
             
+            self.level = len(ctx.frames) - 1
+            ctx.frames.append(0)                    # attributes and local symbols are allocated in a new frame
+            
             for attr in self.attrs:                 # analyse default-value expressions of attributes
                 attr.analyse(ctx)
 
@@ -600,7 +810,14 @@ class NODES(object):
 
             self.body.analyse(ctx)                  # analyse the formal body
 
+            self.size = ctx.frames.pop()
             ctx.reset(position)
+            
+            # prepare data for bindings of actual attributes in calls
+            self.index    = {attr.name: pos for pos, attr in enumerate(self.attr_regul)}
+            self.slots    = [attr.slot.index for attr in self.attr_regul]
+            self.defaults = [self._constant(attr.expr) for attr in self.attr_regul]
+            self.bindings = {}
             ctx.hypertag_depth -= 1
             ctx.regular_depth  -= 1
 
@@ -608,75 +825,68 @@ class NODES(object):
             self.slot = ValueSlot(symbol, self, ctx)
             # ctx.push(symbol, self.slot)
             
+        def compactify(self, state, exposed = False):
+            self.body.compactify(state, True)       # output of a hypertag can be inspected as a DOM by the caller
+            
         def translate(self, state):
             self.slot.set_value(state)
             return None                 # hypertag produces NO output in the place of its definition (only in places of occurrence)
 
         def expand(self, body, attrs, kwattrs, state, caller):
             """
-            Translate the formal self.body in a given `state`, insert the actual `body` wherever necessary,
+            Translate the formal self.body in a new frame on top of the frame of this hypertag's definition,
+            which is found among the parents of the caller's `state`; insert the actual `body` wherever necessary,
             and return as a DOM (not a string!) for possible further manipulation in other hypertags.
             """
-            dom_attrs = self._append_attrs(body, attrs, kwattrs, state, caller)         # extend `state` with actual values of tag attributes
-            output = self.body.translate(state)
-            output.set_indent(state.indentation)
-            # return output
+            binding = self.binding(len(attrs), tuple(kwattrs), caller)
+            values  = list(attrs)
+            values += kwattrs.values()
+            return self.expand_bound(binding, body, values, state, caller)
+
+        def expand_bound(self, binding, body, values, state, caller, inline = False):
+            """
+            Like expand(), but with actual values of attributes listed in the order of a precomputed `binding`.
+            If inline=True, nodes of the output are returned directly, without a wrapper node of the Native tag
+            (unless the output is empty), so the caller must guarantee that the DOM won't be inspected.
+            """
+            parent = state
+            while parent.level > self.level: parent = parent.parent
+            frame = State(self.size, parent)
+            frame.indentation = state.indentation
+            
+            binding.bind(frame, body, values, caller)       # fill the `frame` with actual values of tag attributes
+            output = self.body.translate(frame)
+            output.set_indent(frame.indentation)
             
             if output: output[0].set_outline(False)         # node's `outline` will be set for the root node up in xblock.translate()
-            return DOM.node(output, state.indentation, tag = self.native, kwattrs = dom_attrs)
+            if inline and output: return output
+            return DOM.node(output, frame.indentation, tag = self.native, kwattrs = dict(zip(binding.names, values)))
 
-        def _append_attrs(self, body, attrs, kwattrs, state, caller):
-            """Extend `state` with actual values of tag attributes."""
+        def binding(self, npos, names, caller):
+            """
+            Binding of a call with `npos` positional attributes and keyword attributes of given `names` (a tuple).
+            Taken from cache, or created if this combination of attributes is used for the first time.
+            TypeErrorEx is raised if the attributes don't match the hypertag's signature.
+            """
+            binding = self.bindings.get((npos, names))
+            if binding is None:
+                binding = self.bindings[npos, names] = Binding(self, npos, names, caller)
+            return binding
 
-            # verify no. of positional attributes & names of keyword attributes
-            if len(attrs) > len(self.attr_regul):
-                raise TypeErrorEx("hypertag '%s' takes %s positional attributes but %s were given" % (self.name, len(self.attr_regul), len(attrs)), caller)
-            if self.attr_body and self.attr_body.name in kwattrs:
-                raise TypeErrorEx("direct assignment to body attribute '%s' of hypertag '%s' is not allowed" % (self.attr_body.name, self.name), caller)
-            
-            # translate attribute names in `kwattrs` to nodes as keys
-            try:
-                kwattrs = {self.attr_names[name]: value for name, value in kwattrs.items()}
-            except KeyError as ex:
-                name = ex.args[0]
-                raise TypeErrorEx("hypertag '%s' got an unexpected keyword attribute '%s'" % (self.name, name), caller)
-
-            dom_attrs = {}
-            dom_kwattrs = {attr.name: value for attr, value in kwattrs.items()}
-            
-            # move positional attributes to `kwattrs`
-            for pos, value in enumerate(attrs):
-                attr = self.attr_regul[pos]
-                if attr in kwattrs: raise TypeErrorEx("hypertag '%s' got multiple values for attribute '%s'" % (self.name, attr.name), caller)
-                kwattrs[attr] = value
-                dom_attrs[attr.name] = value
-
-            dom_attrs.update(dom_kwattrs)
-            # dom_attrs = {attr.name: value for attr, value in kwattrs.items()}
-            
-            # impute missing values with defaults
-            for attr in self.attr_regul:
-                if attr not in kwattrs:
-                    if attr.expr is None: raise TypeErrorEx("hypertag '%s' missing a required positional attribute '%s'" % (self.name, attr.name), caller)
-                    kwattrs[attr] = attr.expr.evaluate(state)
-                    
-            # transfer attribute values from `kwattrs` to `state`
-            for attr, value in kwattrs.items():
-                attr.assign(state, value)
-            # state.update(kwattrs)
-            
-            # append `body` to `state`
-            if self.attr_body:
-                self.attr_body.assign(state, body)
-            elif body:
-                raise VoidTagEx("non-empty body passed to a void hypertag '%s'" % self.name, caller)
-            
-            return dom_attrs
+        @staticmethod
+        def _constant(expr):
+            """Value of a default-value expression `expr` if it's a literal (number, string, boolean, None); MISSING otherwise."""
+            if expr is None or expr.qualifier or len(expr.children) != 1: return MISSING
+            value = expr.children[0]
+            if isinstance(value, NODES.literal) or (isinstance(value, NODES.xstring_format) and all(c.isstatic for c in value.children)):
+                return value.evaluate(None)
+            return MISSING
             
     class xblock_import(node):
         """"""
         path  = None            # import path string; optional
         items = None            # list of 1+ nodes of type <xwild_import> or <xname_import>
+        ispure = False
         
         def setup(self):
             if self.children[0].type == 'path_import':
@@ -751,21 +961,27 @@ class NODES(object):
             super(NODES.xblock_import, self).analyse(ctx)
 
     class xcntx_import(node):
-        """Like <xname_import> but imports the name from a dynamic context rather than from a module."""
-        slot  = None        # <slot> that will keep value of the symbol
+        """
+        Like <xname_import> but imports the name from a dynamic context rather than from a module.
+        The value is pulled from `state.context` during translation, so a single analysed AST
+        can be translated many times with different contexts.
+        """
+        symbol = None       # original symbol name with leading % or $
+        slot   = None       # <slot> that will keep value of the symbol
+        ispure = False
         
-        def analyse(self, ctx):
-            context = self.tree.context
-            symbol  = self.children[0].value                            # original symbol name with leading % or $
-            rename  = (symbol[0] + self.children[1].value) if len(self.children) == 2 else symbol
+        def setup(self):
+            self.symbol = self.children[0].value
             
-            if symbol not in context: raise ImportErrorEx("symbol '%s' not found in context" % symbol, self)
-            value = context[symbol]
-            self.slot = ValueSlot(rename, value, ctx)
+        def analyse(self, ctx):
+            rename = (self.symbol[0] + self.children[1].value) if len(self.children) == 2 else self.symbol
+            self.slot = Slot(rename, ctx)
             # ctx.push(rename, self.slot)
 
         def translate(self, state):
-            self.slot.set_value(state)
+            if self.symbol not in state.context:
+                raise ImportErrorEx("symbol '%s' not found in context, it must be passed to translate() or render() as a keyword argument" % self.symbol, self)
+            self.slot.set(state, state.context[self.symbol])
 
         
     class control_block(node):
@@ -776,6 +992,7 @@ class NODES(object):
         # slot_maps = None        # list of slot mappings for every branch including the null branch (-1); each mapping
         #                         # is a dict of {input_or_local_slot: output_slot} pairs; values are copied
         #                         # from input/local to output slots after translation of the block
+        ispure = False
         
         def analyse(self, ctx):
             ctx.control_depth += 1
@@ -907,10 +1124,140 @@ class NODES(object):
             assert len(self.children) == 1
             return self.children[0].translate(state)
         
-    class xblock_while(control_block):
+    class loop_block(control_block):
+        """
+        Base class for "for" and "while" loops. Expressions and blocks inside a loop that don't depend on variables
+        assigned in the loop (loop invariants) are evaluated only once per execution of the loop and cached in the frame.
+        Candidates are found during analysis, from the slots they read; the loop that owns a candidate's cache -
+        the outermost one where the candidate is invariant - is picked during compactification. Only loops without
+        side effects are considered: no function calls or pipelines, no $-blocks, no dynamic or imported hypertags, no impure tags.
+        Member access, indexing, operators and iteration are ASSUMED to have no side effects, which doesn't hold
+        for stateful iterators or generators, hence the optimization is only performed if enabled with `Runtime.hoist`.
+        """
+        written = None          # set of slots assigned inside the loop, including the loop targets, as (level, index) pairs
+        nested  = False         # True if this loop is located inside another loop
+        hoisted = None          # frame indices of caches owned by this loop; they're cleared on every execution of the loop
+        
+        def analyse(self, ctx):
+            super(NODES.loop_block, self).analyse(ctx)
+            self.written = set()
+            self.nested  = False
+            self.hoisted = None
+            
+            # collect assignments, and reserve cache slots for candidate expressions and blocks outside the loop header;
+            # candidates inside nested loops were handled there
+            header = self._header()
+            stack  = [(child, child in header) for child in self.children]
+            while stack:
+                node, inheader = stack.pop()
+                if inheader:
+                    if isinstance(node, NODES.variable) and node.slot_write is not None:
+                        self.written.add((node.slot_write.level, node.slot_write.index))
+                    stack += [(child, True) for child in node.children or ()]
+                    continue
+                if isinstance(node, NODES.loop_block):
+                    node.nested = True
+                    self.written |= node.written
+                    continue
+                if isinstance(node, NODES.variable) and node.slot_write is not None:
+                    self.written.add((node.slot_write.level, node.slot_write.index))
+                if isinstance(node, (NODES.expression_root, NODES.xblock)):
+                    node.cache, node.hoisted = None, False
+                    if isinstance(node, NODES.xblock): node.invariant = False
+                    if self._candidate(node): node.cache = ctx.allocate()
+                    if isinstance(node, NODES.expression_root): continue
+                stack += [(child, False) for child in node.children or ()]
+                
+        def _candidate(self, node):
+            """Check if a given expression or block may be invariant, judging only by its syntax."""
+            if isinstance(node, NODES.expression_root):
+                if len(node.children) != 1 or isinstance(node.children[0], (NODES.variable, NODES.literal)): return False
+            elif not isinstance(node.block, NODES.xblock_struct):
+                return False
+            return self._scan([node], None, self._excluded(node)) is not None
+            
+        @staticmethod
+        def _excluded(node = None):
+            """
+            Types of nodes that may have side effects, which are not allowed inside a loop with invariants (node=None);
+            or types of nodes that are not allowed inside an invariant expression or block `node`.
+            """
+            excluded = (NODES.xcall, NODES.xpipeline, NODES.xtag_use, NODES.xblock_expr)
+            if isinstance(node, NODES.xblock): excluded += (NODES.xblock_assign, NODES.control_block)
+            return excluded
+            
+        def _header(self):
+            """Children evaluated once per execution of the loop, before the iterations."""
+            return ()
+        
+        def compactify(self, state, exposed = False):
+            if not self.nested and self.tree.runtime.hoist: self._hoist(state, [])
+            super(NODES.loop_block, self).compactify(state, exposed)
+            
+        def _hoist(self, state, loops):
+            """
+            Assign candidate invariants to their owners: the outermost loops (from the list of enclosing `loops` + self)
+            that have no side effects and don't assign any of the variables read by a candidate.
+            """
+            self.hoisted = []
+            header = self._header()
+            body = [child for child in self.children if child not in header]
+            if self._scan(body, state, self._excluded()) is not None:
+                loops = loops + [self]
+            
+            stack = body
+            while stack:
+                node = stack.pop()
+                if isinstance(node, NODES.loop_block):
+                    node._hoist(state, loops)
+                    continue
+                if isinstance(node, (NODES.expression_root, NODES.xblock)) and node.cache is not None:
+                    block = isinstance(node, NODES.xblock)
+                    reads = self._scan([node], state, self._excluded(node))
+                    owner = next((loop for loop in loops if not reads & loop.written), None) if reads is not None else None
+                    if owner is not None:
+                        owner.hoisted.append(node.cache[1])
+                        if block: node.invariant = True             # the final decision is made in xblock.compactify()
+                        else:     node.hoisted = True
+                    if not block: continue
+                stack.extend(node.children or ())
+        
+        @staticmethod
+        def _scan(nodes, state, excluded):
+            """
+            Return a set of slots, as (level, index) pairs, read in the subtrees of `nodes`, including the bodies of hypertags
+            called there, or None if any node of `excluded` types was found. If `state` is given, every tag must be known
+            in advance: a built-in or imported pure Tag (see Tag.pure), or a native hypertag whose subtree satisfies
+            the same conditions. Slots of different frames may share the same pair, which only makes the check more strict.
+            """
+            reads, called = set(), set()
+            stack = list(nodes)
+            while stack:
+                node = stack.pop()
+                if isinstance(node, excluded): return None
+                if isinstance(node, NODES.variable) and node.slot_read is not None:
+                    reads.add((node.slot_read.level, node.slot_read.index))
+                if state is not None and isinstance(node, NODES.xtag_expand):
+                    tag = node.static_tag(state)
+                    if isinstance(tag, NODES.xblock_def):
+                        if tag not in called:
+                            called.add(tag)
+                            stack.extend(tag.children)                  # attributes with default values, and the body
+                    elif not isinstance(tag, Tag) or not tag.pure:
+                        return None
+                stack.extend(node.children or ())
+            return reads
+        
+        def _clear_cache(self, state):
+            values = state.values
+            for index in self.hoisted:
+                values[index] = UNDEFINED
+            
+    class xblock_while(loop_block):
         # def _analyse_branches(self, ctx):
         #     self.children[0].analyse(ctx)
         def translate(self, state):
+            if self.hoisted: self._clear_cache(state)
             out = []
             empty = True
             clause = self.children[0]
@@ -930,7 +1277,7 @@ class NODES(object):
             out.set_indent(state.indentation)
             return out
         
-    class xblock_for(control_block):
+    class xblock_for(loop_block):
         targets = None              # 1+ loop variables to assign to
         expr    = None              # loop expression that returns a sequence (iterable) to be looped over
         body    = None              # inner blocks of the loop, can be missing
@@ -949,7 +1296,11 @@ class NODES(object):
             self.targets.analyse(ctx)
             if self.body: self.body.analyse(ctx)
 
+        def _header(self):
+            return self.targets, self.expr
+            
         def translate(self, state):
+            if self.hoisted: self._clear_cache(state)
             out = []
             empty = True
             sequence = self.expr.evaluate(state)
@@ -978,6 +1329,7 @@ class NODES(object):
               $ l.append(3)
         """
         expr = None
+        ispure = False
         def setup(self):
             assert len(self.children) == 1
             self.expr = self.children[0]
@@ -990,6 +1342,7 @@ class NODES(object):
         inplace = None          # symbol of in-place arithmetic operator to apply (+-*/), optional
         expr    = None
         oper    = None          # 2-arg function that implements `inplace` operator
+        ispure  = False
         
         opers   = {'+':  operator.add,
                    '-':  operator.sub,
@@ -1133,6 +1486,9 @@ class NODES(object):
         attrs = None        # 0+ list of <attr_short> and <attr_val> nodes
         unnamed = None      # list of <expression> nodes of unnamed attributes from `attrs`
         named   = None      # list of (name, expression) pairs of named attributes from `attrs`; duplicate names allowed
+        binding = None      # Binding of attributes to a native hypertag, precomputed if the hypertag is known during analysis
+        inline  = False     # if True, the hypertag's output is inserted in the DOM without a wrapper node when the DOM is only rendered;
+                            # set during compactification for calls whose output is never inspected as a DOM
         
         def setup(self):
             
@@ -1165,16 +1521,60 @@ class NODES(object):
             self.tag = ctx.get(TAG(self.name))
             if self.tag is None: raise UndefinedTagEx("undefined tag '%s'" % self.name, self)
             
+            # a native hypertag defined in this script has a known signature: calls can be bound once, now
+            self.binding = None
+            if isinstance(self.tag, ValueSlot) and isinstance(self.tag.value, NODES.xblock_def):
+                names = tuple(name for name, _ in self.named)
+                if len(set(names)) == len(names):               # repeated attributes are concatenated in _eval_attrs()
+                    try:
+                        self.binding = self.tag.value.binding(len(self.unnamed), names, self)
+                    except TypeErrorEx:
+                        pass                                    # the same error will be raised during translation, if ever reached
+            
+        def compactify(self, state, exposed = False):
+            self.inline = self.binding is not None and not exposed and self.tree.runtime.compact
+            
+        def static_tag(self, state):
+            """
+            Value of this tag if it's known before translation: an imported or built-in tag (its value is written to `state`),
+            or None otherwise. `state` must contain values of built-in symbols.
+            """
+            if isinstance(self.tag, ValueSlot):
+                try:
+                    self.tag.set_value(state)
+                except KeyError:                        # the tag is defined inside a hypertag, not in the frame of `state`
+                    pass
+                return self.tag.value
+            try:
+                return self.tag.get(state)
+            except KeyError:
+                return None
+            
+        def check_pure(self, state):
+            if self.ispure is None:
+                tag = self.static_tag(state)
+                self.ispure = isinstance(tag, Tag) and tag.pure and all(attr.check_pure(state) for attr in self.attrs)
+            return self.ispure
+            
         def translate_tag(self, state, body):
             """
             translate_tag() differs from a regular translate() in that it accepts `body` additionaly.
             The actual `body` is already translated and has a form of a DOM.
             """
-            attrs, kwattrs = self._eval_attrs(state)            # calculate actual values of attributes
-            
             assert isinstance(self.tag, Slot)
-            tag = self.tag.get(state)
-
+            binding = self.binding
+            if binding is not None:
+                values = [attr.evaluate(state) for attr in self.unnamed]
+                values += [expr.evaluate(state) for _, expr in self.named]
+                tag = self.tag.get(state)
+                if tag is binding.hypertag:
+                    return tag.expand_bound(binding, body, values, state, self, self.inline and state.flat)
+                npos = len(self.unnamed)
+                attrs, kwattrs = values[:npos], dict(zip(binding.names[npos:], values[npos:]))
+            else:
+                attrs, kwattrs = self._eval_attrs(state)        # calculate actual values of attributes
+                tag = self.tag.get(state)
+            
             if isinstance(tag, Hypertag):
                 return tag.expand(body, attrs, kwattrs, state, self)
             
@@ -1284,6 +1684,9 @@ class NODES(object):
         
         qualifier = None            # optional qualifier: ? or ! ... used only in a few node types
         
+        def compactify(self, state, exposed = False):
+            pass                        # expressions are not compactified, only blocks
+        
         def evaluate(self, state):
             raise NotImplementedError
 
@@ -1314,6 +1717,10 @@ class NODES(object):
         qualifier = None        # optional qualifier: ? or !
         context   = None        # copy of Context that has been passed to this node during analyse(); kept for re-use by render(),
                                 # in case if the expression evaluates to yet another (dynamic) piece of Hypertag code
+        cache     = None        # (level, index) of a frame slot reserved during analysis for the value of this expression,
+                                # if it's a candidate for a loop invariant; see <loop_block>
+        hoisted   = False       # True if the value is cached during execution of an enclosing loop
+        
         def setup(self):
             # see if there is a qualifier added as a sibling of this node
             if self.sibling_next and self.sibling_next.type == 'qualifier':
@@ -1324,7 +1731,13 @@ class NODES(object):
             return STR(self.evaluate(state), self)
         
         def evaluate(self, state):
-            return self.evaluate_with_qualifier(state)
+            if not self.hoisted or state.level != self.cache[0]:
+                return self.evaluate_with_qualifier(state)
+            values = state.values
+            value  = values[self.cache[1]]
+            if value is UNDEFINED:                  # first evaluation during the current execution of the loop
+                value = values[self.cache[1]] = self.evaluate_with_qualifier(state)
+            return value
         
         def _eval_inner_qualified(self, state):
             assert len(self.children) == 1
@@ -1341,6 +1754,7 @@ class NODES(object):
         """Occurrence of a tag inside an expression: %TAG."""
         symbol = None
         slot   = None           # Slot that identifies this tag inside `state` for read access
+        ispure = False
         
         def setup(self):
             self.symbol = self.text()
@@ -1370,6 +1784,7 @@ class NODES(object):
         
         slot_read  = None       # Slot that identifies this variable inside `state` for read access
         slot_write = None       # Slot that identifies this variable inside `state` for write access
+        ispure     = False      # values of variables are not known before translation
         
         # slot_read & slot_write may reference different Slots, e.g., in a reassignment block that overrides a name defined upper in the doc:
         #   $x = 1
@@ -1464,11 +1879,6 @@ class NODES(object):
         """
         title = 'sequence index [...]'
 
-        def compactify(self, state):
-            assert 1 <= len(self.children) <= 3
-            self.children = [n.compactify(state) for n in self.children]
-            return self
-
         def apply(self, obj, state):
             # simple index: [i]
             if len(self.children) == 1:
@@ -1481,8 +1891,6 @@ class NODES(object):
         
     class xmember(tail):
         title = 'member access "."'
-        def compactify(self, state):
-            return self                                 # no compactification, it's only 1 child: a static identifier
         def apply(self, obj, state):
             assert self.children[0].type == "name_id"
             member = self.children[0].value
@@ -1535,8 +1943,8 @@ class NODES(object):
         ops['/'] = getattr(operator, 'div', None) or operator.truediv
         
         # extra operators, implemented by ourselves
-        ops['in'] = lambda x, d: x in d                         # operator.contains() is not suitable bcs it takes operands in reversed order
-        ops['not in'] = lambda x, d: x not in d
+        ops['in'] = contains                                    # named functions, not lambdas, so that nodes can be pickled
+        ops['not in'] = not_contains
         ops[''] = ops['+']                                      # missing operator mapped to '+' (implicit +)
         
         def setup(self):
@@ -1841,70 +2249,95 @@ class NODES(object):
         whitechar = '\t'
 
 
-    # ###  SYNTHETIC nodes  ###
-    #
-    # class merged(static):
-    #     """
-    #     An artificial node created during compactification by merging several sibling nodes that are all pure (or static, in particular).
-    #     Values of the original nodes (strings to be concatenated) are retrieved from their render().
-    #     """
-    #     value = None        # pre-rendered output of the compactified nodes
-    #     ex = None           # if FalseValueEx exception was caught during rendering, it's stored here as an (exception, traceback) pair
-    #
-    #     def __init__(self, node, state):
-    #         self.tree = node.tree
-    #         self.fulltext = node.fulltext
-    #         self.pos = node.pos
-    #         try:
-    #             self.value = node.render(state)
-    #         except FalseValueEx as ex:
-    #             self.ex = (ex, sys.exc_info()[2])
-    #
-    #     def merge(self, node, state, sep):
-    #         self.pos = (self.pos[0], node.pos[1])
-    #         if self.ex: return                          # we already know that an exception will be raised upon self.render(), no need to append new nodes
-    #         try:
-    #             nodeValue = node.render(state)
-    #             self.value += sep + nodeValue
-    #         except FalseValueEx as ex:
-    #             self.ex = (ex, sys.exc_info()[2])
-    #
-    #     def render(self, state):
-    #         if self.ex: reraise(None, self.ex[0], self.ex[1])
-    #         return self.value
-    #
-    #     def info(self):
-    #         from nifty.util import escape as slash_escape
-    #         return "%s at position %s rendering: %s" % (self.infoName(), self.pos, slash_escape(str(self.value)))
-    #
-    # ###  UTILITY METHODS  ###
-    #
-    # @staticmethod
-    # def _compactify_siblings_(nodes, state, sep = u''):
-    #     "Compactify a list of sibling nodes, by compactifying each one separately when possible and then merging neighboring static nodes."
-    #     out = []
-    #     last = None         # the current last <merged> node; can be expanded if the subsequent node is also pure
-    #
-    #     for node in nodes:
-    #         #print(' ', node, node.check_pure())
-    #         if node.check_pure():                               # a pure node that can be reduced into a <merged> node?
-    #             if last: last.merge(node, state, sep)
-    #             else:
-    #                 last = NODES.merged(node, state)
-    #                 out.append(last)
-    #         else:                                               # non-pure node? let's compactify recursively its subtree and append
-    #             node.compactify(state)
-    #             out.append(node)
-    #             last = None
-    #
-    #     return out
-    
+    ###  SYNTHETIC nodes  ###
+
+    class merged(artificial):
+        """
+        An artificial node created during compactification in place of a pure <xblock_struct>: a block whose output
+        doesn't depend on variables and can be rendered before translation. Its output is pre-rendered (relative to
+        the block's own indentation) and returned as a DOM.Text node on every translate() call.
+        If the block's DOM might be inspected by a hypertag or a tag that needs a DOM (`exposed`),
+        the original block is translated instead, and the pre-rendered output is only used in direct-to-string rendering.
+        """
+        isstatic = True
+        ispure   = True
+        value    = None         # pre-rendered output of the original block, without the block's indentation and outline;
+                                # None if rendering failed (the original block should be kept then)
+        origin   = None         # the original <xblock_struct> node
+        exposed  = False        # if True, translate() produces a DOM of the original block
+        
+        def __init__(self, node, state, exposed = False):
+            super(NODES.merged, self).__init__(node)
+            self.children = []
+            self.parent   = node.parent
+            self.origin   = node
+            self.exposed  = exposed
+            
+            indentation = state.indentation
+            state.indentation = '\n'
+            try:
+                dom = node.translate(state)
+                if len(dom) == 1: self.value = dom[0]._render_body()
+            except Exception:
+                pass                                        # errors will be reported during translation of the original block
+            finally:
+                state.indentation = indentation
+        
+        def analyse(self, ctx):
+            self.origin.analyse(ctx)
+            
+        def translate(self, state):
+            if self.exposed: return self.origin.translate(state)
+            return DOM.text(self.value, indent = state.indentation)
+            
+        def __str__(self):
+            return self.value
+
 
 #####################################################################################################################################################
 #####
 #####  HypertagAST
 #####
 
+class ASTPickler(pickle.Pickler):
+    """
+    Pickler of a HypertagAST that drops the results of semantic analysis: all Slots (together with the values
+    they keep, like imported symbols) are replaced with None, and <merged> nodes are replaced with the original blocks.
+    The unpickled tree must be analysed again.
+    """
+    def persistent_id(self, obj):
+        if isinstance(obj, Slot): return 'slot'
+        if isinstance(obj, NODES.merged): return ('merged', obj.origin)
+        return None
+
+class ASTUnpickler(pickle.Unpickler):
+    def persistent_load(self, pid):
+        if isinstance(pid, tuple): return pid[1]
+        return None
+
+class BlockPickler(pickle.Pickler):
+    """
+    Pickler of a top-level block of an unanalysed HypertagAST (see HypertagAST.blocks). Links to the tree and its text
+    are stored as references, to be replaced with the tree and text of a new version of the script during unpickling.
+    """
+    def __init__(self, file, tree):
+        super(BlockPickler, self).__init__(file, pickle.HIGHEST_PROTOCOL)
+        self.tree = tree
+        
+    def persistent_id(self, obj):
+        if obj is self.tree: return 'tree'
+        if obj is self.tree.text: return 'text'
+        return None
+
+class BlockUnpickler(pickle.Unpickler):
+    def __init__(self, file, tree):
+        super(BlockUnpickler, self).__init__(file)
+        self.tree = tree
+        
+    def persistent_load(self, pid):
+        return self.tree if pid == 'tree' else self.tree.text
+
+
 class HypertagAST(BaseTree):
 
     NODES  = NODES              # must tell the BaseTree's rewriting routine where node classes can be found
@@ -1934,6 +2367,13 @@ class HypertagAST(BaseTree):
 
     _reduce_anonym_ = True      # reduce all anonymous nodes, i.e., nodes generated by unnamed expressions, typically groupings (...)
     _reduce_string_ = True      # if a node to be reduced has no children but matched a non-empty part of text, it shall be replaced with a 'string' node
+
+    # actions of rewrite() for different types of nodes, as precomputed in _actions()
+    IGNORE  = 1                 # drop the node together with its subtree
+    FLATTEN = 2                 # replace the node with its children; drop it if it's a leaf
+    REDUCE  = 3                 # like FLATTEN, but a leaf that matched a non-empty string is replaced with a `reduced` string node
+    CREATE  = 4                 # create a NODES.x* node
+    COMPACT = 5                 # like CREATE, but return the only child instead, if there's exactly one
     
 
     ###  Environment  ###
@@ -1941,21 +2381,41 @@ class HypertagAST(BaseTree):
     module   = None             # the module this script was imported from, as runtime.Module instance; can be None (script from a string)
     filename = None             # name of the file this script comes from; for error messages
     runtime  = None             # instance of Runtime that loaded this document and controls how external modules and symbols are imported
-    context  = None             # dict of symbols passed to self.translate() as `context`
     
     ###  Output of parsing and analysis  ###
 
     text    = None              # full text of the input string fed to the parser
-    ast     = None              # raw AST as generated by Pasimonious; for read access
+    ast     = None              # raw AST as generated by Pasimonious; for read access; None if the script was parsed
+                                # by top-level blocks (_parse_blocks()) or with the native parser
     root    = None              # root node of the final tree after rewriting
+    depths  = None              # net no. of INDENT/DEDENT characters in `text` before every line; created by indentation()
+    analysed = False            # True after analyse() was called; the analysis does NOT depend on actual values of symbols,
+                                # so it's performed only once, even if the AST gets translated many times
+    compiled = None             # document function generated by compile() for the "compiler" backend; False if compilation failed
+    compiled_direct = None      # document function generated by compile(direct = True) that renders directly to a string;
+                                # False if the script can't be compiled in this mode
+    compiled_stream = None      # document generator function produced by compile(stream = True); False if not possible
+    compiled_async  = None      # document coroutine function produced by compile(asynchronous = True); False if not possible
+    blocks  = None              # pristine (unanalysed) top-level blocks as a list of (text, start, data) triples: the preprocessed text
+                                # of a block, its position in the script it was parsed from, and the pickled nodes (BlockPickler);
+                                # kept if incremental=True, for reuse by later versions of the script
 
     # symbols   = None            # dict of all top-level symbols as name->node pairs
     # hypertags = None            # dict of top-level hypertags indexed by name, for use by the client as hypertag functions
     #                             # includes imported hypertags (!), but not external ones, only the native ones
 
     
-    def __init__(self, script, module, verbose = False):
-
+    HEAD         = re.compile(r'\n*[^\n]*')        # leading newlines and the first line of a block: a key for finding blocks to be reused
+    BOUNDARY     = re.compile(r'\n+(?!\n|el(if|se))')  # a line break after a top-level block that can't be followed by a clause extending the block
+    LAYOUT       = {'margin', 'indent_s', 'indent_t', 'dedent_s', 'dedent_t'}     # rules that match the line breaks and indentation between blocks
+    
+    def __init__(self, script, module, verbose = False, previous = None, incremental = False):
+        """
+        Parse `script` and build a tree of NODES.x* rooted at self.root. If the `previous` AST of an earlier version
+        of the script is given and it was created with incremental=True, top-level blocks that did not change are
+        copied from there instead of being parsed again. With incremental=True, pristine copies of top-level blocks
+        are kept in self.blocks for later reuse.
+        """
         self.module   = module
         self.runtime  = module.runtime
         self.filename = module.filename
@@ -1967,13 +2427,14 @@ class HypertagAST(BaseTree):
         # parse input text to the 1st version of AST (self.ast) as returned by Parsimonious,
         # then rewrite it to custom NODES.* classes rooted at self.root
         try:
-            super(HypertagAST, self).__init__(flat_script)
+            blocks = previous.blocks if previous and previous.parser is self.parser else None
+            self._parse(flat_script, blocks, incremental)
             
         except IncompleteParseError as ex:
             L = 15
-            line, line_num = self._locate_error(script)
+            line, line_num, column = self._locate_error(script, ex.pos)
             dots = "..." if len(line) > L else ""
-            raise SyntaxErrorEx('invalid syntax near line %s: %s%s' % (line_num, line[:L], dots))
+            raise SyntaxErrorEx('invalid syntax at line %s, column %s: %s%s' % (line_num, column, line[:L], dots))
         
         if self.root is None:           # workaround for Parsimonious bug in the special case of empty document (Parsimonious returns None instead of a tree root)
             self.root = NODES.xdocument(self, ObjDict(start = 0, end = 0, children = [], expr_name = 'document'))
@@ -1981,32 +2442,251 @@ class HypertagAST(BaseTree):
         assert isinstance(self.root, NODES.xdocument)
 
 
-    def _locate_error(self, script):
+    @deep_recursion
+    def _parse(self, text, blocks = None, incremental = False):
+        """
+        Parse a preprocessed script and build the tree of NODES.x* rooted at self.root, either with Parsimonious
+        followed by rewriting of its AST, or with the hand-written parser (hypertag.core.parser),
+        as selected by `runtime.parser`. Both parsers produce identical trees.
+        Top-level blocks found in `blocks` (see self.blocks) are copied from there and not parsed.
         """
-        Find the first line of `script` that causes Parsimonious' IncompleteParseError. Uses binary search and script truncation.
+        super(HypertagAST, self).__init__()         # only initializes the configuration of rewriting, nothing is parsed yet
+        self.text = text
+        if incremental: self.blocks = []
+        if not text: return
+        
+        reused = {}                                 # id of a copied block -> its entry in `blocks`
+        reuse  = self._reuse(text, blocks, reused) if blocks else None
+        
+        if self.runtime.parser == 'native':
+            from hypertag.core.parser import Parser
+            self.root = Parser(self).parse(text, reuse)
+        else:
+            self.root = self._parse_blocks(text, reuse)
+            
+        self.root._enrich()
+        for node in self.root.children:             # copied blocks have been set up already
+            if id(node) not in reused: node._setup_all()
+        self.root.setup()
+        
+        if incremental:
+            self.blocks = [reused.get(id(node)) or self._dump_block(node) for node in self.root.children if isinstance(node, NODES.xblock)]
+        
+    def _dump_block(self, node):
+        """Entry of self.blocks for a top-level block `node`."""
+        stream = io.BytesIO()
+        BlockPickler(stream, self).dump(node)
+        start, end = node.pos
+        return self.text[start:end], start, stream.getvalue()
+        
+    def _reuse(self, text, blocks, reused):
+        """
+        Return a function that takes a position in `text` and returns a copy of a top-level block from `blocks`
+        whose text occurs at this position, or None. A block parses to the same tree at the new position if it is followed
+        by a boundary that can't extend it: the end of text, a dedent, or a line break that is not followed by
+        a clause (elif, else); an indent would start a body of the block's last element. Copied blocks are recorded in `reused`.
+        """
+        symbols = self.parser.symbols
+        ends  = ('', symbols['DEDENT_S'], symbols['DEDENT_T'])
+        heads = {}
+        for block in blocks:
+            heads.setdefault(self.HEAD.match(block[0]).group(), []).append(block)
+        
+        def reuse(pos):
+            for block in heads.get(self.HEAD.match(text, pos).group(), ()):
+                source, start, data = block
+                end = pos + len(source)
+                if text.startswith(source, pos) and (text[end:end+1] in ends or self.BOUNDARY.match(text, end)):
+                    node = BlockUnpickler(io.BytesIO(data), self).load()
+                    if pos != start: self._shift(node, pos - start)
+                    reused[id(node)] = block
+                    return node
+        return reuse
+    
+    @staticmethod
+    def _shift(node, shift):
+        """Move positions of all nodes in a subtree by `shift` characters."""
+        nodes = [node]
+        while nodes:
+            node = nodes.pop()
+            if node.pos: node.pos = (node.pos[0] + shift, node.pos[1] + shift)
+            nodes.extend(node.children)
+        
+    def _actions(self):
+        """
+        Dispatch table of rewrite() for the current grammar: a dict of (action, NODES class) pairs indexed by rule names,
+        computed once per Grammar instance from the configuration of rewriting (_ignore_, _reduce_, _compact_).
+        Anonymous nodes are listed under an empty name. Rules that have no NODES class and are not pruned
+        are left out, so that they raise an error when encountered.
+        """
+        grammar = self.parser
+        if grammar.actions is None:
+            actions = {'': (self.FLATTEN, None)} if self._reduce_anonym_ else {}
+            for name in grammar.keys():
+                if name in self._ignore_:   actions[name] = (self.IGNORE, None)
+                elif name in self._reduce_: actions[name] = (self.REDUCE, None)
+                elif hasattr(self.NODES, 'x' + name):
+                    action = self.COMPACT if name in self._compact_ else self.CREATE
+                    actions[name] = (action, getattr(self.NODES, 'x' + name))
+            grammar.actions = actions
+        return grammar.actions
+        
+    def rewrite(self, astnode):
+        """
+        Convert a Parsimonious node and its subtree to NODES.x* nodes. Does the same as ParsimoniousTree.rewrite(),
+        but the action for every node is looked up in a precomputed table (_actions), nodes are created without
+        calling their __init__, like in the native parser (hypertag.core.parser), and children are collected
+        from the stack of rewritten subtrees with no intermediate lists or generators.
+        """
+        if astnode is None: return None
+        IGNORE, FLATTEN, REDUCE, CREATE = self.IGNORE, self.FLATTEN, self.REDUCE, self.CREATE
+        actions = self._actions()
+        text    = self.text
+        
+        order = []                          # pre-order, right-to-left; reversed, it gives a post-order, left-to-right
+        stack = [astnode]
+        while stack:
+            node = stack.pop()
+            name = node.expr.name
+            try:
+                action, cls = actions[name]
+            except KeyError:
+                raise AttributeError("no NODES class for rule '%s'" % name)
+            order.append((node, action, cls))
+            if action != IGNORE: stack.extend(node.children)
+        
+        out = []                            # rewritten subtrees awaiting their parents: a node, a list of nodes, or None (ignored)
+        for node, action, cls in reversed(order):
+            if action == IGNORE:
+                out.append(None)
+                continue
+            
+            count = len(node.children)
+            children = []
+            if count:
+                start = len(out) - count
+                for i in range(start, len(out)):
+                    item = out[i]
+                    if item.__class__ is list: children += item
+                    elif item is not None:     children.append(item)
+                del out[start:]
+            
+            if action == FLATTEN:
+                out.append(children)
+            elif action == REDUCE:
+                if count or node.start == node.end: out.append(children)
+                else: out.append(self.reduced(self, node))
+            elif action != CREATE and len(children) == 1:
+                out.append(children[0])
+            else:
+                new = cls.__new__(cls)
+                new.tree = self
+                new.fulltext = text
+                new.pos = (node.start, node.end)
+                new.type = node.expr.name
+                new.children = children
+                out.append(new)
+        
+        return [] if out[0] is None else out[0]
         
-        This method relies on the fact that truncating an arbitrary number of trailing lines of a script
-        never introduces syntax errors unless they already have been present in the preceeding lines.
-        For this to be true, all control blocks are allowed by Hypertag grammar to have empty body.
+    def _parse_blocks(self, text, reuse = None):
         """
-        lines = script.split('\n')
+        Parse `text` with Parsimonious one top-level block at a time and rewrite each block right away,
+        so that the memory taken by Parsimonious' packrat cache and raw AST is bounded by the size of the largest block,
+        not the entire script. Equivalent to parsing the `document` rule: a leading indentation of the whole script
+        is matched level by level as nested (indent core_blocks dedent) sequences, which is the only way `tail_blocks`
+        can match there, because no `block` starts with an indentation character.
+        """
+        grammar = self.parser
+        symbols = grammar.symbols
+        levels  = {symbols['INDENT_S']: ('indent_s', 'dedent_s'), symbols['INDENT_T']: ('indent_t', 'dedent_t')}
+        error   = ParseError(text)
+        nodes   = []
+        
+        def match(rule, pos):
+            node = grammar[rule].match_core(text, pos, {}, error)      # a new packrat cache for every top-level block
+            if node is None: return -1
+            nodes.append(self.rewrite(node))
+            return node.end
+        
+        pos = 0
+        dedents = []
+        while text[pos:pos+1] in levels:
+            indent, dedent = levels[text[pos]]
+            pos = match(indent, pos)
+            dedents.append(dedent)
+        
+        start = end = pos
+        while pos >= 0:
+            last, end = end, pos                                       # starts of the last parsed block and the current one
+            node = reuse(pos) if reuse else None
+            if node:
+                nodes.append(node)
+                pos = node.pos[1]
+            else:
+                pos = match('block', pos)
+        pos = end
         
-        line_good = 0               # the last known line before the error
-        line_bad  = len(lines)      # the first known line after or containing the error
+        if dedents and pos == start: pos = -1                          # `core_blocks` inside indentation can't be empty
+        for dedent in reversed(dedents):
+            if pos >= 0: pos = match(dedent, pos)
         
-        while line_good + 1 < line_bad:
-            split   = (line_good + line_bad) // 2
-            partial = '\n'.join(lines[:split])
-            flat    = self.parser.preprocess(partial)
-            try:
-                super(HypertagAST, self).__init__(flat)
-                line_good = split
-                
-            except IncompleteParseError:
-                line_bad = split
-
-        if not line_bad: line_bad = 1
-        return lines[line_bad-1].strip(), line_bad
+        if pos >= 0: pos = max(pos, match('margin', pos))
+        if pos != len(text): raise IncompleteParseError(text, last, grammar['document'])
+        
+        root = NODES.xdocument(self, ObjDict(start = 0, end = pos, children = [], expr_name = 'document'))
+        root.children = flatten(nodes)
+        return root
+        
+    def indentation(self, pos):
+        """
+        Net no. of INDENT minus DEDENT characters in self.text before position `pos`, which is the shift of columns
+        between self.text and the original script. Computed with a table of cumulative counts per line, built once.
+        """
+        symbols = self.parser.symbols
+        marks   = [(symbols['INDENT_S'], 1), (symbols['INDENT_T'], 1), (symbols['DEDENT_S'], -1), (symbols['DEDENT_T'], -1)]
+        def count(text): return sum(text.count(char) * sign for char, sign in marks)
+        
+        line, _ = self.locate(pos)
+        offsets = self.offsets
+        if self.depths is None:
+            depths = [0]
+            for start, end in zip(offsets, offsets[1:]):
+                depths.append(depths[-1] + count(self.text[start:end]))
+            self.depths = depths
+        
+        return self.depths[line - 1] + count(self.text[offsets[line - 1]:pos])
+
+    @deep_recursion
+    def _locate_error(self, script, pos):
+        """
+        Find the line and column of `script` where a syntax error occurred, given the position in self.text
+        of the last top-level block that was parsed before the failure. This block and the next one are matched again
+        by Parsimonious to find the farthest position where any named rule failed - no other part of the script is parsed.
+        If the failed rule is a margin or INDENT/DEDENT, the error belongs to the next non-empty line, otherwise it is
+        where the rule started. The position is then mapped back to the original `script` with the table of line offsets
+        (locate) and the counts of INDENT/DEDENT characters (indentation).
+        Returns the line stripped of whitespace, its number and the column (both 1-based).
+        """
+        text  = self.text
+        error = ParseError(text)
+        cache = {}
+        node  = self.parser['block'].match_core(text, pos, cache, error)
+        if node: pos = node.end
+        for rule in ('block', 'margin'):
+            self.parser[rule].match_core(text, pos, cache, error)
+        
+        pos = max(pos, error.pos)
+        if error.expr is not None and error.expr.name in self.LAYOUT:
+            skip = ''.join(self.parser.symbols.values()) + '\n'
+            while pos < len(text) and text[pos] in skip: pos += 1
+        
+        lines = script.split('\n')
+        line_num, column = self.locate(pos)
+        column += self.indentation(pos)
+        line_num = min(max(line_num - 1, 1), len(lines))             # -1 for the empty line prepended in preprocess()
+        
+        return lines[line_num-1].strip(), line_num, column
         
     @staticmethod
     def make_context(tags, variables):
@@ -2025,36 +2705,201 @@ class HypertagAST(BaseTree):
         return symbols
 
         
+    @deep_recursion
     def analyse(self, builtins = None):
-        "Link occurences of variables and hypertags with their definition nodes, collect all symbols defined in the document."
-        
+        """
+        Link occurences of variables and hypertags with their definition nodes, collect all symbols defined in the document.
+        Only the names of `builtins` (a dict or a list of symbols) are used here, not their values.
+        """
         ctx = Context()
         self.root.predefine(builtins)
         self.root.analyse(ctx)
+        self.analysed = True
         
+        if (self.runtime.compact or self.runtime.hoist) and isinstance(builtins, dict):
+            self.compactify(builtins)
+        
+    def compactify(self, builtins):
+        """
+        Pre-render pure blocks of the analysed tree: tagged blocks whose output doesn't depend on variables,
+        with all tags being known in advance (built-in or imported), and all attributes being literals.
+        Such blocks are replaced with <merged> nodes that hold the output. Tag values are taken from `builtins`.
+        Pre-rendering and inline expansion of hypertags are done if `Runtime.compact` is set; caching
+        of loop invariants (see NODES.loop_block) if `Runtime.hoist` is set.
+        """
+        state = State(self.root.size)
+        state.globals = builtins
+        for symbol, slot in self.root.slots_in.items():
+            slot.set(state, builtins[symbol])
+        
+        self.root.compactify(state)
+        
+    @deep_recursion
     def translate(self, __builtins__ = None, __tags__ = None, **variables):
+        """
+        Translate the AST to a DOM. Semantic analysis is performed beforehand if it hasn't been done yet.
+        Values of built-in symbols and context variables are passed to the AST through `state`.
+        """
+        return self._translate(__builtins__, __tags__, variables)
         
-        if __builtins__ is None:
-            __builtins__ = self.runtime.import_builtins()
-        self.context = self.make_context(__tags__, variables)
+    def _translate(self, builtins, tags, variables, flat = False):
+        """
+        Like translate(). If flat=True, the DOM is only going to be rendered, so hypertags marked as `inline`
+        may insert their output without wrapper nodes.
+        """
+        if builtins is None:
+            builtins = self.runtime.import_builtins(self.filename, self.module.package)
+        if not self.analysed:
+            self.analyse(builtins)
         
-        self.analyse(__builtins__)
+        context = self.make_context(tags, variables)
+        
+        if self.runtime.backend == 'compiler':
+            document = self.compile()
+            if document:
+                dom, symbols = document(builtins, context)
+                return dom, symbols, State()
+        
+        state = State(self.root.size)
+        state.globals = builtins
+        state.context = context
+        state.flat    = flat
         
-        state = State()
         dom, symbols = self.root.translate(state)           # calls NODES.xdocument.translate(), see there for description of returned objects
         assert isinstance(dom, DOM.Root)
         # print('top-level symbols: {symbols}')
         
         return dom, symbols, state
 
-    def render(self):
-        dom, symbols, state = self.translate()
+    @deep_recursion
+    def compile(self, direct = False, builtins = None, stream = False, asynchronous = False):
+        """
+        Generate Python code for this AST (see Compiler) and return it as a function that performs translation.
+        The tree must be analysed beforehand. The function is generated once and cached in self.compiled.
+        If compilation fails because the tree contains unsupported constructs, None is returned
+        and the interpreter (translate() of nodes) should be used instead.
+        
+        If direct=True, the function renders the document directly to a string, without DOM construction,
+        and is cached in self.compiled_direct. Unless direct rendering was requested explicitly in the runtime (Runtime.direct),
+        the tree is checked statically whether it might need a DOM - values of tags are resolved with the help of `builtins` -
+        and None is returned if so. If stream=True, the function is a generator of output chunks, see render_iter().
+        If asynchronous=True, the function is a coroutine function, see render_async().
+        """
+        attr = 'compiled_stream' if stream else 'compiled_async' if asynchronous else 'compiled_direct' if direct else 'compiled'
+        if getattr(self, attr) is None:
+            from hypertag.core.compiler import Compiler, CompilerError
+            assert self.analysed
+            try:
+                if direct or stream or asynchronous:
+                    compiler = Compiler(self, direct, self.runtime.direct is not True, builtins, stream, asynchronous)
+                else:
+                    compiler = Compiler(self)
+                setattr(self, attr, compiler.compile())
+            except (CompilerError, SyntaxError, RecursionError):
+                setattr(self, attr, False)      # too deeply nested code is rejected by Python's compiler
+                
+        return getattr(self, attr) or None
+
+    @deep_recursion
+    def render(self, __builtins__ = None, __tags__ = None, **variables):
+        """
+        Translate the AST and render the output document to a string. With the "compiler" backend, the document is rendered
+        directly, without DOM construction, if static analysis shows that no DOM is needed or Runtime.direct is True.
+        """
+        if self.runtime.backend == 'compiler' and self.runtime.direct is not False:
+            if __builtins__ is None:
+                __builtins__ = self.runtime.import_builtins(self.filename, self.module.package)
+            if not self.analysed:
+                self.analyse(__builtins__)
+            
+            document = self.compile(direct = True, builtins = __builtins__)
+            if document:
+                text, symbols = document(__builtins__, self.make_context(__tags__, variables))
+                return text
+            
+        dom, symbols, state = self._translate(__builtins__, __tags__, variables, flat = True)
         return dom.render()
-        # output = dom.render()
-        # if not output: return output
-        # assert output[0] == '\n'        # extra empty line was prepended by Grammar.preprocess() and must be removed now
-        # return output[1:]
 
+    def render_iter(self, __builtins__ = None, __tags__ = None, **variables):
+        """
+        Like render(), but returns an iterator of output chunks that concatenate to the document. With the "compiler" backend,
+        if the document can be rendered directly (see render()), chunks are produced incrementally as translation proceeds:
+        markup tags are rendered in two parts, before and after the body, and a chunk is yielded after every iteration
+        of a loop that is not nested inside a hypertag or non-markup tag. Otherwise, the entire document is yielded as one chunk.
+        """
+        if self.runtime.backend == 'compiler' and self.runtime.direct is not False:
+            if __builtins__ is None:
+                __builtins__ = self.runtime.import_builtins(self.filename, self.module.package)
+            if not self.analysed:
+                self.analyse(__builtins__)
+            
+            document = self.compile(builtins = __builtins__, stream = True)
+            if document:
+                return document(__builtins__, self.make_context(__tags__, variables))
+        
+        return iter([self.render(__builtins__, __tags__, **variables)])
+
+    async def render_async(self, __builtins__ = None, __tags__ = None, **variables):
+        """
+        Like render(), but a coroutine that can be awaited inside an event loop. With the "compiler" backend, if the document
+        can be rendered directly (see render()), it is compiled to a coroutine function: context variables and results
+        of function calls are awaited if they are awaitable, `for` loops accept asynchronous iterables, and control is
+        given back to the event loop periodically during long loops. Otherwise, awaitable context variables are resolved
+        (asynchronous iterables are collected into lists) and the document is rendered synchronously.
+        """
+        if __builtins__ is None:
+            __builtins__ = self.runtime.import_builtins(self.filename, self.module.package)
+        
+        if self.runtime.backend == 'compiler' and self.runtime.direct is not False:
+            if not self.analysed:
+                self.analyse(__builtins__)
+            
+            document = self.compile(builtins = __builtins__, asynchronous = True)
+            if document:
+                text, symbols = await document(__builtins__, self.make_context(__tags__, variables))
+                return text
+        
+        from hypertag.core.compiler import resolve_values
+        variables = await resolve_values(variables)
+        return self.render(__builtins__, __tags__, **variables)
+
+    def __getstate__(self):
+        """
+        The runtime environment (module, runtime) and the raw Parsimonious AST are not pickled.
+        The grammar is represented by its special characters.
+        """
+        state = self.__dict__.copy()
+        for attr in ('module', 'runtime', 'filename', 'ast', 'parser', '_ignore_', '_reduce_', '_compact_', 'offsets', 'depths', 'blocks', 'analysed', 'compiled', 'compiled_direct', 'compiled_stream', 'compiled_async'):
+            state.pop(attr, None)
+        state['special_chars'] = [self.parser.symbols[symbol] for symbol in Grammar.SPECIAL_SYMBOLS]
+        return state
+        
+    def __setstate__(self, state):
+        chars = state.pop('special_chars')
+        self.__dict__.update(state)
+        self.parser = Grammar.get(chars)
+        
+    @deep_recursion
+    def dumps(self):
+        """
+        Serialize this AST to bytes. Results of semantic analysis are NOT included, so the tree is always stored
+        in the form it had right after parsing. See loads().
+        """
+        stream = io.BytesIO()
+        ASTPickler(stream, pickle.HIGHEST_PROTOCOL).dump(self)
+        return stream.getvalue()
+        
+    @staticmethod
+    @deep_recursion
+    def loads(data, module):
+        """Deserialize an AST previously serialized with dumps(); attach it to a given `module` (the script's referrer)."""
+        tree = ASTUnpickler(io.BytesIO(data)).load()
+        tree.module   = module
+        tree.runtime  = module.runtime
+        tree.filename = module.filename
+        tree.root._enrich()
+        return tree
+        
     # def __getitem__(self, tag_name):
     #     """Returns a top-level hypertag node wrapped up in Hypertag, for isolated rendering. Analysis must have been performed first."""
     #     # TODO
@@ -0,0 +1,108 @@
+"""
+Persistent on-disk cache of parsed Hypertag scripts, which allows to skip parsing of unchanged scripts
+in subsequent processes, similarly to how Python uses *.pyc files in __pycache__ folders.
+
+@author:  Marcin Wojnarski
+"""
+
+import os, sys, pickle, hashlib, tempfile
+
+import hypertag
+from hypertag.core.ast import Grammar, HypertagAST
+
+
+#####################################################################################################################################################
+#####
+#####  SCRIPT CACHE
+#####
+
+class ScriptCache:
+    """
+    Cache of parsed scripts (rewritten ASTs) stored on disk. Every entry contains a header that identifies
+    the source script (by its hash), the Hypertag version and the special characters of the grammar;
+    an entry whose header doesn't match the current script is treated as stale and gets overwritten,
+    like a *.pyc file of a modified *.py source. Only the state of the AST from before semantic analysis is stored.
+    
+    If `folder` is None, entries are placed in a __pycache__ subfolder next to the script file,
+    and scripts that were not loaded from a file (module.location is None) are not cached.
+    Otherwise, all entries are placed in `folder`: scripts loaded from files are identified by their full path,
+    while the remaining ones - by their contents.
+    """
+    
+    CACHE_DIR = '__pycache__'       # name of the subfolder for cache entries when no explicit `folder` is given
+    EXTENSION = '.pickle'
+    
+    folder = None
+    
+    def __init__(self, folder = None):
+        self.folder = folder
+        
+    def load(self, script, module):
+        """Load an AST of `script` from cache and return as a HypertagAST attached to `module`; or None if unavailable."""
+        
+        path = self._path(script, module.location)
+        if path is None: return None
+        try:
+            with open(path, 'rb') as file:
+                header = pickle.load(file)
+                if header != self._header(script): return None
+                return HypertagAST.loads(file.read(), module)
+        
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+            return None
+        
+    def store(self, script, module, ast):
+        """
+        Save an AST of `script` in cache. Failures (e.g., a read-only file system, or an AST that can't be pickled)
+        are ignored silently, like in Python: the entry is just missing then, and no temporary file is left behind.
+        """
+        path = self._path(script, module.location)
+        if path is None: return
+        temp = None
+        try:
+            data   = ast.dumps()
+            folder = os.path.dirname(path)
+            os.makedirs(folder, exist_ok = True)
+            
+            # write to a temporary file and move to the target location, so that concurrent readers never see a partial entry
+            fd, temp = tempfile.mkstemp(dir = folder, suffix = '.tmp')
+            with os.fdopen(fd, 'wb') as file:
+                pickle.dump(self._header(script), file, pickle.HIGHEST_PROTOCOL)
+                file.write(data)
+            os.replace(temp, path)
+            temp = None
+            
+        except Exception:
+            pass                            # caching is only an optimization, it must never make compilation fail
+        finally:
+            if temp is not None:
+                try:
+                    os.remove(temp)
+                except OSError:
+                    pass
+        
+    def _header(self, script):
+        return {'version':  hypertag.__version__,
+                'chars':    Grammar.special_chars(script),
+                'source':   self._hash(script)}
+    
+    def _path(self, script, filename):
+        """Path to the cache entry of a given script loaded from `filename` (can be None); None if the script can't be cached."""
+        
+        tag = '.hypertag-%s.%s' % (hypertag.__version__, sys.implementation.cache_tag) + self.EXTENSION
+        
+        if self.folder is None:
+            if not filename: return None
+            folder, name = os.path.split(os.path.abspath(filename))
+            return os.path.join(folder, self.CACHE_DIR, name + tag)
+        
+        if filename:
+            name = os.path.basename(filename) + '-' + self._hash(os.path.abspath(filename))[:16]
+        else:
+            name = self._hash(script)
+        return os.path.join(self.folder, name + tag)
+        
+    @staticmethod
+    def _hash(text):
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+    
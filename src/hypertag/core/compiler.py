@@ -0,0 +1,1342 @@
+"""
+Code generation backend. An analysed HypertagAST is converted to the source code of a Python function,
+which is then compiled and executed in place of recursive translate() / evaluate() calls on NODES.* objects.
+Hypertag definitions become nested functions, slots become local variables, and expressions
+become native Python expressions. The function produces the same DOM as the interpreter does.
+
+In the "direct" mode, the generated function renders the document straight to a string, without constructing a DOM.
+Output fragments are then kept as lists of items, [text, indent, outline], which correspond to DOM nodes:
+`text` is a rendered body of the node, `indent` is its indentation relative to the parent node (known during compilation),
+and `outline` is the node's outline flag.
+
+In the asynchronous mode (direct rendering only), the document and hypertags become coroutine functions:
+results of function calls and context variables are awaited if awaitable, and `for` loops iterate over
+asynchronous iterables, too. See HypertagAST.render_async().
+
+@author:  Marcin Wojnarski
+"""
+
+import re, keyword, asyncio
+from itertools import chain
+from inspect import isawaitable
+
+from hypertag.core.errors import ValueErrorEx, TypeErrorEx, FalseValueEx, NameErrorEx, UnboundLocalEx, \
+    NotATagEx, VoidTagEx, ImportErrorEx
+from hypertag.core.structs import State, ValueSlot, MISSING
+from hypertag.core.dom import DOM, add_indent
+from hypertag.core.tag import Tag, null
+from hypertag.core.ast import NODES, Hypertag, ImportedHypertag, EmbeddedHypertag, STR, partial, format_text
+
+
+#####################################################################################################################################################
+#####
+#####  RUNTIME SUPPORT
+#####
+
+class Token:
+    def __init__(self, name): self.name = name
+    def __repr__(self):       return self.name
+
+UNDEFINED = Token('UNDEFINED')      # initial value of a local variable that hasn't been assigned yet
+
+
+class CompiledHypertag(Hypertag):
+    """Hypertag defined by an <xblock_def> node of a compiled AST. Expansion calls the generated Python function."""
+
+    def __init__(self, function, node, direct = False, asynchronous = False):
+        self.function = function            # generated function: (body, attrs, kwattrs, indentation, caller) -> DOM
+        self.node = node                    # the original <xblock_def> node
+        self.name = node.name
+        self.direct = direct                # if True, `function` takes a Body and returns a rendered text instead of a DOM
+        self.asynchronous = asynchronous    # if True, `function` is a coroutine function, which can only be called by compiled code
+
+    def expand(self, body, attrs, kwattrs, state, caller):
+        if self.asynchronous:
+            raise TypeErrorEx("hypertag '%s' of an asynchronous document can't be expanded synchronously" % self.name, caller)
+        if not self.direct:
+            return self.function(body, attrs, kwattrs, state.indentation, caller)
+
+        # direct-to-string hypertag is called from the outside: DOM must be converted to a Body and back again
+        text = self.function(as_body(body), attrs, kwattrs, state.indentation, caller)
+        return make_node(make_dom([make_text(text)]), state.indentation, tag = self.node.native, kwattrs = dom_attrs(self.node, attrs, kwattrs))
+
+
+class Body(list):
+    """
+    Output fragment in direct-to-string rendering: a list of [text, indent, outline] items.
+    Passed in place of a DOM to tags that only need body.render() and to hypertags whose body is only embedded with @.
+    """
+    def render(self):
+        return render_items(self)
+
+def render_items(items):
+    """Like DOM.render(), but for a list of [text, indent, outline] items."""
+    output = []
+    for text, indent, outline in items:
+        if outline: text = '\n' + text
+        output.append(add_indent(text, indent) if indent else text)
+    return ''.join(output)
+
+def as_body(dom):
+    """Convert a DOM, or a DOM.Node, that was passed as a body to a direct-to-string hypertag from the outside, to a Body."""
+    if isinstance(dom, Body): return dom
+    if isinstance(dom, DOM.Node): dom = [dom]
+    return Body([n._render_body(), None, n.outline] for n in dom)
+
+def as_dom(body):
+    """Convert a Body to a DOM of DOM.Text nodes, for a tag or hypertag that needs a DOM."""
+    nodes = []
+    for text, indent, outline in body:
+        node = make_text(text, indent)
+        node.outline = outline
+        nodes.append(node)
+    return make_dom(nodes)
+
+
+def make_dom(nodes):
+    """Wrap up a flat list of DOM.Node's in a DOM, without copying and flattening."""
+    dom = DOM.__new__(DOM)
+    dom.nodes = nodes
+    return dom
+
+def make_text(text, indent = None):
+    """Like DOM.Text(text, indent = indent), but faster."""
+    node = DOM.Text.__new__(DOM.Text)
+    node.text = text
+    node.body = make_dom([])
+    node.indent = indent
+    return node
+
+def make_node(body, indent = None, tag = None, attrs = None, kwattrs = None):
+    """Like DOM.node(body, indent, ...), but faster: `body` must be a DOM (not a list of lists) and is not flattened again."""
+    node = DOM.Node.__new__(DOM.Node)
+    node.tag = tag
+    node.attrs = attrs
+    node.kwattrs = kwattrs
+    node.body = make_dom(list(body.nodes))
+    node.set_indent(indent)
+    return make_dom([node])
+
+def set_indent(nodes, indent):
+    for n in nodes: n.set_indent(indent)
+
+def unbound(msg, node):
+    raise UnboundLocalEx(msg, node)
+
+def global_get(builtins, symbol, node):
+    if symbol not in builtins: raise NameErrorEx("global symbol '%s' is missing in translation" % symbol, node)
+    return builtins[symbol]
+
+def context_get(context, symbol, node):
+    if symbol not in context:
+        raise ImportErrorEx("symbol '%s' not found in context, it must be passed to translate() or render() as a keyword argument" % symbol, node)
+    return context[symbol]
+
+def optional(fun):
+    """Evaluation of an expression with "?" qualifier, which is passed as a 0-argument function."""
+    try:
+        val = fun()
+    except Exception:
+        return ''
+    return val if val else ''
+
+def obligatory(val, node):
+    """Evaluation of an expression with "!" qualifier."""
+    if val: return val
+    raise FalseValueEx("Obligatory expression evaluates to a false value (%s)" % repr(val), node)
+
+def negate(val):
+    return -val if val is not None else val
+
+def pipe(__x, __fun, *args, **kwargs):
+    """Application of a filter in a pipeline, x:fun(a,b) is executed as fun(x,a,b)."""
+    return __fun(__x, *args, **kwargs)
+
+def join_attrs(items):
+    """Like NODES.xtag_expand._eval_attrs(): values of repeated attributes are space-concatenated."""
+    named = {}
+    for name, value in items:
+        if name in named:
+            named[name] += ' ' + value
+        else:
+            named[name] = value
+    return named
+
+def unpack(value, N, node):
+    """Like NODES.xtargets.assign(), but the unpacked items are returned as a list instead of being assigned to slots."""
+    items = []
+    for i, v in enumerate(value):               # raises TypeError if `value` is not iterable
+        if i >= N: raise ValueErrorEx("too many values to unpack (expected %s)" % N, node)
+        items.append(v)
+    if len(items) < N:
+        raise ValueErrorEx("not enough values to unpack (expected %s, got %s)" % (N, len(items)), node)
+    return items
+
+def expand_tag(body, attrs, kwattrs, tag, indent, caller):
+    """Like NODES.xtag_expand.translate_tag(), with a fast path for compiled hypertags."""
+    if isinstance(tag, CompiledHypertag):
+        return tag.function(body, attrs, kwattrs, indent, caller)
+
+    elif isinstance(tag, Hypertag):
+        state = State()
+        state.indentation = indent
+        return tag.expand(body, attrs, kwattrs, state, caller)
+
+    elif isinstance(tag, Tag):
+        return make_node(body, tag = tag, attrs = attrs, kwattrs = kwattrs)
+
+    else:
+        raise NotATagEx("Not a tag: '%s' (%s)" % (caller.name, tag.__class__), caller)
+
+class Stream:
+    """
+    Writer of output in streamed rendering. Items and parts of split tags are written as they are produced,
+    with indentation added on the fly, and collected chunks are taken out with flush() to be yielded to the client.
+    The output is exactly the same as rendering of the DOM would produce: a newline gets indented only if followed by
+    a character, so a trailing newline is kept back until the next write() (see `pending`). Mimics the list interface
+    of append() and extend() for writing items, so it can be used in place of an output list in the generated code.
+    """
+    def __init__(self):
+        self.chunks  = []           # output strings not flushed yet
+        self.indents = ['']         # absolute indentations of the current node and its ancestors, innermost last
+        self.tails   = []           # [tail, first] pairs of open split tags: the closing string and the 1st character of the body
+        self.waiting = []           # pairs from `tails` whose 1st character of the body is not known yet
+        self.pending = None         # if a trailing newline was kept back: depth of the lowest node visited since then
+        self.outline = False        # if True, the next item or tag written is the 1st node of an outline block
+        self.start   = True         # True until the 1st character is output; a leading newline of the document is dropped, like in DOM.Root
+
+    def append(self, item):
+        text, indent, outline = item
+        if self.outline: outline, self.outline = True, False
+        self._push(indent)
+        self.write('\n' + text if outline else text)
+        self._pop()
+
+    def extend(self, items):
+        for item in items: self.append(item)
+
+    def open(self, tag, attrs, kwattrs, indent, outline, caller):
+        """Begin a node of a split tag: write the head. The body is to be written next, then close() called."""
+        parts = tag.split(attrs, kwattrs)
+        if parts is None: raise TypeErrorEx("tag '%s' can't be split for streamed rendering" % caller.name, caller)
+        head, tail = parts
+        if self.outline: outline, self.outline = True, False
+        self._push(indent)
+        self.write('\n' + head if outline else head)
+        pair = [tail, None]
+        self.tails.append(pair)
+        self.waiting.append(pair)
+
+    def close(self):
+        pair = self.tails.pop()
+        if self.waiting and self.waiting[-1] is pair: self.waiting.pop()
+        tail, first = pair
+        self.write('\n' + tail if first == '\n' else tail)
+        self._pop()
+
+    def write(self, text):
+        if not text: return
+        if self.waiting:
+            for pair in self.waiting: pair[1] = text[0]
+            self.waiting = []
+
+        held = ''
+        if self.pending is not None:
+            held = '\n' + self.indents[self.pending] if text[0] != '\n' else '\n'
+            self.pending = None
+        if text[-1] == '\n':
+            text = text[:-1]
+            self.pending = len(self.indents) - 1
+
+        text = held + add_indent(text, self.indents[-1])
+        if self.start and text:
+            self.start = False
+            if text[0] == '\n': text = text[1:]
+        self.chunks.append(text)
+
+    def flush(self):
+        text = ''.join(self.chunks)
+        self.chunks = []
+        return text
+
+    def finish(self):
+        """Flush the remaining output at the end of the document, including a newline that was kept back."""
+        if self.pending is not None:
+            self.pending = None
+            if self.start:
+                self.start = False
+            else:
+                self.chunks.append('\n')
+        return self.flush()
+
+    def _push(self, indent):
+        self.indents.append(self.indents[-1] + indent if indent else self.indents[-1])
+
+    def _pop(self):
+        self.indents.pop()
+        if self.pending is not None and self.pending >= len(self.indents):
+            self.pending = len(self.indents) - 1
+
+
+def expand_text(body, attrs, kwattrs, tag, indent, caller):
+    """
+    Like expand_tag(), but in direct-to-string rendering: `body` is a Body, and the rendered text of the resulting node is returned,
+    without the node's outline and indentation, which are added by the caller.
+    """
+    if isinstance(tag, CompiledHypertag) and tag.direct:
+        return tag.function(body, attrs, kwattrs, indent, caller)
+
+    elif isinstance(tag, Hypertag):
+        state = State()
+        state.indentation = indent
+        dom = tag.expand(as_dom(body), attrs, kwattrs, state, caller)
+        dom.set_indent(indent)
+        return ''.join(n.outline * '\n' + n._render_body() for n in dom)
+
+    elif isinstance(tag, Tag):
+        return tag.expand(as_dom(body) if tag.dom else body, attrs, kwattrs)
+
+    else:
+        raise NotATagEx("Not a tag: '%s' (%s)" % (caller.name, tag.__class__), caller)
+
+async def expand_async(body, attrs, kwattrs, tag, indent, caller):
+    """Like expand_text(), but in asynchronous rendering: hypertags of the document are coroutine functions."""
+    if isinstance(tag, CompiledHypertag) and tag.asynchronous:
+        return await tag.function(body, attrs, kwattrs, indent, caller)
+    return expand_text(body, attrs, kwattrs, tag, indent, caller)
+
+async def resolve(value):
+    """In asynchronous rendering, the result of a function call or a context variable is awaited if awaitable."""
+    if isawaitable(value): return await value
+    return value
+
+async def resolve_values(values):
+    """
+    Await all awaitable values of a dict, and collect asynchronous iterables into lists, so that the variables
+    can be rendered synchronously. Used when asynchronous compilation is not possible.
+    """
+    resolved = {}
+    for name, value in values.items():
+        if isawaitable(value):
+            value = await value
+        if hasattr(value, '__aiter__'):
+            items = []
+            async for item in value: items.append(item)
+            value = items
+        resolved[name] = value
+    return resolved
+
+class AsyncIter:
+    """
+    Iterator of a `for` block in asynchronous rendering: items of an asynchronous or a regular iterable.
+    Control is given back to the event loop every PERIOD items of a regular iterable.
+    """
+    PERIOD = 100
+
+    def __init__(self, iterable):
+        if hasattr(iterable, '__aiter__'):
+            self.source = iterable.__aiter__()
+            self.sync   = False
+        else:
+            self.source = iter(iterable)
+            self.sync   = True
+        self.count = 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.sync:
+            return await self.source.__anext__()
+        self.count += 1
+        if self.count % self.PERIOD == 0:
+            await asyncio.sleep(0)
+        try:
+            return next(self.source)
+        except StopIteration:
+            raise StopAsyncIteration
+
+def embed_items(node, value, indent, relative):
+    """
+    Like NODES.xblock_embed.translate(), but in direct-to-string rendering: a list of items is returned.
+    `indent` is the absolute indentation of the block, `relative` is its indentation relative to the parent node.
+    """
+    if isinstance(value, Body):
+        return [[text, relative, outline] for text, _, outline in value]
+
+    dom = node._as_sequence(value)
+    dom.set_indent(indent)
+    return [[n._render_body(), relative, n.outline] for n in dom]
+
+def embed_tag(tag, indent, caller):
+    """Like NODES.xtag_use.evaluate(): a hypertag used inside an expression is wrapped up in EmbeddedHypertag."""
+    if isinstance(tag, Hypertag):
+        state = State()
+        state.indentation = indent
+        return EmbeddedHypertag(tag, state, caller)
+    return tag
+
+def bind_attrs(hypertag, body, attrs, kwattrs, caller):
+    """
+    Like NODES.xblock_def.expand_bound(), but returns values of regular attributes as a list, in the order of
+    hypertag.attr_regul, instead of assigning them to slots. Defaults that are not constants are left as MISSING.
+    """
+    binding = hypertag.binding(len(attrs), tuple(kwattrs), caller)
+    if body and binding.body is None:
+        raise VoidTagEx("non-empty body passed to a void hypertag '%s'" % hypertag.name, caller)
+
+    values = hypertag.defaults[:]
+    for pos, value in zip(binding.positions, chain(attrs, kwattrs.values())):
+        values[pos] = value
+    return values
+
+def dom_attrs(hypertag, attrs, kwattrs):
+    """Attributes of the DOM node of a hypertag's expansion, as a dict: positional ones named after the hypertag's attributes."""
+    names = [attr.name for attr in hypertag.attr_regul[:len(attrs)]]
+    return dict(zip(names, attrs), **kwattrs)
+
+
+# symbols available to the generated code, in addition to constants
+RUNTIME = dict(UNDEFINED = UNDEFINED, MISSING = MISSING, CompiledHypertag = CompiledHypertag, DOM = DOM, Text = make_text, make_node = make_node,
+               null = null, STR = STR, partial = partial, format_text = format_text, make_dom = make_dom, set_indent = set_indent, unbound = unbound,
+               global_get = global_get, context_get = context_get, optional = optional, obligatory = obligatory,
+               negate = negate, pipe = pipe, join_attrs = join_attrs, unpack = unpack, expand_tag = expand_tag,
+               embed_tag = embed_tag, bind_attrs = bind_attrs, dom_attrs = dom_attrs, Body = Body, render_items = render_items, as_dom = as_dom,
+               expand_text = expand_text, embed_items = embed_items, Stream = Stream, expand_async = expand_async, resolve = resolve, AsyncIter = AsyncIter)
+
+
+#####################################################################################################################################################
+#####
+#####  COMPILER
+#####
+
+class CompilerError(Exception):
+    """The AST contains a construct that is not supported by Compiler. The interpreter should be used instead."""
+
+
+class Code(str):
+    """A piece of generated Python code that evaluates to a string, as opposed to a static string known during compilation."""
+
+
+class Function:
+    """Python function being generated: for the document, or for a hypertag definition."""
+
+    def __init__(self, name, params, base):
+        self.name   = name
+        self.params = params
+        self.base   = base          # base indentation string known during compilation, or None if passed in `ind` argument
+        self.lines  = []            # lines of the body
+        self.level  = 1             # current indentation level of code in `lines`
+        self.owned  = []            # slots whose variables are local to this function
+        self.control = 0            # current depth of nested control blocks
+
+
+class Compiler:
+    """
+    Generator of Python code from an analysed HypertagAST. Every x* node class is handled by a method
+    of this class, which is found by the node's class name (or names of base classes) prefixed with:
+    t_ for translate(), e_ for evaluate(), r_ for render() of nodes inside text blocks.
+    """
+
+    # Python equivalents of Hypertag binary operators
+    OPERATORS = {'': '+', '<>': '!='}
+
+    # blocks that never produce any output
+    SILENT = {'block_comment', 'block_def', 'block_import', 'block_context', 'block_expr', 'block_assign'}
+
+    tree      = None        # HypertagAST to be compiled
+    namespace = None        # global namespace of the generated code: runtime support symbols + constants
+    constants = None        # {id(value): name} of all constants put in `namespace`
+    names     = None        # {slot: name} of local variables assigned to slots
+    owners    = None        # {slot: Function} that owns the local variable of a slot
+    sure      = None        # set of slots that are always assigned before they are read, no checks are needed
+    used      = None        # set of slots that are read somewhere in the code
+    fun       = None        # Function being generated
+    suffix    = None        # current indentation, relative to fun.base
+    source    = None        # generated source code
+
+    direct    = False       # if True, the document is rendered to a string instead of a DOM
+    checks    = True        # if True, constructs that might need a DOM are rejected with CompilerError (automatic mode)
+    builtins  = None        # values of built-in symbols, for static resolution of tags
+    hypertags = None        # set of slots of hypertags defined in the tree
+    bodies    = None        # set of slots of body attributes of hypertags
+    region    = None        # indentation suffix of the nearest parent node, to which indentations of items are relative
+    override  = None        # relative indentation imposed on all items of the current region by a control block or "<" modifier
+    outline   = False       # True if the next item appended is the 1st node of an outline block
+    stream    = False       # if True, the document function is a generator of output chunks (implies direct mode)
+    writer    = None        # in streamed rendering, name of the variable that holds the Stream
+    asynchronous = False    # if True, generated functions are coroutines that await results of calls (implies direct mode)
+    awaits    = 0           # no. of awaits generated so far
+
+    def __init__(self, tree, direct = False, checks = True, builtins = None, stream = False, asynchronous = False):
+        self.tree      = tree
+        self.namespace = dict(RUNTIME)
+        self.constants = {}
+        self.names     = {}
+        self.owners    = {}
+        self.sure      = set()
+        self.used      = set()
+        self.counter   = 0
+        self._handlers = {}
+        self.direct    = direct or stream or asynchronous
+        self.stream    = stream
+        self.asynchronous = asynchronous
+        if stream and asynchronous: raise CompilerError("asynchronous streaming is not supported")
+        self.checks    = checks
+        self.builtins  = builtins or {}
+        self.hypertags = set()
+        self.bodies    = set()
+
+    def compile(self):
+        """
+        Generate Python code for the tree and return the document function: (builtins, context) -> (DOM.Root, symbols).
+        In the direct mode, the function returns (text, symbols) instead.
+        In the streaming mode, the function is a generator of output strings that concatenate to the document.
+        In the asynchronous mode, the function is a coroutine function that returns (text, symbols).
+        """
+        doc = self.tree.root
+        self.fun = Function('document', 'builtins, context', '\n')
+        self.suffix = ''
+        self.region = ''
+
+        # built-in symbols are assigned to variables only when they are actually read
+        for slot in doc.slots_in.values():
+            self.define(slot)
+
+        if self.stream:
+            out = self.writer = '_w'
+            self.emit('%s = Stream()' % out)
+        else:
+            out = self.temp()
+            self.emit('%s = []' % out)
+        for c in doc.children: self.translate(c, out)
+
+        root = self.temp()
+        if self.stream:
+            self.emit('yield %s.finish()' % out)
+        elif self.direct:
+            self.emit('%s = render_items(%s)' % (root, out))
+            self.emit("if %s[:1] == '\\n': %s = %s[1:]" % (root, root, root))
+        else:
+            self.emit('%s = DOM.Root(body = %s, indent = %s)' % (root, out, repr('\n')))
+            self.emit("%s.indent = ''" % root)
+
+        # pull actual values of top-level output symbols
+        symbols = self.temp()
+        self.emit('%s = {}' % symbols)
+        for symbol, slot in doc.slots_out.items():
+            if slot not in self.owners: raise CompilerError("output symbol '%s' is never assigned" % symbol)
+            var = self.var(slot)
+            if slot in self.sure:
+                self.emit('%s[%r] = %s' % (symbols, symbol, var))
+            else:
+                self.emit('if %s is not UNDEFINED: %s[%r] = %s' % (var, symbols, symbol, var))
+        self.emit('return %s' % symbols if self.stream else 'return %s, %s' % (root, symbols))
+
+        prolog = ['%s = global_get(builtins, %r, %s)' % (self.var(slot), symbol, self.const(doc))
+                  for symbol, slot in doc.slots_in.items() if slot in self.used]
+        lines  = self._function(self.fun, prolog)
+
+        self.source = '\n'.join(lines) + '\n'
+        code = compile(self.source, '<hypertag %s>' % (self.tree.filename or 'script'), 'exec')
+        exec(code, self.namespace)
+        return self.namespace['document']
+
+    def _function(self, fun, prolog = ()):
+        """Complete lines of a generated function: header, initialization of local variables, and the body."""
+
+        header = ['%sdef %s(%s):' % ('async ' if self.asynchronous else '', fun.name, fun.params)]
+        init   = ['%s = UNDEFINED' % self.var(slot) for slot in fun.owned if slot not in self.sure]
+        return header + ['    ' + line for line in list(prolog) + init] + fun.lines
+
+
+    ###  UTILITIES  ###
+
+    def emit(self, line):
+        self.fun.lines.append('    ' * self.fun.level + line)
+
+    def temp(self, prefix = '_r'):
+        """Unique name of a new temporary variable."""
+        self.counter += 1
+        return '%s%d' % (prefix, self.counter)
+
+    def const(self, value):
+        """Name of a global variable in the generated code that holds a given constant `value`."""
+        key = id(value)
+        name = self.constants.get(key)
+        if name is None:
+            name = self.constants[key] = 'K%d' % len(self.constants)
+            self.namespace[name] = value
+        return name
+
+    def literal(self, value):
+        """Python code of a constant `value`; a literal if possible."""
+        if value is None or isinstance(value, (bool, int, str)): return repr(value)
+        return self.const(value)
+
+    def awaited(self, code):
+        """In the asynchronous mode, code that awaits the value of `code` if it's awaitable; `code` itself otherwise."""
+        if not self.asynchronous: return code
+        self.awaits += 1
+        return '(await resolve(%s))' % code
+
+    def indentation(self):
+        """Python code of the current indentation string: State.indentation of the interpreter."""
+        if self.fun.base is not None: return repr(self.fun.base + self.suffix)
+        if not self.suffix: return 'ind'
+        return '(ind + %r)' % self.suffix
+
+    def var(self, slot):
+        """Name of a local variable assigned to a given slot."""
+        name = self.names.get(slot)
+        if name is None:
+            self.counter += 1
+            name = self.names[slot] = 'v%d_%s' % (self.counter, re.sub(r'\W', '_', slot.name))
+        return name
+
+    def define(self, slot):
+        """Mark that `slot` is assigned in the current function; its variable is local to this function."""
+        if slot in self.owners: return
+        self.owners[slot] = self.fun
+        self.fun.owned.append(slot)
+        if self.fun.control == 0:
+            self.sure.add(slot)
+
+    def read(self, slot, msg, node):
+        """Code that reads a variable of `slot`; UnboundLocalEx is raised if the variable is unassigned."""
+        if slot not in self.owners: raise CompilerError("symbol '%s' is read before definition" % slot.symbol)
+        self.used.add(slot)
+        var = self.var(slot)
+        if slot in self.sure: return var
+        return '(%s if %s is not UNDEFINED else unbound(%r, %s))' % (var, var, msg, self.const(node))
+
+    def _handler(self, prefix, node):
+        cls = node.__class__
+        handler = self._handlers.get((prefix, cls))
+        if handler is None:
+            for base in cls.__mro__:
+                handler = getattr(self, prefix + base.__name__, None)
+                if handler: break
+            else:
+                raise CompilerError("compilation of <%s> nodes is not supported" % cls.__name__)
+            self._handlers[(prefix, cls)] = handler
+        return handler
+
+    def translate(self, node, out):
+        """Emit code that appends DOM nodes produced by translate() of `node` to a list named `out`."""
+        self._handler('t_', node)(node, out)
+
+    def expr(self, node):
+        """Python expression that computes evaluate() of `node`."""
+        return self._handler('e_', node)(node)
+
+    def render(self, node):
+        """List of static strings and Code pieces that comprise render() of `node` inside a text block."""
+        return self._handler('r_', node)(node)
+
+    @staticmethod
+    def concat(parts):
+        """Python expression that concatenates `parts`, or a plain string if all parts are static."""
+        if not any(isinstance(p, Code) for p in parts): return ''.join(parts)
+        codes = [p if isinstance(p, Code) else repr(p) for p in parts if p]
+        return Code(codes[0] if len(codes) == 1 else '(%s)' % ' + '.join(codes))
+
+    @staticmethod
+    def atom(code):
+        return code if code.isidentifier() else '(%s)' % code
+
+    def qualify(self, code, qualifier, node, awaits = None):
+        if qualifier == '?':
+            if awaits is not None and self.awaits > awaits:
+                raise CompilerError("'?' qualifier can't be applied to an expression that awaits values")
+            return 'optional(lambda: %s)' % code
+        if qualifier == '!': return 'obligatory(%s, %s)' % (code, self.const(node))
+        return code
+
+    def arguments(self, nodes):
+        """Code of a list of call arguments: expressions and <xkwarg> nodes."""
+        args   = [self.expr(c) for c in nodes if c.type != 'kwarg']
+        kwargs = [(c.name, self.expr(c.expr)) for c in nodes if c.type == 'kwarg']
+        names  = [name for name, _ in kwargs]
+
+        ordered = all(c.type == 'kwarg' for c in nodes[len(args):])
+        simple  = len(set(names)) == len(names) and not any(keyword.iskeyword(name) for name in names)
+
+        if ordered and simple:
+            return ', '.join(args + ['%s = %s' % item for item in kwargs])
+
+        kwargs = '{%s}' % ', '.join('%r: %s' % item for item in kwargs)
+        return '*[%s], **%s' % (', '.join(args), kwargs)
+
+    def assign(self, target, value):
+        """Emit assignment of `value` code to a <xtargets> or <xvar_def> node."""
+        if target.type == 'var_def':
+            self.define(target.slot_write)
+            self.emit('%s = %s' % (self.var(target.slot_write), value))
+        elif len(target.children) == 1:
+            self.assign(target.children[0], value)
+        else:
+            items = self.temp('_u')
+            self.emit('%s = unpack(%s, %d, %s)' % (items, value, len(target.children), self.const(target)))
+            for i, child in enumerate(target.children):
+                self.assign(child, '%s[%d]' % (items, i))
+
+    def relative(self, indent = True):
+        """
+        In the direct mode, code of the relative indentation of an item appended in the current region.
+        If indent=False, the item is inline (indentation None in the DOM node).
+        """
+        if self.override is not None: return repr(self.override)
+        if not indent: return 'None'
+        assert self.suffix.startswith(self.region)
+        return repr(self.suffix[len(self.region):])
+
+    def impose(self, override):
+        """
+        Like DOM.set_indent() applied to all nodes of a fragment, but in the direct mode, during compilation:
+        the outermost block that sets indentation wins. Returns the previous value to be restored later.
+        """
+        previous = self.override
+        if previous is None: self.override = override
+        return previous
+
+    def take_outline(self):
+        outline, self.outline = self.outline, False
+        return outline
+
+    @staticmethod
+    def plain_variable(expr):
+        """If `expr` is an expression root that consists of a variable alone, without qualifiers, return the variable node."""
+        if isinstance(expr, NODES.expression_root) and not expr.qualifier and len(expr.children) == 1:
+            if isinstance(expr.children[0], NODES.variable): return expr.children[0]
+        return None
+
+    @classmethod
+    def embedded_only(cls, hypertag):
+        """
+        True if the body attribute of `hypertag` (an <xblock_def> node) is only embedded with @ as a plain variable,
+        so it can be passed as a Body in the direct mode; otherwise, the body is used as a DOM and must be converted.
+        """
+        slot  = hypertag.attr_body.slot
+        stack = list(hypertag.body.children) if hypertag.body else []
+        while stack:
+            node = stack.pop()
+            if isinstance(node, NODES.xblock_embed):
+                var = cls.plain_variable(node.expr)
+                if var is not None and var.slot_read is slot: continue
+            if isinstance(node, NODES.variable) and node.slot_read is slot: return False
+            stack.extend(node.children or ())
+        return True
+
+    def static_value(self, tag):
+        """Value of an imported or built-in tag, `tag` being an <xtag_expand> node; MISSING if the value is not known during compilation."""
+        slot = tag.tag
+        if isinstance(slot, ValueSlot):
+            return slot.value
+        if self.tree.root.slots_in.get(slot.symbol) is slot and slot.symbol in self.builtins:
+            return self.builtins[slot.symbol]
+        return MISSING
+
+    def splittable(self, node):
+        """True if the tag of an <xblock_struct> node is known during compilation to be a single split tag (Tag.split()), for streaming."""
+        tags = node.tags.children
+        if len(tags) != 1 or tags[0].type == 'null': return False
+
+        value = self.static_value(tags[0])
+        if not isinstance(value, Tag) or getattr(value, 'void', False): return False
+
+        # split() must be overridden at least as deep in the class hierarchy as expand()
+        def owner(name): return next(cls for cls in type(value).__mro__ if name in cls.__dict__)
+        return owner('split') is not Tag and issubclass(owner('split'), owner('expand'))
+
+    def check_tag(self, tag):
+        """
+        Static analysis for the automatic direct mode: CompilerError is raised unless the value of `tag` (an <xtag_expand> node)
+        is known during compilation and its expansion doesn't need a DOM.
+        """
+        if tag.tag in self.hypertags: return
+
+        value = self.static_value(tag)
+        if value is MISSING:
+            raise CompilerError("tag '%s' can't be resolved statically, direct rendering is not possible" % tag.name)
+
+        if isinstance(value, Tag) and not value.dom: return
+        if isinstance(value, ImportedHypertag):
+            hypertag = value.hypertag
+            if isinstance(hypertag, CompiledHypertag): hypertag = hypertag.node
+            if isinstance(hypertag, NODES.xblock_def) and self.embeds_body(hypertag): return
+
+        raise CompilerError("expansion of tag '%s' may need a DOM, direct rendering is not possible" % tag.name)
+
+    @classmethod
+    def embeds_body(cls, hypertag):
+        """True if the body attribute of a given <xblock_def> is absent or only used by @-blocks that embed it as a whole."""
+        if not hypertag.attr_body: return True
+        slot = hypertag.attr_body.slot
+
+        def reads(node):
+            if isinstance(node, NODES.xblock_embed) and cls.plain_variable(node.expr) is not None:
+                return 0
+            if isinstance(node, NODES.variable) and node.slot_read is slot:
+                return 1
+            return sum(reads(c) for c in node.children or ())
+
+        return reads(hypertag.body) == 0
+
+    def block(self, node, out):
+        """Like translate(), but with a control branch: `pass` is emitted if no code was generated."""
+        size = len(self.fun.lines)
+        self.fun.level += 1
+        self.fun.control += 1
+        if node is not None:
+            self.translate(node, out)
+        if len(self.fun.lines) == size:
+            self.emit('pass')
+        self.fun.control -= 1
+        self.fun.level -= 1
+
+
+    ###  BLOCKS (translate)  ###
+
+    def t_static(self, node, out):
+        if not node.value: return
+        if self.direct:
+            self.emit('%s.append([%r, %s, %s])' % (out, node.value, self.relative(False), self.take_outline()))
+        else:
+            self.emit('%s.append(Text(%r))' % (out, node.value))
+
+    def t_indent(self, node, out):
+        self.suffix += node.whitechar
+
+    def t_dedent(self, node, out):
+        assert self.suffix[-1:] == node.whitechar
+        self.suffix = self.suffix[:-1]
+
+    def t_xpass(self, node, out):
+        pass
+
+    def t_body(self, node, out):
+        suffix = self.suffix
+        for c in node.children: self.translate(c, out)
+        self.suffix = suffix
+
+    def t_xblock(self, node, out):
+        margin, block = node.children
+        self.translate(margin, out)
+
+        if block.type in self.SILENT:
+            self.translate(block, out)
+            return
+
+        if self.direct:
+            previous = self.impose('') if node.modifier == '<' else self.override
+            if isinstance(block, (NODES.block_text, NODES.xblock_struct, NODES.merged)):
+                self.outline = (node.modifier != '...')
+                self.translate(block, out)
+                self.outline = False
+            elif node.modifier == '...':
+                self.translate(block, out)
+            elif out == self.writer:
+                self.emit('%s.outline = True' % out)            # the 1st item written will be marked as outline
+                self.translate(block, out)
+                self.emit('%s.outline = False' % out)
+            else:
+                start = self.temp('_k')
+                self.emit('%s = len(%s)' % (start, out))
+                self.translate(block, out)
+                self.emit('if len(%s) > %s: %s[%s][2] = True' % (out, start, out, start))
+            self.override = previous
+            return
+
+        if isinstance(block, NODES.block_text):
+            text = self.text_block(block)
+            if node.modifier == '...':
+                self.emit('%s.append(%s)' % (out, text))
+            else:
+                item = self.temp('_n')
+                self.emit('%s = %s' % (item, text))
+                self.emit('%s.set_outline()' % item)
+                if node.modifier == '<': self.emit("%s.set_indent('')" % item)
+                self.emit('%s.append(%s)' % (out, item))
+            return
+
+        nodes = self.temp()
+        self.emit('%s = []' % nodes)
+        self.translate(block, nodes)
+        if node.modifier != '...':
+            self.emit('if %s: %s[0].set_outline()' % (nodes, nodes))
+        if node.modifier == '<':
+            self.emit("set_indent(%s, '')" % nodes)
+        self.emit('%s.extend(%s)' % (out, nodes))
+
+    def t_block_text(self, node, out):
+        self.emit('%s.append(%s)' % (out, self.text_block(node)))
+
+    def t_line(self, node, out):
+        text = self.concat(self.inline(node))
+        text = text if isinstance(text, Code) else repr(text)
+        if self.direct:
+            self.emit('%s.append([%s, %s, %s])' % (out, text, self.relative(False), self.take_outline()))
+        else:
+            self.emit('%s.append(Text(%s))' % (out, text))
+
+    def t_xblock_comment(self, node, out):
+        pass
+
+    def text_block(self, node):
+        """Code that creates a DOM.Text node for a text block, or an item in the direct mode."""
+        base, suffix = self.fun.base, self.suffix
+        self.fun.base, self.suffix = '', ''             # indentation is reset to zero for rendering of text blocks
+        try:
+            parts = []
+            for c in node.children: parts += self.render(c)
+            body = self.concat(parts)
+        finally:
+            self.fun.base, self.suffix = base, suffix
+
+        lead = node.column
+        if isinstance(body, Code):
+            text = 'format_text(%s, %d)' % (body, lead)
+        else:
+            text = repr(format_text(body, lead))        # static text is formatted during compilation
+        if self.direct:
+            return '[%s, %s, %s]' % (text, self.relative(), self.take_outline())
+        return 'Text(%s, indent = %s)' % (text, self.indentation())
+
+    def t_xblock_embed(self, node, out):
+        if self.direct:
+            var = self.plain_variable(node.expr)
+            if var is not None and var.slot_read in self.bodies:
+                value = self.read(var.slot_read, "variable '%s' referenced before assignment" % var.name, var)
+            else:
+                value = self.expr(node.expr)
+            self.emit('%s.extend(embed_items(%s, %s, %s, %s))' % (out, self.const(node), value, self.indentation(), self.relative()))
+            return
+
+        dom = self.temp('_d')
+        self.emit('%s = %s._as_sequence(%s)' % (dom, self.const(node), self.expr(node.expr)))
+        self.emit('%s.set_indent(%s)' % (dom, self.indentation()))
+        self.emit('%s.extend(%s.nodes)' % (out, dom))
+
+    def t_xblock_struct(self, node, out):
+        if self.direct: return self._struct_direct(node, out)
+
+        body = self.temp()
+        self.emit('%s = []' % body)
+        self.translate(node.body, body)
+
+        dom = self.temp('_d')
+        self.emit('%s = make_dom(%s)' % (dom, body))
+
+        for tag in reversed(node.tags.children):
+            if tag.type == 'null':
+                self.emit('%s = make_node(%s, tag = null)' % (dom, dom))
+                continue
+
+            attrs, kwattrs = self.tag_attrs(tag)
+
+            value = self.read(tag.tag, "tag '%s' referenced before declaration or assignment" % tag.name, tag)
+            self.emit('%s = expand_tag(%s, %s, %s, %s, %s, %s)' % (dom, dom, attrs, kwattrs, value, self.indentation(), self.const(tag)))
+
+        self.emit('%s.set_indent(%s)' % (dom, self.indentation()))
+        self.emit('%s.extend(%s.nodes)' % (out, dom))
+
+    def t_merged(self, node, out):
+        if self.direct:
+            self.emit('%s.append([%r, %s, %s])' % (out, node.value, self.relative(), self.take_outline()))
+        elif node.exposed:
+            self.translate(node.origin, out)
+        else:
+            self.emit('%s.append(Text(%r, indent = %s))' % (out, node.value, self.indentation()))
+
+    def tag_attrs(self, tag):
+        """Code of the lists of positional and keyword attributes of a tag occurrence, <xtag_expand>."""
+        attrs = '[%s]' % ', '.join(self.expr(expr) for expr in tag.unnamed)
+        names = [name for name, _ in tag.named]
+        if len(set(names)) == len(names):
+            kwattrs = '{%s}' % ', '.join('%r: %s' % (name, self.expr(expr)) for name, expr in tag.named)
+        else:
+            kwattrs = 'join_attrs([%s])' % ', '.join('(%r, %s)' % (name, self.expr(expr)) for name, expr in tag.named)
+        return attrs, kwattrs
+
+    def _struct_stream(self, node, out):
+
+        tag = node.tags.children[0]
+        if self.checks: self.check_tag(tag)
+        attrs, kwattrs = self.tag_attrs(tag)
+        value = self.read(tag.tag, "tag '%s' referenced before declaration or assignment" % tag.name, tag)
+        self.emit('%s.open(%s, %s, %s, %s, %s, %s)' % (out, value, attrs, kwattrs, self.relative(), self.take_outline(), self.const(tag)))
+
+        region, override = self.region, self.override
+        self.region, self.override = self.suffix, None
+        self.translate(node.body, out)
+        self.region, self.override = region, override
+
+        self.emit('%s.close()' % out)
+
+    def _struct_direct(self, node, out):
+
+        if out == self.writer and self.splittable(node):
+            return self._struct_stream(node, out)
+
+        outline = self.take_outline()
+        region, override = self.region, self.override
+        self.region, self.override = self.suffix, None
+
+        body = self.temp('_b')
+        self.emit('%s = Body()' % body)
+        self.translate(node.body, body)
+        self.region, self.override = region, override
+
+        text = None
+        for tag in reversed(node.tags.children):
+            arg = body if text is None else 'Body([[%s, None, False]])' % text
+            if tag.type == 'null':
+                if text is None:
+                    text = self.temp('_t')
+                    self.emit('%s = %s.render()' % (text, body))
+                continue
+
+            attrs, kwattrs = self.tag_attrs(tag)
+
+            if self.checks: self.check_tag(tag)
+            value = self.read(tag.tag, "tag '%s' referenced before declaration or assignment" % tag.name, tag)
+            text = self.temp('_t')
+            expand = 'expand_text'
+            if self.asynchronous and (tag.tag in self.hypertags or self.static_value(tag) is MISSING):
+                expand = 'await expand_async'
+            self.emit('%s = %s(%s, %s, %s, %s, %s, %s)' % (text, expand, arg, attrs, kwattrs, value, self.indentation(), self.const(tag)))
+
+        self.emit('%s.append([%s, %s, %s])' % (out, text, self.relative(), outline))
+
+    def t_xblock_def(self, node, out):
+
+        outer, suffix, region, override = self.fun, self.suffix, self.region, self.override
+        self.fun = fun = Function('h%d_%s' % (self.counter, re.sub(r'\W', '_', node.name)), 'body, attrs, kwattrs, ind, caller', None)
+        self.suffix = self.region = self.override = ''          # all top-level nodes of the output are set to `ind` indentation
+        self.counter += 1
+        self.hypertags.add(node.slot)
+
+        values = self.temp('_v')
+        self.emit('%s = bind_attrs(%s, body, attrs, kwattrs, caller)' % (values, self.const(node)))
+
+        for pos, attr in enumerate(node.attr_regul):
+            self.define(attr.slot)
+            var = self.var(attr.slot)
+            self.emit('%s = %s[%d]' % (var, values, pos))
+            if attr.expr is not None and node.defaults[pos] is MISSING:
+                self.emit('if %s is MISSING: %s = %s' % (var, var, self.expr(attr.expr)))
+        if node.attr_body:
+            self.define(node.attr_body.slot)
+            self.bodies.add(node.attr_body.slot)
+            if self.direct and not self.embedded_only(node):
+                self.emit('%s = as_dom(body)' % self.var(node.attr_body.slot))        # forced direct mode, see Runtime.direct
+            else:
+                self.emit('%s = body' % self.var(node.attr_body.slot))
+
+        output = self.temp()
+        self.emit('%s = []' % output)
+        self.translate(node.body, output)
+
+        if self.direct:
+            self.emit('if %s: %s[0][2] = False' % (output, output))
+            self.emit('return render_items(%s)' % output)
+        else:
+            dom = self.temp('_d')
+            self.emit('%s = make_dom(%s)' % (dom, output))
+            self.emit('%s.set_indent(ind)' % dom)
+            self.emit('if %s: %s[0].set_outline(False)' % (output, output))
+            self.emit('return make_node(%s, ind, tag = %s, kwattrs = dom_attrs(%s, attrs, kwattrs))' % (dom, self.const(node.native), self.const(node)))
+
+        self.fun, self.suffix, self.region, self.override = outer, suffix, region, override
+        for line in self._function(fun):
+            self.emit(line)
+
+        self.define(node.slot)
+        self.emit('%s = CompiledHypertag(%s, %s, %s, %s)' % (self.var(node.slot), fun.name, self.const(node), self.direct, self.asynchronous))
+
+    def t_xblock_import(self, node, out):
+        for item in node.items: self.translate(item, out)
+
+    def t_xwild_import(self, node, out):
+        for slot in node.slots.values():
+            self.define(slot)
+            self.emit('%s = %s' % (self.var(slot), self.literal(slot.value)))
+
+    def t_xname_import(self, node, out):
+        self.define(node.slot)
+        self.emit('%s = %s' % (self.var(node.slot), self.literal(node.slot.value)))
+
+    def t_xcntx_import(self, node, out):
+        self.define(node.slot)
+        self.emit('%s = %s' % (self.var(node.slot), self.awaited('context_get(context, %r, %s)' % (node.symbol, self.const(node)))))
+
+    def t_xblock_expr(self, node, out):
+        self.emit(self.expr(node.expr))
+
+    def t_xblock_assign(self, node, out):
+        value = self.expr(node.expr)
+        if node.oper:
+            var = node.targets.children[0]
+            if self.direct and self.checks and var.slot_read in self.bodies:
+                raise CompilerError("body attribute '%s' is used as a DOM, direct rendering is not possible" % var.name)
+            tmp = self.temp('_x')
+            self.emit('%s = %s' % (tmp, value))
+            current = self.read(var.slot_read, "variable '%s' referenced before assignment" % var.name, var)
+            value = '%s %s %s' % (self.atom(current), node.children[1].value, tmp)
+        self.assign(node.targets, value)
+
+    def t_xclause_if(self, node, out):
+        if node.body: self.translate(node.body, out)
+
+    def t_xclause_else(self, node, out):
+        for c in node.children: self.translate(c, out)
+
+    def _control_input(self):
+        """In the direct mode, indentation of a control block is imposed on all items produced inside. Returns the previous override."""
+        return self.impose(self.suffix[len(self.region):])
+
+    def _control_list(self, out):
+        """Name of a new list for output of a control block; or the writer itself in streamed rendering, where output is not collected."""
+        if out == self.writer: return out
+        nodes = self.temp()
+        self.emit('%s = []' % nodes)
+        return nodes
+
+    def _control_flush(self, nodes):
+        """In streamed rendering, emit code that yields the output collected so far, at the end of a loop iteration."""
+        if nodes != self.writer: return
+        self.fun.level += 1
+        self.emit('if %s.chunks: yield %s.flush()' % (nodes, nodes))
+        self.fun.level -= 1
+
+    def _control_output(self, nodes, out, override):
+        self.override = override
+        if nodes == out: return
+        if not self.direct:
+            self.emit('set_indent(%s, %s)' % (nodes, self.indentation()))
+        self.emit('%s.extend(%s)' % (out, nodes))
+
+    def t_xblock_if(self, node, out):
+        override = self._control_input()
+        nodes = self._control_list(out)
+        for i, clause in enumerate(node.clauses):
+            self.emit(('if %s:' if i == 0 else 'elif %s:') % self.expr(clause.test))
+            self.block(clause, nodes)
+        if node.elsebody:
+            self.emit('else:')
+            self.block(node.elsebody, nodes)
+        self._control_output(nodes, out, override)
+
+    def t_xblock_try(self, node, out):
+        override = self._control_input()
+        nodes = self.temp()
+        self.emit('%s = []' % nodes)
+        level = self.fun.level
+
+        for branch in node.children:
+            self.emit('try:')
+            self.fun.level += 1
+            self.fun.control += 1
+            local = self.temp()
+            self.emit('%s = []' % local)
+            self.translate(branch, local)
+            self.emit('%s = %s' % (nodes, local))
+            self.fun.control -= 1
+            self.fun.level -= 1
+            self.emit('except Exception:')
+            self.fun.level += 1
+
+        self.emit('pass')
+        self.fun.level = level
+        self._control_output(nodes, out, override)
+
+    def t_xblock_while(self, node, out):
+        clause = node.children[0]
+        else_  = node.children[1] if len(node.children) > 1 else None
+
+        override = self._control_input()
+        nodes, empty = self._control_list(out), self.temp('_e')
+        self.emit('%s = True' % empty)
+        self.emit('while %s:' % self.expr(clause.test))
+        self.fun.level += 1
+        self.emit('%s = False' % empty)
+        self.fun.level -= 1
+        self.block(clause, nodes)
+        self._control_flush(nodes)
+        if else_:
+            self.emit('if %s:' % empty)
+            self.block(else_, nodes)
+        self._control_output(nodes, out, override)
+
+    def t_xblock_for(self, node, out):
+        override = self._control_input()
+        nodes, empty, item = self._control_list(out), self.temp('_e'), self.temp('_i')
+        self.emit('%s = True' % empty)
+        if self.asynchronous:
+            self.emit('async for %s in AsyncIter(%s):' % (item, self.expr(node.expr)))
+        else:
+            self.emit('for %s in %s:' % (item, self.expr(node.expr)))
+
+        self.fun.level += 1
+        self.fun.control += 1
+        self.emit('%s = False' % empty)
+        self.assign(node.targets, item)
+        self.fun.control -= 1
+        self.fun.level -= 1
+
+        self.block(node.body, nodes)
+        self._control_flush(nodes)
+        if node.else_:
+            self.emit('if %s:' % empty)
+            self.block(node.else_, nodes)
+        self._control_output(nodes, out, override)
+
+
+    ###  TEXT (render)  ###
+
+    def r_static(self, node):
+        return [node.render(None)]
+
+    def r_indent(self, node):
+        self.t_indent(node, None)
+        return []
+
+    def r_dedent(self, node):
+        self.t_dedent(node, None)
+        return []
+
+    def r_line(self, node):
+        return [self.suffix] + self.inline(node)
+
+    def r_expression_root(self, node):
+        return [Code('STR(%s, %s)' % (self.expr(node), self.const(node)))]
+
+    def inline(self, node):
+        """List of parts of render_inline() of a line node."""
+        if node.type == 'line_verbat':
+            return [node.text()]
+
+        if node.type == 'line_normal':
+            text   = self.concat(self.inline(node.children[0]))
+            escape = node.tree.runtime.escape
+            if not escape: return [text]
+            if isinstance(text, Code):
+                return [Code('%s(%s)' % (self.const(escape), text))]
+            return [escape(text)]
+
+        if node.type == 'line_markup':
+            parts = []
+            for c in node.children: parts += self.render(c)
+            return parts
+
+        raise CompilerError("compilation of <%s> nodes is not supported" % node.__class__.__name__)
+
+
+    ###  EXPRESSIONS (evaluate)  ###
+
+    def e_expression_root(self, node):
+        assert len(node.children) == 1
+        awaits = self.awaits
+        return self.qualify(self.expr(node.children[0]), node.qualifier, node, awaits)
+
+    def e_literal(self, node):
+        return self.literal(node.value)
+
+    def e_variable(self, node):
+        if self.direct and self.checks and node.slot_read in self.bodies:
+            raise CompilerError("body attribute '%s' is used as a DOM, direct rendering is not possible" % node.name)
+        return self.read(node.slot_read, "variable '%s' referenced before assignment" % node.name, node)
+
+    def e_xtag_use(self, node):
+        if self.asynchronous and node.slot in self.hypertags:
+            raise CompilerError("hypertag '%s' of an asynchronous document can't be used as a value" % node.symbol)
+        tag = self.read(node.slot, "tag '%s' referenced before declaration or assignment" % node.symbol, node)
+        return 'embed_tag(%s, %s, %s)' % (tag, self.indentation(), self.const(node))
+
+    def e_xtargets(self, node):
+        assert len(node.children) == 1
+        return self.expr(node.children[0])
+
+    def e_xslice_value(self, node):
+        return self.expr(node.children[0]) if node.children else 'None'
+
+    def e_xfactor(self, node, tail = None):
+        awaits = self.awaits
+        code = self.expr(node.atom)
+        for op in (node.tail if tail is None else tail):
+            code = self.atom(code)
+            if op.type == 'call':
+                code = self.awaited('%s(%s)' % (code, self.arguments(op.children)))
+            elif op.type == 'partial_call':
+                if op.children: code = 'partial(%s, %s)' % (code, self.arguments(op.children))
+            elif op.type == 'index':
+                code = '%s[%s]' % (code, ':'.join(self.expr(c) for c in op.children))
+            elif op.type == 'member':
+                member = op.children[0].value
+                if member.isidentifier() and not keyword.iskeyword(member):
+                    code = '%s.%s' % (code, member)
+                else:
+                    code = 'getattr(%s, %r)' % (code, member)
+            else:
+                raise CompilerError("compilation of <%s> nodes is not supported" % op.__class__.__name__)
+        return self.qualify(code, node.qualifier, node, awaits)
+
+    def e_xpipeline(self, node):
+        code = self.expr(node.children[0])
+        for filter in node.children[1:]:
+            if isinstance(filter, NODES.xfactor) and not filter.qualifier and filter.tail and filter.tail[-1].type == 'partial_call':
+                call = filter.tail[-1]
+                fun  = self.e_xfactor(filter, filter.tail[:-1])
+                args = self.arguments(call.children)
+                code = self.awaited('pipe(%s, %s%s)' % (code, fun, ', ' + args if args else ''))
+            else:
+                code = self.awaited('pipe(%s, %s)' % (code, self.expr(filter)))
+        return code
+
+    def e_chain_expression(self, node):
+        children = node.children
+        if children[0].type == 'neg':
+            code = 'negate(%s)' % self.expr(children[1])
+            children = children[2:]
+        else:
+            code = self.expr(children[0])
+            children = children[1:]
+
+        for op, expr in zip(children[0::2], children[1::2]):
+            code = '(%s %s %s)' % (code, self.OPERATORS.get(op.name, op.name), self.expr(expr))
+        return code
+
+    def e_simple_chain_expression(self, node):
+        return '(%s)' % (' %s ' % node.name).join(self.expr(c) for c in node.children)
+
+    def e_xconcat_expr(self, node):
+        error = self.const("expression to be string-concatenated evaluates to None")
+        return '(%s)' % ' + '.join('STR(%s, %s, %s)' % (self.expr(c), self.const(c), error) for c in node.children)
+
+    def e_xnot_test(self, node):
+        code = self.expr(node.children[-1])
+        return '(not %s)' % code if len(node.children) % 2 == 0 else code
+
+    def e_xifelse_test(self, node):
+        other = self.expr(node.children[2]) if len(node.children) == 3 else "''"
+        return '(%s if %s else %s)' % (self.expr(node.children[0]), self.expr(node.children[1]), other)
+
+    def e_xlist(self, node):
+        return '[%s]' % ', '.join(self.expr(c) for c in node.children)
+
+    def e_xtuple(self, node):
+        return '(%s)' % ''.join(self.expr(c) + ', ' for c in node.children)
+
+    def e_xset(self, node):
+        return 'set((%s))' % ''.join(self.expr(c) + ', ' for c in node.children)
+
+    def e_xdict(self, node):
+        items = node.children
+        return '{%s}' % ', '.join('%s: %s' % (self.expr(k), self.expr(v)) for k, v in zip(items[0::2], items[1::2]))
+
+    def e_xstring_format(self, node):
+        parts = []
+        for c in node.children: parts += self.render(c)
+        text = self.concat(parts)
+        return text if isinstance(text, Code) else repr(text)
@@ -8,12 +8,7 @@ class HError(ParserError):
         
         # convert `line`, `column` to coordinates of the original script from before INDENT/DEDENT encoding
         if self.node and self.column is not None:
-            prefix  = self.node.fulltext[:self.pos[0]]
-            symbols = self.node.tree.parser.symbols
-            indents = prefix.count(symbols['INDENT_S']) + prefix.count(symbols['INDENT_T'])
-            dedents = prefix.count(symbols['DEDENT_S']) + prefix.count(symbols['DEDENT_T'])
-            indent  = indents - dedents
-            column  = indent + self.column
+            column  = self.node.tree.indentation(self.pos[0]) + self.column
         else:
             column  = None
         
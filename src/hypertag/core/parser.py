@@ -0,0 +1,1215 @@
+"""
+Hand-written parser of Hypertag, an alternative to the Parsimonious-based one (Runtime.parser = 'native').
+A recursive-descent parser that mirrors the PEG grammar of hypertag.core.grammar rule by rule, with the same
+ordered choice and greedy repetition semantics. It consumes the output of Grammar.preprocess() and builds
+the tree of NODES.x* objects directly, without an intermediate Parsimonious AST: the rewriting rules
+of HypertagAST (_ignore_, _reduce_, _compact_) are applied in place, so the resulting tree is identical
+to the one produced by Parsimonious and ParsimoniousTree.rewrite().
+
+Every rule is a method, rule(pos, out), that tries to match the rule at position `pos` of the text,
+appends the resulting nodes to the list `out` and returns the end position of the match; or returns -1
+and leaves `out` unchanged if the rule doesn't match. Rules that are tried repeatedly at the same position
+by alternative branches of the grammar are memoized (packrat-style).
+
+@author:  Marcin Wojnarski
+"""
+
+from parsimonious.exceptions import IncompleteParseError
+
+
+def memoized(rule):
+    """Decorator of a rule method that caches its results (end position + output nodes) per position in the text."""
+    name = rule.__name__
+
+    def cached(self, pos, out):
+        key = (name, pos)
+        hit = self.memo.get(key)
+        if hit is None:
+            start = len(out)
+            end = rule(self, pos, out)
+            self.memo[key] = (end, out[start:])
+            return end
+        end, nodes = hit
+        if end >= 0: out.extend(nodes)
+        return end
+
+    return cached
+
+
+class Parser:
+    """
+    Parser of a preprocessed script for a given HypertagAST, which provides the Grammar (special characters
+    and regular expressions of terminal rules), the configuration of rewriting, and the NODES classes.
+    Parser.parse() returns the root <xdocument> node, not yet enriched nor set up.
+    """
+
+    def __init__(self, tree):
+        grammar  = tree.parser
+        symbols  = grammar.symbols
+
+        self.tree    = tree
+        self.grammar = grammar
+        self.classes = {}               # rule name -> NODES class
+        self.compact = set(tree._compact_.split()) if isinstance(tree._compact_, str) else tree._compact_
+        self.memo    = {}               # (rule name, position) -> (end position, list of output nodes)
+        self.text    = None
+
+        self.INDENT_S, self.DEDENT_S = symbols['INDENT_S'], symbols['DEDENT_S']
+        self.INDENT_T, self.DEDENT_T = symbols['INDENT_T'], symbols['DEDENT_T']
+
+        # regular expressions of terminal rules are taken from the grammar, so that the matching is identical
+        for rule in ('ws', 'space', 'gap', 'nl', 'escape', 'verbatim', 'text', 'text_quot1', 'text_quot2', 'mark_comment',
+                     'qualifier', 'number', 'op_comp', 'op_inplace', 'name_xml', 'name_reserved', 'path_import', 'attr_short_lit'):
+            setattr(self, 're_' + rule, grammar[rule].re)
+
+        self.re_name_id = grammar['name_id'].members[1].re
+        self.re_string_raw = [member.re for member in grammar['string_raw'].members]
+
+        # operators of binary expressions, as rules that output a node of a given type, or nothing (anonymous literals)
+        self.op_power     = self.literals('op_power', '**')
+        self.op_multiplic = self.literals('op_multiplic', '*', '//', '/', '%')
+        self.op_additive  = self.literals('op_additive', '+', '-')
+        self.op_shift     = self.literals('op_shift', '<<', '>>')
+        self.op_and       = self.literals(None, '&')
+        self.op_xor       = self.literals(None, '^')
+        self.op_or        = self.literals(None, '|')
+        self.op_pipe      = self.literals(None, ':')
+
+    def parse(self, text, reuse = None):
+        """
+        Parse the entire `text`. Raises Parsimonious' IncompleteParseError if the text can't be parsed to its end,
+        with `pos` pointing at the beginning of the last top-level block that was parsed before the failure.
+        `reuse(pos)` is an optional function that returns a ready node of a top-level block at `pos`, or None.
+        """
+        self.text = text
+        self.memo = {}
+        try:
+            return self.document(reuse)
+        finally:
+            self.memo = {}
+
+    def make(self, rule, start, end, children):
+        """
+        Create a node of the NODES class corresponding to `rule`, like ParsimoniousTree.rewrite() does, or return
+        its only child if the rule is listed in _compact_.
+        """
+        if len(children) == 1 and rule in self.compact: return children[0]
+
+        cls = self.classes.get(rule)
+        if cls is None:
+            cls = self.classes[rule] = getattr(self.tree.NODES, 'x' + rule)
+
+        node = cls.__new__(cls)
+        node.tree = self.tree
+        node.astnode = None
+        node.fulltext = self.text
+        node.pos = (start, end)
+        node.type = rule
+        node.children = children
+        return node
+
+    def leaf(self, rule, pos, end, out):
+        """Append a childless node of `rule` that matched text[pos:end]; return `end`."""
+        out.append(self.make(rule, pos, end, []))
+        return end
+
+    def regex(self, regex, rule, pos, out):
+        match = regex.match(self.text, pos)
+        if match is None: return -1
+        return self.leaf(rule, pos, match.end(), out)
+
+
+    ###  WHITESPACE & PUNCTUATION (ignored, no output)  ###
+
+    def ws(self, pos):
+        return self.re_ws.match(self.text, pos).end()
+
+    def space(self, pos):
+        match = self.re_space.match(self.text, pos)
+        return match.end() if match else -1
+
+    def comma(self, pos):
+        pos = self.ws(pos)
+        if not self.text.startswith(',', pos): return -1
+        return self.ws(pos + 1)
+
+    def inline_comment(self, pos):
+        text = self.text
+        match = self.re_mark_comment.match(text, self.ws(pos))
+        if match is None: return -1
+        pos = match.end()
+        match = self.re_verbatim.match(text, pos)
+        return match.end() if match else pos
+
+
+    ###  DOCUMENT  ###
+
+    def document(self, reuse = None):
+        """
+        Like `document` rule, but leading indentation of the whole script is matched level by level (as nested `tail_blocks`)
+        and top-level blocks are parsed one by one, with the memo cleared after each block to keep memory use bounded.
+        Blocks returned by reuse(pos) are inserted without parsing.
+        """
+        text = self.text
+        levels = {self.INDENT_S: ('indent_s', 'dedent_s', self.DEDENT_S), self.INDENT_T: ('indent_t', 'dedent_t', self.DEDENT_T)}
+        children = []
+        dedents = []
+        pos = 0
+        while text[pos:pos+1] in levels:
+            indent, dedent, char = levels[text[pos]]
+            pos = self.leaf(indent, pos, pos + 1, children)
+            dedents.append((dedent, char))
+
+        start = end = pos
+        while pos >= 0:
+            last, end = end, pos                                       # starts of the last parsed block and the current one
+            node = reuse(pos) if reuse else None
+            if node:
+                children.append(node)
+                pos = node.pos[1]
+            else:
+                pos = self.block(pos, children)
+                self.memo = {}
+        pos = end
+
+        if dedents and pos == start: pos = -1                      # `core_blocks` inside indentation can't be empty
+        for dedent, char in reversed(dedents):
+            if pos >= 0: pos = self.leaf(dedent, pos, pos + 1, children) if text.startswith(char, pos) else -1
+
+        if pos >= 0: pos = max(pos, self.margin(pos, children))
+        if pos != len(text): raise IncompleteParseError(text, last, self.grammar['document'])
+        return self.make('document', 0, pos, children)
+
+    @memoized
+    def tail_blocks(self, pos, out):
+        text = self.text
+        if text.startswith(self.INDENT_S, pos):   dedent, rules = self.DEDENT_S, ('indent_s', 'dedent_s')
+        elif text.startswith(self.INDENT_T, pos): dedent, rules = self.DEDENT_T, ('indent_t', 'dedent_t')
+        else: return -1
+
+        start = len(out)
+        self.leaf(rules[0], pos, pos + 1, out)
+        end = self.core_blocks(pos + 1, out)
+        if end < 0 or not text.startswith(dedent, end):
+            del out[start:]
+            return -1
+        return self.leaf(rules[1], end, end + 1, out)
+
+    def core_blocks(self, pos, out):
+        end = self.tail_blocks(pos, out)
+        if end >= 0: return end
+        end = self.block(pos, out)
+        if end < 0: return -1
+        while True:
+            pos, end = end, self.block(end, out)
+            if end < 0: return pos
+
+    def block(self, pos, out):
+        children = []
+        end = self.margin_out(pos, children)
+        if end < 0: return -1
+
+        mod = self.modifier(end, children)
+        if mod >= 0: end = self.ws(mod)
+
+        for rule in self.BLOCKS:
+            stop = rule(self, end, children)
+            if stop >= 0:
+                out.append(self.make('block', pos, stop, children))
+                return stop
+        return -1
+
+    def modifier(self, pos, out):
+        text = self.text
+        if text.startswith('<', pos):   return self.leaf('dedent', pos, pos + 1, out)
+        if text.startswith('...', pos): return self.leaf('append', pos, pos + 3, out)
+        return -1
+
+    def margin_out(self, pos, out):
+        return self.regex(self.re_nl, 'margin_out', pos, out)
+
+    def margin(self, pos, out):
+        return self.regex(self.re_nl, 'margin', pos, out)
+
+
+    ###  CONTROL BLOCKS  ###
+
+    def block_try(self, pos, out):
+        text = self.text
+        children = []
+        if text.startswith('try', pos):                             # try_long
+            end = self.generic_control(pos + 3, children)
+            end = self.clauses_else(end if end >= 0 else pos + 3, children)
+        elif text.startswith('?', pos):                             # try_short
+            end = self.ws(pos + 1)
+            stop = self.block_struct(end, children)
+            if stop < 0: stop = self.body_control(end, children)
+            if stop >= 0: end = stop
+        else:
+            return -1
+        out.append(self.make('block_try', pos, end, children))
+        return end
+
+    def clauses_else(self, pos, out):
+        """clause_else*"""
+        while True:
+            end = self.clause_else(pos, out)
+            if end < 0: return pos
+            pos = end
+
+    def block_expr(self, pos, out):
+        if not self.text.startswith('$', pos): return -1
+        children = []
+        end = self.expr_assign(pos + 1, children)
+        if end < 0: return -1
+        out.append(self.make('block_expr', pos, end, children))
+        return end
+
+    def block_assign(self, pos, out):
+        text = self.text
+        if not text.startswith('$', pos): return -1
+        children = []
+        end = self.targets(self.ws(pos + 1), children)
+        if end < 0: return -1
+        end = self.ws(end)
+        op = self.regex(self.re_op_inplace, 'op_inplace', end, children)
+        if op >= 0: end = op
+        if not text.startswith('=', end): return -1
+        end = self.expr_assign(end + 1, children)
+        if end < 0: return -1
+        out.append(self.make('block_assign', pos, end, children))
+        return end
+
+    def expr_assign(self, pos, out):
+        pos = self.ws(pos)
+        end = self.expr_augment(pos, out)
+        if end < 0: end = self.embedding(pos, out)
+        if end < 0: return -1
+        stop = self.inline_comment(end)
+        return stop if stop >= 0 else end
+
+    def block_while(self, pos, out):
+        if not self.text.startswith('while', pos): return -1
+        children = []
+        end = self.clause_if(pos + 5, children)
+        if end < 0: return -1
+        stop = self.clause_else(end, children)
+        if stop >= 0: end = stop
+        out.append(self.make('block_while', pos, end, children))
+        return end
+
+    def block_for(self, pos, out):
+        text = self.text
+        if not text.startswith('for', pos): return -1
+        children = []
+        end = self.space(pos + 3)
+        if end < 0: return -1
+        end = self.targets(end, children)
+        if end < 0: return -1
+        end = self.space(end)
+        if end < 0 or not text.startswith('in', end): return -1
+        end = self.space(end + 2)
+        if end < 0: return -1
+        end = self.tail_control(end, children, self.expr_augment)
+        if end < 0: return -1
+        stop = self.clause_else(end, children)
+        if stop >= 0: end = stop
+        out.append(self.make('block_for', pos, end, children))
+        return end
+
+    def block_if(self, pos, out):
+        text = self.text
+        if not text.startswith('if', pos): return -1
+        children = []
+        end = self.clause_if(pos + 2, children)
+        if end < 0: return -1
+        while True:
+            match = self.re_nl.match(text, end)
+            if match is None or not text.startswith('elif', match.end()): break
+            stop = self.clause_if(match.end() + 4, children)
+            if stop < 0: break
+            end = stop
+        stop = self.clause_else(end, children)
+        if stop >= 0: end = stop
+        out.append(self.make('block_if', pos, end, children))
+        return end
+
+    def clause_if(self, pos, out):
+        end = self.space(pos)
+        if end < 0: return -1
+        children = []
+        end = self.tail_control(end, children, self.expr)
+        if end < 0: return -1
+        out.append(self.make('clause_if', pos, end, children))
+        return end
+
+    def clause_else(self, pos, out):
+        match = self.re_nl.match(self.text, pos)
+        if match is None or not self.text.startswith('else', match.end()): return -1
+        children = []
+        end = match.end() + 4
+        stop = self.generic_control(end, children)
+        if stop >= 0: end = stop
+        out.append(self.make('clause_else', pos, end, children))
+        return end
+
+    def tail_control(self, pos, out, expr):
+        """tail_for and tail_if:  (expr_factor generic_control) / (EXPR body_control?)"""
+        start = len(out)
+        end = self.expr_factor(pos, out)
+        if end >= 0:
+            end = self.generic_control(end, out)
+            if end >= 0: return end
+            del out[start:]
+        end = expr(pos, out)
+        if end < 0: return -1
+        stop = self.body_control(end, out)
+        return stop if stop >= 0 else end
+
+    def targets(self, pos, out):
+        children = []
+        end = self.target(pos, children)
+        if end < 0: return -1
+        while True:
+            stop = self.comma(end)
+            if stop < 0: break
+            stop = self.target(stop, children)
+            if stop < 0: break
+            end = stop
+        stop = self.ws(end)
+        if self.text.startswith(',', stop): end = stop + 1
+        out.append(self.make('targets', pos, end, children))
+        return end
+
+    def target(self, pos, out):
+        if self.text.startswith('(', pos):
+            start = len(out)
+            end = self.targets(self.ws(pos + 1), out)
+            if end >= 0:
+                end = self.ws(end)
+                if self.text.startswith(')', end): return end + 1
+                del out[start:]
+        return self.var_def(pos, out)
+
+    def var_def(self, pos, out):
+        children = []
+        end = self.name_id(pos, children)
+        if end < 0: return -1
+        out.append(self.make('var_def', pos, end, children))
+        return end
+
+
+    ###  DEFINITION BLOCKS  ###
+
+    def block_def(self, pos, out):
+        if not self.text.startswith('%', pos): return -1
+        children = []
+        end = self.name_id(self.ws(pos + 1), children)
+        if end < 0: return -1
+        end = self.attrs_def(end, children)
+        end = self.generic_struct(end, children)
+        if end < 0: return -1
+        out.append(self.make('block_def', pos, end, children))
+        return end
+
+    def attrs_def(self, pos, out):
+        end = self.space(pos)
+        if end >= 0:
+            end = self.attr_body(end, out)
+            if end >= 0: pos = end
+        while True:
+            end = self.space(pos)
+            if end < 0: return pos
+            end = self.attr_def(end, out)
+            if end < 0: return pos
+            pos = end
+
+    def attr_body(self, pos, out):
+        if not self.text.startswith('@', pos): return -1
+        children = []
+        end = self.name_id(self.ws(pos + 1), children)
+        if end < 0: return -1
+        out.append(self.make('attr_body', pos, end, children))
+        return end
+
+    def attr_def(self, pos, out):
+        children = []
+        end = self.name_id(pos, children)
+        if end < 0: return -1
+        stop = self.ws(end)
+        if self.text.startswith('=', stop):
+            stop = self.value_of_attr(self.ws(stop + 1), children)
+            if stop >= 0: end = stop
+        out.append(self.make('attr_def', pos, end, children))
+        return end
+
+    def block_context(self, pos, out):
+        if not self.text.startswith('context', pos): return -1
+        return self.block_symbols(pos, pos + 7, out, 'block_context', self.cntx_import)
+
+    def block_import(self, pos, out):
+        text = self.text
+        if not text.startswith('from', pos): return -1
+        children = []
+        end = self.space(pos + 4)
+        if end < 0: return -1
+        end = self.regex(self.re_path_import, 'path_import', end, children)
+        if end < 0: return -1
+        end = self.space(end)
+        if end < 0 or not text.startswith('import', end): return -1
+        return self.block_symbols(pos, end + 6, out, 'block_import', self.item_import, children)
+
+    def block_symbols(self, pos, end, out, rule, item, children = None):
+        """The common tail of `block_context` and `block_import`:  space ITEM (comma ITEM)* inline_comment?"""
+        children = children or []
+        end = self.space(end)
+        if end < 0: return -1
+        end = item(end, children)
+        if end < 0: return -1
+        while True:
+            stop = self.comma(end)
+            if stop < 0: break
+            stop = item(stop, children)
+            if stop < 0: break
+            end = stop
+        stop = self.inline_comment(end)
+        if stop >= 0: end = stop
+        out.append(self.make(rule, pos, end, children))
+        return end
+
+    def item_import(self, pos, out):
+        if self.text.startswith('*', pos): return self.leaf('wild_import', pos, pos + 1, out)
+        return self.symbol_import(pos, out, 'name_import')
+
+    def cntx_import(self, pos, out):
+        return self.symbol_import(pos, out, 'cntx_import')
+
+    def symbol_import(self, pos, out, rule):
+        """cntx_import and name_import:  symbol rename?"""
+        if not self.text.startswith(('%', '$'), pos): return -1
+        children = []
+        name = []
+        end = self.name_id(pos + 1, name)
+        if end < 0: return -1
+        children.append(self.make('symbol', pos, end, name))
+
+        stop = self.space(end)                                  # rename
+        if stop >= 0 and self.text.startswith('as', stop):
+            stop = self.space(stop + 2)
+            if stop >= 0:
+                stop = self.name_id(stop, children)
+                if stop >= 0: end = stop
+
+        out.append(self.make(rule, pos, end, children))
+        return end
+
+
+    ###  STRUCTURED BLOCK  ###
+
+    def block_struct(self, pos, out):
+        children = []
+        end = self.tags_expand(pos, children)
+        if end >= 0:
+            end = self.generic_struct(end, children)
+        if end < 0:
+            children = []
+            end = self.body_text(pos, children)
+            if end < 0: return -1
+        out.append(self.make('block_struct', pos, end, children))
+        return end
+
+    def tags_expand(self, pos, out):
+        text = self.text
+        children = []
+        if text.startswith('.', pos):
+            end = self.leaf('null', pos, pos + 1, children)
+        else:
+            end = self.tag_expand(pos, children)
+            if end < 0: return -1
+            while True:
+                stop = self.ws(end)
+                if not text.startswith(':', stop): break
+                stop = self.tag_expand(self.ws(stop + 1), children)
+                if stop < 0: break
+                end = stop
+        out.append(self.make('tags_expand', pos, end, children))
+        return end
+
+    def tag_expand(self, pos, out):
+        children = []
+        end = self.name_id(pos, children)
+        if end < 0: return -1
+        end = self.attrs_val(end, children)
+        out.append(self.make('tag_expand', pos, end, children))
+        return end
+
+    def special_tag(self, pos, out):
+        if not self.text.startswith('pass', pos): return -1
+        return self.leaf('pass', pos, pos + 4, out)
+
+
+    ###  HEAD, BODY  ###
+
+    def generic_control(self, pos, out):
+        end = self.body_text(self.ws(pos), out)
+        if end >= 0: return end
+        return self.body_control(pos, out)
+
+    def generic_struct(self, pos, out):
+        end = self.body_text(self.ws(pos), out)
+        if end >= 0: return end
+        return self.body_struct(pos, out)
+
+    def body_control(self, pos, out):
+        children = []
+        end = self.ws(pos)
+        if self.text.startswith(':', end):
+            end += 1
+            stop = self.inline_comment(end)
+            if stop >= 0: end = stop
+            stop = self.tail_blocks(end, children)
+            if stop >= 0: end = stop
+        else:
+            end = self.inline_comment(pos)
+            end = self.tail_blocks(end if end >= 0 else pos, children)
+            if end < 0: return -1
+        out.append(self.make('body_control', pos, end, children))
+        return end
+
+    def body_struct(self, pos, out):
+        children = []
+        end = self.ws(pos)
+        end = end + 1 if self.text.startswith(':', end) else pos
+        stop = self.headline(self.ws(end), children)
+        if stop < 0: stop = self.inline_comment(end)
+        if stop >= 0: end = stop
+        stop = self.tail_blocks(end, children)
+        if stop >= 0: end = stop
+        out.append(self.make('body_struct', pos, end, children))
+        return end
+
+    def body_text(self, pos, out):
+        text = self.text
+        if text.startswith('!', pos): return self.block_text(pos, out, 'block_verbat', self.line_verbat)
+        if text.startswith('|', pos): return self.block_text(pos, out, 'block_normal', self.line_normal)
+        if text.startswith('/', pos): return self.block_text(pos, out, 'block_markup', self.line_markup)
+        return self.block_embed(pos, out)
+
+    def headline(self, pos, out):
+        text = self.text
+        if text.startswith('!', pos):   line = self.line_verbat
+        elif text.startswith('|', pos): line = self.line_normal
+        elif text.startswith('/', pos): line = self.line_markup
+        else: return -1
+        end = pos + 1
+        if self.re_gap.match(text, end): end += 1
+        stop = line(end, out)
+        return stop if stop >= 0 else end
+
+
+    ###  TEXT BLOCKS, TAIL, LINE  ###
+
+    def block_text(self, pos, out, rule, line, start = 1):
+        """block_verbat, block_normal, block_markup, block_comment:  MARK line? tail?"""
+        children = []
+        end = pos + start
+        stop = line(end, children)
+        if stop >= 0: end = stop
+        stop = self.tail_text(end, children, line)
+        if stop >= 0: end = stop
+        out.append(self.make(rule, pos, end, children))
+        return end
+
+    def block_comment(self, pos, out):
+        match = self.re_mark_comment.match(self.text, pos)
+        if match is None: return -1
+        return self.block_text(pos, out, 'block_comment', self.line_verbat, match.end() - pos)
+
+    def block_embed(self, pos, out):
+        if not self.text.startswith('@', pos): return -1
+        children = []
+        end = self.expr(self.ws(pos + 1), children)
+        if end < 0: return -1
+        stop = self.inline_comment(end)
+        if stop >= 0: end = stop
+        out.append(self.make('block_embed', pos, end, children))
+        return end
+
+    def tail_text(self, pos, out, line):
+        """tail_verbat, tail_normal, tail_markup:  (indent_s CORE dedent_s) / (indent_t CORE dedent_t)"""
+        text = self.text
+        if text.startswith(self.INDENT_S, pos):   dedent, rules = self.DEDENT_S, ('indent_s', 'dedent_s')
+        elif text.startswith(self.INDENT_T, pos): dedent, rules = self.DEDENT_T, ('indent_t', 'dedent_t')
+        else: return -1
+
+        start = len(out)
+        self.leaf(rules[0], pos, pos + 1, out)
+        end = self.core_text(pos + 1, out, line)
+        if end < 0 or not text.startswith(dedent, end):
+            del out[start:]
+            return -1
+        return self.leaf(rules[1], end, end + 1, out)
+
+    def core_text(self, pos, out, line):
+        """core_verbat, core_normal, core_markup:  (TAIL / (margin LINE))+"""
+        start = pos
+        while True:
+            end = self.tail_text(pos, out, line)
+            if end < 0:
+                size = len(out)
+                end = self.margin(pos, out)
+                if end >= 0:
+                    end = line(end, out)
+                    if end < 0: del out[size:]
+            if end < 0: break
+            pos = end
+        return pos if pos > start else -1
+
+    def line_verbat(self, pos, out):
+        match = self.re_verbatim.match(self.text, pos)
+        if match is None: return -1
+        return self.leaf('line_verbat', pos, match.end(), out)
+
+    def line_normal(self, pos, out):
+        children = []
+        end = self.line_markup(pos, children)
+        if end < 0: return -1
+        out.append(self.make('line_normal', pos, end, children))
+        return end
+
+    def line_markup(self, pos, out):
+        children = []
+        end = self.items(pos, children, self.re_text, 'text')
+        if end == pos: return -1
+        out.append(self.make('line_markup', pos, end, children))
+        return end
+
+    def items(self, pos, out, re_text, rule):
+        """(escape / embedding / TEXT)*"""
+        text = self.text
+        while True:
+            match = self.re_escape.match(text, pos)
+            if match:
+                pos = self.leaf('escape', pos, match.end(), out)
+                continue
+            end = self.embedding(pos, out)
+            if end >= 0:
+                pos = end
+                continue
+            match = re_text.match(text, pos)
+            if match:
+                pos = self.leaf(rule, pos, match.end(), out)
+                continue
+            return pos
+
+
+    ###  EMBEDDINGS  ###
+
+    def embedding(self, pos, out):
+        text = self.text
+        if text.startswith('{', pos):                               # embedding_braces
+            start = len(out)
+            end = self.expr_augment(self.ws(pos + 1), out)
+            if end < 0: return -1
+            end = self.ws(end)
+            if not text.startswith('}', end):
+                del out[start:]
+                return -1
+            stop = self.regex(self.re_qualifier, 'qualifier', end + 1, out)
+            return stop if stop >= 0 else end + 1
+
+        if text.startswith('$', pos) and not text.startswith('$', pos + 1):         # embedding_eval
+            return self.expr_var(pos + 1, out)
+        return -1
+
+
+    ###  ATTRIBUTES  ###
+
+    def attrs_val(self, pos, out):
+        while True:
+            end = self.attr_short(pos, out)
+            if end < 0: break
+            pos = end
+        while True:
+            end = self.space(pos)
+            if end < 0: return pos
+            stop = self.attr_val(end, out)
+            if stop < 0:
+                stop = self.attr_short(end, out)
+                if stop < 0: return pos
+                while True:
+                    end = self.attr_short(stop, out)
+                    if end < 0: break
+                    stop = end
+            pos = stop
+
+    def attr_val(self, pos, out):
+        end = self.attr_named(pos, out)
+        if end >= 0: return end
+        children = []
+        end = self.value_of_attr(pos, children)
+        if end < 0: return -1
+        out.append(self.make('attr_unnamed', pos, end, children))
+        return end
+
+    def attr_short(self, pos, out):
+        if not self.text.startswith(('.', '#'), pos): return -1
+        children = []
+        end = self.regex(self.re_attr_short_lit, 'attr_short_lit', pos + 1, children)
+        if end < 0: end = self.embedding(pos + 1, children)
+        if end < 0: return -1
+        out.append(self.make('attr_short', pos, end, children))
+        return end
+
+    def attr_named(self, pos, out):
+        children = []
+        end = self.regex(self.re_name_xml, 'name_xml', pos, children)
+        if end < 0: return -1
+        end = self.ws(end)
+        if not self.text.startswith('=', end): return -1
+        end = self.value_of_attr(self.ws(end + 1), children)
+        if end < 0: return -1
+        out.append(self.make('attr_named', pos, end, children))
+        return end
+
+    def value_of_attr(self, pos, out):
+        end = self.embedding(pos, out)
+        if end >= 0: return end
+        return self.expr_strict(pos, out)
+
+
+    ###  ARGUMENTS of functions  ###
+
+    def args(self, pos, out):
+        end = self.arg(pos, out)
+        if end < 0: return -1
+        while True:
+            stop = self.comma(end)
+            if stop < 0: break
+            stop = self.arg(stop, out)
+            if stop < 0: break
+            end = stop
+        stop = self.ws(end)
+        return stop + 1 if self.text.startswith(',', stop) else end
+
+    def arg(self, pos, out):
+        children = []
+        end = self.name_id(pos, children)                          # kwarg
+        if end >= 0:
+            end = self.ws(end)
+            if self.text.startswith('=', end):
+                end = self.expr(self.ws(end + 1), children)
+                if end >= 0:
+                    out.append(self.make('kwarg', pos, end, children))
+                    return end
+        return self.expr(pos, out)
+
+
+    ###  EXPRESSIONS  ###
+
+    def wrapped(self, rule, inner, pos, out, start = None):
+        """A node of `rule` that wraps the output of a single sub-rule matched at `pos`, like in:  expr = expr_root ''
+        The node begins at `start`, if given."""
+        children = []
+        end = inner(pos, children)
+        if end < 0: return -1
+        out.append(self.make(rule, pos if start is None else start, end, children))
+        return end
+
+    @memoized
+    def expr(self, pos, out):           return self.wrapped('expr', self.ifelse_test, pos, out)
+    def expr_var(self, pos, out):       return self.wrapped('expr_var', self.factor_var, pos, out)
+    def expr_factor(self, pos, out):    return self.wrapped('expr_factor', self.factor, pos, out)
+    def expr_strict(self, pos, out):    return self.wrapped('expr_strict', self.factor_strict, pos, out)
+    def expr_bitwise(self, pos, out):   return self.wrapped('expr_bitwise', self.or_expr, pos, out)
+
+    def expr_augment(self, pos, out):
+        children = []
+        end = self.expr_tuple(pos, children)
+        if end < 0: end = self.ifelse_test(pos, children)
+        if end < 0: return -1
+        out.append(self.make('expr_augment', pos, end, children))
+        return end
+
+    def expr_tuple(self, pos, out):
+        text = self.text
+        children = []
+        end = self.expr(pos, children)
+        if end < 0: return -1
+        end = self.ws(end)
+        if not text.startswith(',', end): return -1
+        end += 1
+        while True:
+            size = len(children)
+            stop = self.expr(self.ws(end), children)
+            if stop < 0: break
+            stop = self.ws(stop)
+            if not text.startswith(',', stop):
+                del children[size:]
+                break
+            end = stop + 1
+        stop = self.expr(self.ws(end), children)
+        if stop >= 0: end = stop
+        out.append(self.make('expr_tuple', pos, end, children))
+        return end
+
+    def tag_use(self, pos, out):
+        if not self.text.startswith('%', pos): return -1
+        return self.wrapped('tag_use', self.name_id, pos + 1, out, pos)
+
+    def var_use(self, pos, out):
+        start = pos + 1 if self.text.startswith('$', pos) else pos
+        return self.wrapped('var_use', self.name_id, start, out, pos)
+
+    def name_id(self, pos, out):
+        text = self.text
+        match = self.re_name_id.match(text, pos)
+        if match is None or self.re_name_reserved.match(text, pos): return -1
+        return self.leaf('name_id', pos, match.end(), out)
+
+    def items_comma(self, pos, out):
+        """(expr comma)*  in `tuple` and `list`; returns the end position and the no. of items"""
+        count = 0
+        while True:
+            size = len(out)
+            end = self.expr(pos, out)
+            if end >= 0: end = self.comma(end)
+            if end < 0:
+                del out[size:]
+                return pos, count
+            pos = end
+            count += 1
+
+    def tuple(self, pos, out):
+        text = self.text
+        if not text.startswith('(', pos): return -1
+        children = []
+        end = self.ws(pos + 1)
+        stop, count = self.items_comma(end, children)
+        if count:
+            end = stop
+            stop = self.expr(end, children)
+            if stop >= 0: end = self.ws(stop)
+        if not text.startswith(')', end): return -1
+        out.append(self.make('tuple', pos, end + 1, children))
+        return end + 1
+
+    def list(self, pos, out):
+        text = self.text
+        if not text.startswith('[', pos): return -1
+        children = []
+        end, _ = self.items_comma(self.ws(pos + 1), children)
+        stop = self.expr(end, children)
+        if stop >= 0: end = self.ws(stop)
+        if not text.startswith(']', end): return -1
+        out.append(self.make('list', pos, end + 1, children))
+        return end + 1
+
+    def set(self, pos, out):
+        text = self.text
+        if not text.startswith('{', pos): return -1
+        children = []
+        end = self.expr(self.ws(pos + 1), children)
+        if end < 0: return -1
+        while True:
+            stop = self.comma(end)
+            if stop < 0: break
+            stop = self.expr(stop, children)
+            if stop < 0: break
+            end = stop
+        end = self.ws(end)
+        if text.startswith(',', end): end = self.ws(end + 1)
+        if not text.startswith('}', end): return -1
+        out.append(self.make('set', pos, end + 1, children))
+        return end + 1
+
+    def dict(self, pos, out):
+        text = self.text
+        if not text.startswith('{', pos): return -1
+        children = []
+        end = self.ws(pos + 1)
+        while True:
+            size = len(children)
+            stop = self.dict_pair(end, children)
+            if stop >= 0: stop = self.comma(stop)
+            if stop < 0:
+                del children[size:]
+                break
+            end = stop
+        stop = self.dict_pair(end, children)
+        if stop >= 0: end = self.ws(stop)
+        if not text.startswith('}', end): return -1
+        out.append(self.make('dict', pos, end + 1, children))
+        return end + 1
+
+    def dict_pair(self, pos, out):
+        start = len(out)
+        end = self.expr_bitwise(pos, out)
+        if end >= 0:
+            end = self.ws(end)
+            if self.text.startswith(':', end):
+                end = self.expr(self.ws(end + 1), out)
+                if end >= 0: return end
+        del out[start:]
+        return -1
+
+    def subexpr(self, pos, out):
+        if not self.text.startswith('(', pos): return -1
+        start = len(out)
+        end = self.expr(self.ws(pos + 1), out)
+        if end < 0: return -1
+        end = self.ws(end)
+        if self.text.startswith(')', end): return end + 1
+        del out[start:]
+        return -1
+
+    def atom(self, pos, out):
+        for rule in self.ATOMS:
+            end = rule(self, pos, out)
+            if end >= 0: return end
+        return -1
+
+    def factor_var(self, pos, out):
+        return self.factor_chain('factor_var', self.var_use, self.trailer, pos, out)
+
+    def factor_strict(self, pos, out):
+        return self.factor_chain('factor_strict', self.atom, self.trailer, pos, out)
+
+    def factor_filt(self, pos, out):
+        return self.factor_chain('factor_filt', self.atom, self.trailer_filt, pos, out, qualifier = False)
+
+    @memoized
+    def factor(self, pos, out):
+        return self.factor_chain('factor', self.atom, self.trailer, pos, out, spaced = True)
+
+    def factor_chain(self, rule, atom, trailer, pos, out, qualifier = True, spaced = False):
+        """Factors:  ATOM TRAILER* qualifier?  or  ATOM (ws TRAILER)* qualifier?"""
+        children = []
+        end = atom(pos, children)
+        if end < 0: return -1
+        while True:
+            stop = trailer(self.ws(end) if spaced else end, children)
+            if stop < 0: break
+            end = stop
+        if qualifier:
+            stop = self.regex(self.re_qualifier, 'qualifier', end, children)
+            if stop >= 0: end = stop
+        out.append(self.make(rule, pos, end, children))
+        return end
+
+    def chain(self, rule, first, op, pos, out, next = None, children = None, start = None):
+        """
+        Chain of binary operators:  FIRST (ws OP ws NEXT)*
+        The node of `rule` begins at `start` and contains `children` (if given) followed by the operands and operators.
+        """
+        next = next or first
+        children = children if children is not None else []
+        end = first(pos, children)
+        if end < 0: return -1
+        while True:
+            size = len(children)
+            stop = op(self.ws(end), children)
+            if stop >= 0: stop = next(self.ws(stop), children)
+            if stop < 0:
+                del children[size:]
+                break
+            end = stop
+        out.append(self.make(rule, pos if start is None else start, end, children))
+        return end
+
+    def literals(self, rule, *literals):
+        """An operator rule that matches one of `literals` and outputs a node of `rule`, or nothing if `rule` is None."""
+        def op(pos, out):
+            for literal in literals:
+                if self.text.startswith(literal, pos):
+                    end = pos + len(literal)
+                    return self.leaf(rule, pos, end, out) if rule else end
+            return -1
+        return op
+
+    def op_comp(self, pos, out):
+        return self.regex(self.re_op_comp, 'op_comp', pos, out)
+
+    def pow_expr(self, pos, out):   return self.chain('pow_expr', self.factor, self.op_power, pos, out)
+    def term(self, pos, out):       return self.chain('term', self.pow_expr, self.op_multiplic, pos, out)
+    def shift_expr(self, pos, out): return self.chain('shift_expr', self.arith_expr, self.op_shift, pos, out)
+    def and_expr(self, pos, out):   return self.chain('and_expr', self.shift_expr, self.op_and, pos, out)
+    def xor_expr(self, pos, out):   return self.chain('xor_expr', self.and_expr, self.op_xor, pos, out)
+    def pipeline(self, pos, out):   return self.chain('pipeline', self.or_expr, self.op_pipe, pos, out, self.filter)
+    def comparison(self, pos, out): return self.chain('comparison', self.concat_expr, self.op_comp, pos, out)
+
+    @memoized
+    def or_expr(self, pos, out):    return self.chain('or_expr', self.xor_expr, self.op_or, pos, out)
+
+    def arith_expr(self, pos, out):
+        children = []
+        end = pos
+        if self.text.startswith('-', pos): end = self.leaf('neg', pos, pos + 1, children)
+        return self.chain('arith_expr', self.term, self.op_additive, self.ws(end), out, children = children, start = pos)
+
+    def concat_expr(self, pos, out):
+        children = []
+        end = self.pipeline(pos, children)
+        if end < 0: return -1
+        while True:
+            stop = self.space(end)
+            if stop >= 0: stop = self.pipeline(stop, children)
+            if stop < 0: break
+            end = stop
+        out.append(self.make('concat_expr', pos, end, children))
+        return end
+
+    def not_test(self, pos, out):
+        text = self.text
+        children = []
+        end = pos
+        while text.startswith('not', end):
+            stop = self.space(end + 3)
+            if stop < 0: break
+            self.leaf('not', end, end + 3, children)
+            end = stop
+        end = self.comparison(end, children)
+        if end < 0: return -1
+        out.append(self.make('not_test', pos, end, children))
+        return end
+
+    def keyword(self, pos, word):
+        """space WORD space"""
+        pos = self.space(pos)
+        if pos < 0 or not self.text.startswith(word, pos): return -1
+        return self.space(pos + len(word))
+
+    def logical(self, rule, operand, word, pos, out):
+        """and_test, or_test:  OPERAND (space WORD space OPERAND)*"""
+        children = []
+        end = operand(pos, children)
+        if end < 0: return -1
+        while True:
+            stop = self.keyword(end, word)
+            if stop >= 0: stop = operand(stop, children)
+            if stop < 0: break
+            end = stop
+        out.append(self.make(rule, pos, end, children))
+        return end
+
+    def and_test(self, pos, out):   return self.logical('and_test', self.not_test, 'and', pos, out)
+    def or_test(self, pos, out):    return self.logical('or_test', self.and_test, 'or', pos, out)
+
+    @memoized
+    def ifelse_test(self, pos, out):
+        children = []
+        end = self.or_test(pos, children)
+        if end < 0: return -1
+        stop = self.keyword(end, 'if')
+        if stop >= 0: stop = self.or_test(stop, children)
+        if stop >= 0:
+            end = stop
+            stop = self.keyword(end, 'else')
+            if stop >= 0: stop = self.ifelse_test(stop, children)
+            if stop >= 0: end = stop
+        out.append(self.make('ifelse_test', pos, end, children))
+        return end
+
+
+    ###  TAIL OPERATORS  ###
+
+    def trailer(self, pos, out):
+        end = self.call(pos, out)
+        if end >= 0: return end
+        return self.trailer_filt(pos, out)
+
+    def trailer_filt(self, pos, out):
+        end = self.index(pos, out)
+        if end >= 0: return end
+        return self.member(pos, out)
+
+    def call(self, pos, out, rule = 'call'):
+        if not self.text.startswith('(', pos): return -1
+        children = []
+        end = self.ws(pos + 1)
+        stop = self.args(end, children)
+        if stop >= 0: end = self.ws(stop)
+        if not self.text.startswith(')', end): return -1
+        out.append(self.make(rule, pos, end + 1, children))
+        return end + 1
+
+    def partial_call(self, pos, out):
+        return self.call(pos, out, 'partial_call')
+
+    def index(self, pos, out):
+        if not self.text.startswith('[', pos): return -1
+        children = []
+        end = self.slice(pos + 1, children)
+        if end < 0:
+            end = self.expr_augment(self.ws(pos + 1), children)
+            if end < 0: return -1
+            end = self.ws(end)
+        if not self.text.startswith(']', end): return -1
+        out.append(self.make('index', pos, end + 1, children))
+        return end + 1
+
+    def slice(self, pos, out):
+        start = len(out)
+        end = self.slice_value(pos, out)
+        if not self.text.startswith(':', end):
+            del out[start:]
+            return -1
+        end = self.slice_value(end + 1, out)
+        if self.text.startswith(':', end):
+            end = self.slice_value(end + 1, out)
+        return end
+
+    def slice_value(self, pos, out):
+        children = []
+        end = self.ws(pos)
+        stop = self.expr_bitwise(end, children)
+        if stop >= 0: end = self.ws(stop)
+        out.append(self.make('slice_value', pos, end, children))
+        return end
+
+    def member(self, pos, out):
+        if not self.text.startswith('.', pos): return -1
+        return self.wrapped('member', self.name_id, self.ws(pos + 1), out, pos)
+
+    def filter(self, pos, out):
+        children = []
+        end = self.factor_filt(pos, children)
+        if end < 0: return -1
+        stop = self.partial_call(end, children)
+        if stop >= 0: end = stop
+        out.append(self.make('filter', pos, end, children))
+        return end
+
+
+    ###  ATOMS  ###
+
+    def literal(self, pos, out):
+        text = self.text
+        end = self.regex(self.re_number, 'number', pos, out)
+        if end >= 0: return end
+        end = self.string(pos, out)
+        if end >= 0: return end
+        for word in ('True', 'False'):
+            if text.startswith(word, pos): return self.leaf('boolean', pos, pos + len(word), out)
+        if text.startswith('None', pos): return self.leaf('none', pos, pos + 4, out)
+        return -1
+
+    def string(self, pos, out):
+        text = self.text
+        for quote, regex, rule in (("'", self.re_text_quot1, 'text_quot1'), ('"', self.re_text_quot2, 'text_quot2')):
+            if text.startswith(quote, pos):                         # string_format
+                children = []
+                end = self.items(pos + 1, children, regex, rule)
+                if not text.startswith(quote, end): return -1
+                out.append(self.make('string_format', pos, end + 1, children))
+                return end + 1
+        for regex in self.re_string_raw:
+            end = self.regex(regex, 'string_raw', pos, out)
+            if end >= 0: return end
+        return -1
+
+
+    # alternatives of `block` and `atom` rules, in the order of the grammar
+    BLOCKS = [block_assign, block_expr, block_if, block_try, block_for, block_while,
+              block_def, block_context, block_import, block_struct, block_comment, special_tag]
+    ATOMS  = [literal, var_use, tag_use, subexpr, tuple, list, dict, set]
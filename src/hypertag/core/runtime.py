@@ -1,8 +1,11 @@
-import os, sys, importlib
+import os, time, threading, importlib, weakref
+from functools import wraps
 
 from hypertag.core.errors import ImportErrorEx, ModuleNotFoundEx
 from hypertag.core.grammar import MARK_VAR, MARK_TAG, VAR, TAG, TAGS
 from hypertag.core.ast import HypertagAST
+from hypertag.core.cache import ScriptCache
+from hypertag.core.watcher import Watcher
 
 PATH_SEP = os.path.sep
 
@@ -12,12 +15,6 @@ PATH_SEP = os.path.sep
 #####  UTILITIES
 #####
 
-# set Python's global recursion limit to at least MIN_RECURSION_LIMIT to avoid RecursionError
-# when parsing deeply nested scripts
-MIN_RECURSION_LIMIT = 20000
-sys.setrecursionlimit(max(sys.getrecursionlimit(), MIN_RECURSION_LIMIT))
-
-
 def join_path(base, path, sep = '.', ext = None):
     """
     Convert a relative import `path` to an absolute one by appending it to an absolute `base` path.
@@ -49,6 +46,15 @@ def join_path(base, path, sep = '.', ext = None):
     return fullpath
 
 
+def synchronized(method):
+    """Decorator of Loader methods that must run under the loader's lock, `self.lock`, when called from concurrent threads."""
+    @wraps(method)
+    def locked(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return locked
+
+
 #####################################################################################################################################################
 #####
 #####  MODULES
@@ -60,9 +66,11 @@ class Module:
     runtime  = None     # Runtime that created this module
     location = None     # canonical path of this module, for deduplication and caching; there can be many
                         # non-canonical (e.g., relative) paths pointing to the same module, but only one canonical path
+    key      = None     # identifier of this module in the ImportGraph if it has no `location`, like a module of a compiled Template
     filename = None     # name of the file if this module was loaded from disk; mapped to __file__ inside a script
     package  = None     # Python package path of this module's package, if available; mapped to __package__ inside a script
     symbols  = None     # cached dict of this module's symbols; each symbol has a leading mark % or $
+    imports  = None     # if not None, a dict of {import path: (loader, module)} of the modules imported by this one is recorded here
     
     def __init__(self, **kwattrs):
         for attr, value in kwattrs.items():
@@ -110,23 +118,238 @@ class HyModule(Module):
     dom     = None      # output DOM produced by translation
     symbols = None      # dict of output symbols produced during script parsing, {name: value}
     state   = None      # local State at the end of translation; needed when hypertags from this module are to be expanded
+    ast     = None      # HypertagAST of the script that was translated
     
-    def translate(self, builtins, __tags__, **variables):
-    
-        ast = HypertagAST(self.script, self)
+    def translate(self, builtins, __tags__, __ast__ = None, **variables):
+        """
+        Translate self.script and store the results in self. If a pre-parsed AST of the script
+        is provided in `__ast__`, it is reused and parsing is skipped.
+        """
+        ast = self.ast = __ast__ or self.runtime.parse(self.script, self)
         self.dom, self.symbols, self.state = ast.translate(builtins, __tags__, **variables)
         return self
         
+    def render(self, builtins, __tags__, __ast__ = None, **variables):
+        """Like translate() followed by rendering of self.dom, but the DOM may not be constructed at all, see HypertagAST.render()."""
+        ast = __ast__ or self.runtime.parse(self.script, self)
+        return ast.render(builtins, __tags__, **variables)
+        
+    def render_iter(self, builtins, __tags__, __ast__ = None, **variables):
+        """Like render(), but returns an iterator of output chunks, see HypertagAST.render_iter()."""
+        ast = __ast__ or self.runtime.parse(self.script, self)
+        return ast.render_iter(builtins, __tags__, **variables)
+        
+    async def render_async(self, builtins, __tags__, __ast__ = None, **variables):
+        """Like render(), but a coroutine, see HypertagAST.render_async()."""
+        ast = __ast__ or self.runtime.parse(self.script, self)
+        return await ast.render_async(builtins, __tags__, **variables)
+        
     
 class RootModule(HyModule):
     """Wrapper module for a top-level script, to provide a referrer module for other (imported) scripts."""
     
 
+#####################################################################################################################################################
+#####
+#####  TEMPLATE
+#####
+
+class Template:
+    """
+    A script that has been parsed and analysed once, in Runtime.compile(), and can be translated or rendered many times
+    with different variables. Only the translation phase is executed on subsequent calls to translate() or render().
+    Templates are immutable: their attributes can't be modified after creation.
+    Templates can be pickled, for instance, to be sent to multiprocessing workers; the AST is pickled
+    in its serialized form (HypertagAST.dumps()) and analysed again after unpickling.
+    
+    The modules imported by the script are bound to the AST during analysis. Before every translation, the template checks
+    with the loaders whether these modules are still current - an imported script may have been modified on disk
+    and evicted from the loader's cache - and if not, a fresh copy of the AST is analysed again and replaces the old one.
+    """
+    
+    runtime  = None     # Runtime that compiled this template
+    script   = None     # plain text of the Hypertag script
+    filename = None     # name of the file the script was loaded from; mapped to __file__ inside the script
+    package  = None     # Python package path of the script; mapped to __package__ inside the script
+    module   = None     # HyModule that serves as a referrer for imports that occur in the script
+    ast      = None     # HypertagAST of the script, parsed once
+    
+    _lock    = threading.Lock()     # held while a stale template is analysed again, so that concurrent threads do it only once
+    
+    def __init__(self, runtime, script, filename = None, package = None, previous = None):
+        """
+        If a `previous` Template compiled from an earlier version of the script is given, and the runtime is `incremental`,
+        top-level blocks that did not change are reused from there instead of being parsed again.
+        """
+        module = HyModule(runtime = runtime, script = script, filename = filename, package = package)
+        ast    = runtime.parse(script, module, previous.ast if previous else None, runtime.incremental)
+        self._setup(runtime, script, filename, package, module, ast)
+        
+    def _setup(self, runtime, script, filename, package, module, ast):
+        # the template is identified in the import graph by a synthetic key, as it has no location;
+        # its imports are recorded during analysis, in the graph and in `module.imports` (for _stale())
+        module.key = '<template 0x%x>' % id(self)
+        module.imports = {}
+        runtime.graph.clear(module.key)
+        if self.module is None:
+            weakref.finalize(self, runtime.graph.clear, module.key)     # edges are removed when the template is garbage-collected
+        
+        ast.analyse(runtime.import_builtins(filename, package))
+        self.__dict__.update(runtime = runtime, script = script, filename = filename, package = package, module = module, ast = ast)
+        
+    def _stale(self):
+        """True if any of the modules imported during analysis is no longer the one returned by its loader."""
+        return any(loader.load(path, self.module, self.runtime) is not module for path, (loader, module) in self.module.imports.items())
+    
+    def _refresh(self):
+        """
+        If the template is stale, analyse a fresh copy of the AST, so that imported symbols are bound anew.
+        The AST is replaced as a whole, so concurrent translations use either the old or the new version.
+        """
+        if not self.module.imports or not self._stale(): return
+        with self._lock:
+            if not self._stale(): return
+            module = HyModule(runtime = self.runtime, script = self.script, filename = self.filename, package = self.package)
+            ast    = HypertagAST.loads(self.ast.dumps(), module)
+            self._setup(self.runtime, self.script, self.filename, self.package, module, ast)
+        
+    def __setattr__(self, name, value):
+        raise AttributeError("can't set attribute '%s', Template is immutable" % name)
+    
+    def __getstate__(self):
+        return {'runtime': self.runtime, 'script': self.script, 'filename': self.filename, 'package': self.package,
+                'ast': self.ast.dumps()}
+    
+    def __setstate__(self, state):
+        runtime, script, filename, package = state['runtime'], state['script'], state['filename'], state['package']
+        module = HyModule(runtime = runtime, script = script, filename = filename, package = package)
+        ast    = HypertagAST.loads(state['ast'], module)
+        self._setup(runtime, script, filename, package, module, ast)
+    
+    def recompile(self, script):
+        """
+        Compile a modified version of this template's script and return as a new Template. If the runtime is `incremental`,
+        only the top-level blocks that changed are parsed, the remaining ones are copied from this template's AST.
+        """
+        return Template(self.runtime, script, self.filename, self.package, self)
+        
+    def _prepare(self):
+        """
+        Common preamble of all entry points that execute the template: refresh the AST if any of its imports changed,
+        and return (builtins, module) - the built-in symbols and a new HyModule for the execution.
+        """
+        self._refresh()
+        builtins = self.runtime.import_builtins(self.filename, self.package)
+        module   = HyModule(runtime = self.runtime, script = self.script, filename = self.filename, package = self.package)
+        return builtins, module
+        
+    def translate(self, __tags__ = None, **variables):
+        """Translate the pre-parsed script to a DOM tree, and return wrapped up in a new HyModule instance."""
+        builtins, module = self._prepare()
+        return module.translate(builtins, __tags__, self.ast, **variables)
+    
+    def render(self, __tags__ = None, **variables):
+        builtins, module = self._prepare()
+        return module.render(builtins, __tags__, self.ast, **variables)
+        
+    def stream(self, __tags__ = None, **variables):
+        """
+        Render the pre-parsed script incrementally: return an iterator of output chunks that concatenate to the document.
+        See Runtime.render_iter() for details.
+        """
+        builtins, module = self._prepare()
+        return module.render_iter(builtins, __tags__, self.ast, **variables)
+        
+    async def render_async(self, __tags__ = None, **variables):
+        """Like render(), but a coroutine that awaits asynchronous values of variables, see Runtime.render_async()."""
+        builtins, module = self._prepare()
+        return await module.render_async(builtins, __tags__, self.ast, **variables)
+        
+
 #####################################################################################################################################################
 #####
 #####  LOADERS
 #####
 
+class ImportGraph:
+    """
+    Graph of imports between modules, identified by their locations (or by Module.key, for compiled templates): which module imported which.
+    Edges are kept in both directions, so that all modules that depend on a given one (directly or indirectly)
+    can be found when it is invalidated. The graph is maintained by Runtime and shared with its loaders. Thread-safe.
+    """
+    
+    imports    = None   # dict of {location: set of locations of the modules imported by this one}
+    dependents = None   # dict of {location: set of locations of the modules that import this one} - the reverse edges
+    lock       = None   # RLock that guards the graph against concurrent modifications
+    
+    def __init__(self):
+        self.imports    = {}
+        self.dependents = {}
+        self.lock       = threading.RLock()
+        
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
+        
+    def add(self, referrer, imported):
+        """Record that module at location `referrer` imports module at location `imported`."""
+        with self.lock:
+            self.imports.setdefault(referrer, set()).add(imported)
+            self.dependents.setdefault(imported, set()).add(referrer)
+        
+    def clear(self, location):
+        """Remove all outgoing edges of `location`, e.g., before its script is translated again and its imports are recorded anew."""
+        with self.lock:
+            for imported in self.imports.pop(location, ()):
+                referrers = self.dependents.get(imported)
+                if referrers:
+                    referrers.discard(location)
+                    if not referrers: del self.dependents[imported]
+    
+    def affected(self, location):
+        """List of `location` and locations of all modules that import it, directly or indirectly; `location` goes first."""
+        result, visited = [], {location}
+        pending = [location]
+        with self.lock:
+            while pending:
+                location = pending.pop()
+                result.append(location)
+                for referrer in self.dependents.get(location, ()):
+                    if referrer not in visited:
+                        visited.add(referrer)
+                        pending.append(referrer)
+        return result
+    
+    def order(self, locations = None):
+        """
+        List of `locations` (all locations in the graph if None) together with the locations they import, directly or indirectly,
+        sorted topologically: every module goes after the modules it imports. Import cycles, if any, are broken arbitrarily.
+        """
+        with self.lock:
+            if locations is None:
+                locations = list(self.imports) + list(self.dependents)
+            result, visited = [], set()
+            for location in locations:
+                if location in visited: continue
+                visited.add(location)
+                stack = [(location, iter(self.imports.get(location, ())))]
+                while stack:
+                    location, imports = stack[-1]
+                    imported = next(imports, None)
+                    if imported is None:
+                        stack.pop()
+                        result.append(location)
+                    elif imported not in visited:
+                        visited.add(imported)
+                        stack.append((imported, iter(self.imports.get(imported, ()))))
+        return result
+        
+
 class Loader:
     """
     Finding, loading, and caching modules.
@@ -137,17 +360,33 @@ class Loader:
     """
     cache = None        # dict of cached modules indexed by their canonical path (module.location);
                         # each Loader subclass is responsible for managing the cache by itself
+    graph = None        # ImportGraph of the Runtime this loader belongs to; used to find dependents of invalidated modules
+    lock  = None        # RLock held during loading and invalidation of modules, so that concurrent threads
+                        # don't load the same module twice nor see a partially updated cache; not pickled
     
     def __init__(self):
         self.cache = {}
+        self.lock  = threading.RLock()
+    
+    def __getstate__(self):
+        """Cached modules are not pickled."""
+        state = self.__dict__.copy()
+        state['cache'] = {}
+        state.pop('lock', None)
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
     
+    @synchronized
     def load(self, path, referrer, runtime):
         """
         Try to load a module given its (non-canonical) path and a referrer module, and return a Module instance.
         If the path is invalid or the module can't be found, None is returned.
         If this method is overriden by subclasses, `self.cache` should be checked to avoid repeated loading
         of the same module every time after a `path` is converted to a canonical `location`; every newly loaded module
-        should be put into cache.
+        should be put into cache. Overriding methods should be decorated with @synchronized.
         """
         location = self._find(path, referrer)
         if location is None: return None
@@ -156,6 +395,31 @@ class Loader:
         module = self.cache[location] = self._read(location, runtime)
         return module
 
+    @synchronized
+    def load_location(self, location, runtime):
+        """
+        Load a module given its canonical `location`, which may have been obtained from a previous load(), e.g., for
+        pre-warming of the cache. Return None if the location is invalid for this loader or the module is missing.
+        """
+        if location in self.cache: return self.cache[location]
+        module = self._read(location, runtime)
+        if module: self.cache[location] = module
+        return module
+        
+    @synchronized
+    def invalidate(self, location):
+        """
+        Remove the module of a given `location` from the cache, together with all cached modules that import it,
+        directly or indirectly (according to the `graph`), so that they are loaded again on the next import.
+        Return a list of locations removed.
+        """
+        locations = self.graph.affected(location) if self.graph else [location]
+        return [loc for loc in locations if self._evict(loc)]
+        
+    def _evict(self, location):
+        """Remove a module from the cache. Return True if it was present."""
+        return self.cache.pop(location, None) is not None
+
     def _find(self, path, referrer):
         """
         Convert a path to its canonical form. The `referrer` is the module where the path occured.
@@ -216,19 +480,118 @@ class HyLoader(Loader):
     
     Import paths CAN refer to folders which are NOT valid Python packages (don't have __init__.py inside).
     HyLoader does not check the existence of __init__.py on directory paths to scripts.
+    
+    Loaded modules are cached. A cached module is re-read when its script, or any script it imports (directly
+    or indirectly), has been modified on disk, as indicated by the file's modification time and size. To keep the cost
+    of imports low, the file of a given module is checked (os.stat) at most once per `interval` seconds.
+    
+    Alternatively, with watch(), the loader starts a background Watcher that is notified about modifications
+    of the loaded scripts (by inotify on Linux) and evicts the modified modules and their dependents from the cache
+    immediately. Imports of cached modules perform no file system calls then.
+    
+    Results of the lookup of import paths are cached, too, in `resolved`, keyed by the import path, the referrer's folder
+    and - for absolute paths - the current working directory. Import paths that could not be resolved are cached as well
+    (for `interval` seconds), so that repeated imports of built-in or Python modules, which are tried with HyLoader first,
+    don't search the file system every time. Absolute paths are not cached when a `resolve` function is set,
+    as its result may depend on the referrer in any way.
     """
     
     SCRIPT_EXTENSION = '.hy'         # default file extension of Hypertag scripts
-
-    def __init__(self, resolve = None):
+    
+    interval  = 1.0     # min. time in seconds between two checks whether a cached script was modified on disk;
+                        # 0 - check on every import; None - never check, cached modules are kept until reload()
+    stamps    = None    # dict of {location: [(mtime, size), time of the last check]} for cached modules
+    _previous = None    # dict of {location: module} of modules evicted from the cache, for incremental re-parsing
+    resolved  = None    # resolution cache: dict of {(import path, referrer's folder, cwd or None): (location, package, time of resolution)};
+                        # location is None for paths that could not be resolved (negative entries, they expire after `interval`)
+    watcher   = None    # Watcher of the loaded scripts, if started with watch(); not pickled
+    on_change = None    # optional function called with a list of locations of the modules evicted after a change reported by the watcher
+
+    def __init__(self, resolve = None, interval = 1.0, watch = False):
+        """
+        :param interval: see HyLoader.interval
+        :param watch: if True, watch() is called to start a Watcher of the loaded scripts
+        """
         super(HyLoader, self).__init__()
-        self.resolve = resolve
-
+        self.resolve   = resolve
+        self.interval  = interval
+        self.stamps    = {}
+        self.resolved  = {}
+        self._previous = {}
+        if watch: self.watch()
+
+    def __getstate__(self):
+        state = super(HyLoader, self).__getstate__()
+        state['stamps']    = {}
+        state['resolved']  = {}
+        state['_previous'] = {}
+        state['watcher']   = None
+        return state
+        
+    @synchronized
+    def watch(self, on_change = None):
+        """
+        Start a background Watcher that evicts cached modules as soon as their scripts are modified on disk,
+        together with the modules that import them. Periodic checks of files during imports are disabled then.
+        If `on_change` is given, it is called (in the watcher's thread) with a list of locations of the evicted modules.
+        Compiled templates that imported any of them are analysed again on their next render, see Template.
+        """
+        if on_change: self.on_change = on_change
+        if self.watcher: return self.watcher
+        self.watcher = Watcher.create(self._changed, self.interval or 1.0)
+        for location in list(self.cache):
+            self.watcher.add(location)
+            stamp = self.stamps.get(location)
+            if stamp is None or self._signature(location) != stamp[0]:      # modified before the watcher was started
+                self._changed(location)
+        return self.watcher
+        
+    def unwatch(self):
+        """Stop the watcher started with watch(), if any. Cached scripts are checked during imports again, every `interval` seconds."""
+        if not self.watcher: return
+        self.watcher.stop()
+        self.watcher = None
+        for stamp in self.stamps.values(): stamp[1] = float('-inf')         # files might have changed after stop()
+        
+    def _changed(self, location):
+        evicted = self.invalidate(location)
+        if evicted and self.on_change:
+            self.on_change(evicted)
+        
+    @synchronized
     def load(self, path, referrer, runtime):
         
+        ref_root = os.path.dirname(referrer.filename) if referrer.filename else None
+        relative = (path[:1] == '.')
+        
+        # absolute paths depend on the current folder, and on the resolve() function, which is called with the referrer;
+        # the results of the latter are not cached at all
+        if relative: key = (path, ref_root, None)
+        elif self.resolve: key = None
+        else: key = (path, ref_root, os.getcwd())
+        
+        # look up the resolution cache first; negative entries expire after `interval` seconds
+        entry = self.resolved.get(key) if key else None
+        if entry and (entry[0] or self.interval is None or time.monotonic() - entry[2] < self.interval):
+            location, package = entry[:2]
+            if location is None: return None
+            if self._fresh(location): return self.cache[location]
+            if os.path.isfile(location):
+                return self._read_script(location, package, runtime, self._previous.pop(location, None))
+        
+        location, package = self._resolve(path, referrer, ref_root)
+        if key: self.resolved[key] = (location, package, time.monotonic())
+        if location is None: return None
+        if self._fresh(location): return self.cache[location]
+        return self._read_script(location, package, runtime, self._previous.pop(location, None))
+        
+    def _resolve(self, path, referrer, ref_root):
+        """
+        Find the location of a script given its import `path`. Return (location, package), or (None, None) if the script
+        can't be found. The `package` is a Python package path of the script's package, if it can be inferred.
+        """
         # whenever possible, python package path (python_path) of the module is inferred, so that its `package` can be set
         location = python_path = None
-        ref_root = os.path.dirname(referrer.filename) if referrer.filename else None
         
         # relative import path is always resolved relative to the referrer's folder
         if path[:1] == '.':
@@ -241,27 +604,28 @@ class HyLoader(Loader):
             # 1. try calling a resolve() function
             if self.resolve:
                 location = self.resolve(path, referrer)
-                if location in self.cache: return self.cache[location]
                 if location and not os.path.exists(location):
                     location = None
 
             # 2. try the Python's standard import mechanism (importlib); must be applied to the parent package, not the script itself
             if not location and '.' in path:
                 package_name, filename = path.rsplit('.', 1)
-                pkg = importlib.import_module(package_name)                 # package_name is an absolute path, so referrer is not needed here
-                package_path = pkg.__file__
-                if package_path.endswith('.py'):
-                    package_path = os.path.dirname(package_path)            # truncate /__init__.py part of a package file path
-                
-                location = package_path + PATH_SEP + filename + self.SCRIPT_EXTENSION
-                python_path = package_path + '.' + filename
-                if location and not os.path.exists(location):
-                    location = python_path = None
+                try:
+                    pkg = importlib.import_module(package_name)             # package_name is an absolute path, so referrer is not needed here
+                except ImportError:
+                    pkg = None
+                package_path = getattr(pkg, '__file__', None)
+                if package_path:
+                    if package_path.endswith('.py'):
+                        package_path = os.path.dirname(package_path)        # truncate /__init__.py part of a package file path
+                    location = package_path + PATH_SEP + filename + self.SCRIPT_EXTENSION
+                    python_path = path
+                    if not os.path.exists(location):
+                        location = python_path = None
                 
             # 3. try using the process' current folder as a root
             if not location:
                 location = self._join_path(os.getcwd(), '.' + path)
-                if location in self.cache: return self.cache[location]
                 if location and not os.path.exists(location):
                     location = None
 
@@ -271,16 +635,97 @@ class HyLoader(Loader):
                 python_path = self._make_absolute('.' + path, referrer)
 
         if not location or not os.path.exists(location):
-            return None
+            return None, None
         
         package = python_path.rsplit('.', 1)[0] if python_path else None
+        return location, package
+        
+    @synchronized
+    def load_location(self, location, runtime):
+        """
+        Load a script given its file path. If the module was evicted from the cache before, its package is preserved,
+        and the previous AST is used for incremental re-parsing.
+        """
+        if self._fresh(location): return self.cache[location]
+        if not os.path.isfile(location): return None
+        previous = self._previous.pop(location, None)
+        return self._read_script(location, previous.package if previous else None, runtime, previous)
+        
+    @synchronized
+    def reload(self, location, runtime):
+        """
+        Read again a script that was loaded before from `location` (a file path) and replace its module in the cache.
+        If the runtime is `incremental`, only the top-level blocks that changed since the previous version are parsed,
+        the remaining ones are copied from the AST of the previous module. Return the new module, or None if the file is missing.
+        Cached modules that import this one, directly or indirectly, are removed from the cache.
+        """
+        self.invalidate(location)
+        return self.load_location(location, runtime)
+        
+    @synchronized
+    def invalidate(self, location):
+        """
+        Like Loader.invalidate(), but additionally clears the resolution cache, so that all import paths are resolved again:
+        a script created or removed on disk may change the resolution of paths other than the ones of the evicted modules.
+        """
+        evicted = super(HyLoader, self).invalidate(location)
+        self.resolved = {}
+        return evicted
+        
+    def _evict(self, location):
+        module = self.cache.pop(location, None)
+        if module is None: return False
+        self._previous[location] = module
+        self.stamps.pop(location, None)
+        return True
+        
+    def _fresh(self, location, now = None):
+        """
+        True if the module of `location` is in the cache and neither its script nor any of the scripts imported by it
+        have been modified since loading. Every file is checked at most once per `interval` seconds.
+        A modified module is removed from the cache, together with the modules that depend on it.
+        """
+        if location not in self.cache: return False
+        if self.interval is None or self.watcher: return True
+        
+        now = now or time.monotonic()
+        stamp = self.stamps.get(location)
+        
+        # check the script itself, then the imported ones
+        if stamp is None or now - stamp[1] >= self.interval:
+            signature = self._signature(location)
+            if stamp is None or signature != stamp[0]:
+                self.invalidate(location)
+                return False
+            stamp[1] = now
+        
+        for imported in list(self.graph.imports.get(location, ()) if self.graph else ()):
+            if imported in self.cache and not self._fresh(imported, now):
+                self.invalidate(location)
+                return False
+        return True
+        
+    @staticmethod
+    def _signature(location):
+        """Modification time and size of the file at `location`, or None if the file is missing."""
+        try:
+            stat = os.stat(location)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
         
+    def _read_script(self, location, package, runtime, previous = None):
+        
+        if self.watcher: self.watcher.add(location)         # start watching before reading, so that no modification is missed
+        signature = self._signature(location)
         script = open(location).read()
         
-        module = self.cache[location] = runtime.translate(script, location, package)
-        module.location = location
-        module.package = package
+        module = HyModule(runtime = runtime, script = script, filename = location, package = package, location = location)
+        ast = runtime.parse(script, module, previous.ast if previous else None, runtime.incremental)
         
+        if self.graph: self.graph.clear(location)           # imports are recorded anew during translation
+        self.cache[location] = module.translate(runtime.import_builtins(location, package), None, ast)
+        self.stamps[location] = [signature, time.monotonic()]
         return module
         
     
@@ -310,35 +755,103 @@ class Runtime:
     _builtins = None
 
     language = None     # target language the documents will be compiled into, defined in subclasses
-    #compact  = True    # if True, compactification is performed after analysis: pure (static, constant) nodes are replaced with their pre-computed render() values,
-                        # which are returned on all subsequent render() requests; this improves performance when
-                        # a document contains many static parts and variables occur rarely
+    compact  = True     # if True, compactification is performed after analysis: pure (static, constant) blocks are replaced with their pre-computed
+                        # output, which is returned on all subsequent translate() and render() requests; this improves performance when
+                        # a document contains many static parts and variables occur rarely (see HypertagAST.compactify())
+    hoist    = False    # if True, the interpreter caches values of loop-invariant expressions and blocks during execution of a loop;
+                        # assumes that member access and iteration have no side effects, which is not true for stateful iterators
+                        # or generators, hence disabled by default (see NODES.loop_block)
     escape   = None     # escaping function or static method that converts plaintext to target language; typically, when assigned
                         # in a subclass, staticmethod() must be applied as a wrapper to prevent this attr be treated as a regular method:
                         #   escape = staticmethod(custom_function)
 
     loaders  = None     # list of Module subclasses whose static load() is called in sequence to find the first one
                         # that is able to locate and load a module by a given path
+    graph    = None     # ImportGraph of the modules imported by scripts, shared with the loaders
+    cache    = None     # optional ScriptCache for persistent storage of parsed scripts (ASTs) on disk
+    backend  = 'interpreter'    # how ASTs are translated: 'interpreter' (nodes' translate() is called recursively)
+                                # or 'compiler' (AST is converted to Python code first, see hypertag.core.compiler)
+    direct   = None     # with the 'compiler' backend, render() can output a string directly, without DOM construction:
+                        # None - when static analysis shows that no DOM is needed; True - always; False - never
+    
+    parser   = 'parsimonious'   # how scripts are parsed: 'parsimonious' (a generic PEG parser driven by the grammar in hypertag.core.grammar,
+                                # followed by rewriting of its AST) or 'native' (a hand-written, faster parser, see hypertag.core.parser)
+    
+    incremental = False         # if True, compiled templates and scripts loaded by HyLoader keep pickled copies of their top-level blocks,
+                                # so that a modified script can be re-parsed incrementally: Template.recompile(), HyLoader.reload()
+    
+    BACKENDS = ('interpreter', 'compiler')
+    PARSERS  = ('parsimonious', 'native')
     
     default_loaders = [HyLoader, PyLoader]      # loaders to be used when no others are passed to __init__
     
     
-    def __init__(self, loaders = None):
+    def __init__(self, loaders = None, cache = None, backend = None, direct = None, compact = None, parser = None, incremental = None,
+                 hoist = None):
+        """
+        :param loaders: list of Loader classes or instances to be used instead of `default_loaders`
+        :param cache: ScriptCache instance, or a path to a folder where parsed scripts will be cached,
+                      or True to store the cache in __pycache__ folders next to script files (like Python does);
+                      None or False disables caching
+        :param backend: 'interpreter' or 'compiler'; overrides the class-level default `backend`
+        :param direct: True or False; overrides the class-level default `direct`;
+                       with direct=True, tags that need a DOM receive a flat DOM of DOM.Text nodes as the body
+        :param compact: True or False; overrides the class-level default `compact`
+        :param parser: 'parsimonious' or 'native'; overrides the class-level default `parser`
+        :param incremental: True or False; overrides the class-level default `incremental`
+        :param hoist: True or False; overrides the class-level default `hoist`
+        """
+        if backend:
+            if backend not in self.BACKENDS: raise ValueError("unknown backend '%s', expected one of: %s" % (backend, ', '.join(self.BACKENDS)))
+            self.backend = backend
+        if direct is not None:
+            self.direct = direct
+        if compact is not None:
+            self.compact = compact
+        if parser:
+            if parser not in self.PARSERS: raise ValueError("unknown parser '%s', expected one of: %s" % (parser, ', '.join(self.PARSERS)))
+            self.parser = parser
+        if incremental is not None:
+            self.incremental = incremental
+        if hoist is not None:
+            self.hoist = hoist
+        
         self.loaders = loaders or self.default_loaders
         self.loaders = [loader if isinstance(loader, Loader) else loader() for loader in self.loaders]
-
-    def import_builtins(self):
+        
+        self.graph = ImportGraph()
+        for loader in self.loaders:
+            loader.graph = self.graph
+        
+        if cache is True:
+            cache = ScriptCache()
+        elif cache and not isinstance(cache, ScriptCache):
+            cache = ScriptCache(cache)
+        self.cache = cache or None
+
+    def __getstate__(self):
+        """Built-in symbols are imported anew after unpickling."""
+        state = self.__dict__.copy()
+        state.pop('_builtins', None)
+        return state
+
+    def import_builtins(self, __file__ = None, __package__ = None):
         """
         Import default symbols that shall be available to every script upon startup.
         This typically means all general-purpose symbols + standard tags/variables specific for a target language.
+        Special variables, $__file__ and $__package__, are included, too.
         """
         if self._builtins is None:
-            self._builtins = {}
+            symbols = {}
             for path in self.BUILTINS:
                 module = self.import_module(path, RootModule(), None)
-                self._builtins.update(module.symbols)
+                symbols.update(module.symbols)
+            self._builtins = symbols            # assigned when complete, for concurrent threads
                 
-        return dict(self._builtins)
+        builtins = dict(self._builtins)
+        builtins[VAR('__file__')]    = __file__
+        builtins[VAR('__package__')] = __package__
+        return builtins
         
     def import_module(self, path, referrer, ast_node):
         """Import symbols that are defined in a module identified by `path`. Return as an instance of Module."""
@@ -347,17 +860,59 @@ class Runtime:
 
         for loader in self.loaders:
             module = loader.load(path, referrer, self)
-            if module: return module
+            if module:
+                referrer_key = referrer.location or referrer.key
+                if referrer_key and module.location:
+                    self.graph.add(referrer_key, module.location)
+                if referrer.imports is not None:
+                    referrer.imports[path] = (loader, module)
+                return module
 
         raise ModuleNotFoundEx("import path not found '%s', try setting __package__ or __file__ when calling render()" % path, ast_node)
         
+    def invalidate(self, location):
+        """
+        Remove the module of a given `location` from the caches of all loaders, together with all modules that import it,
+        directly or indirectly. Return a list of locations of the modules removed.
+        """
+        return [loc for loader in self.loaders for loc in loader.invalidate(location)]
+        
+    def preload(self, locations = None):
+        """
+        Load modules of given `locations` (e.g., file paths of scripts for HyLoader), or of all locations from the import graph
+        if None, so that subsequent imports are served from the loaders' caches. Modules are loaded in topological order
+        of the import graph, with every module going after the modules it imports. Return a list of the modules loaded.
+        Locations that can't be loaded by any of the loaders are skipped.
+        """
+        modules = []
+        for location in self.graph.order(locations):
+            for loader in self.loaders:
+                module = loader.load_location(location, self)
+                if module:
+                    modules.append(module)
+                    break
+        return modules
+        
+    def parse(self, script, module, previous = None, incremental = False):
+        """
+        Parse a given script to a HypertagAST, or load the AST from cache if available.
+        Top-level blocks of the `previous` AST, parsed from an earlier version of the script, are reused if possible,
+        see HypertagAST.__init__(); in such case, the cache is not used for loading. With incremental=True, the AST
+        keeps pickled copies of its top-level blocks for later reuse; an AST loaded from the cache does not keep them.
+        """
+        if self.cache and not previous:
+            ast = self.cache.load(script, module)
+            if ast: return ast
+            
+        ast = HypertagAST(script, module, previous = previous, incremental = incremental)
+        if self.cache:
+            self.cache.store(script, module, ast)
+        return ast
+        
     def translate(self, __script__, __file__ = None, __package__ = None, __tags__ = None, **variables):
         """Parse a given script, translate to a DOM tree, and return wrapped up in a HyModule instance."""
         
-        builtins = self.import_builtins()
-        builtins[VAR('__file__')]    = __file__
-        builtins[VAR('__package__')] = __package__
-        
+        builtins = self.import_builtins(__file__, __package__)
         module = HyModule(runtime = self, script = __script__, filename = __file__, package  = __package__)
         module.translate(builtins, __tags__, **variables)
         
@@ -365,7 +920,36 @@ class Runtime:
         
     def render(self, __script__, __file__ = None, __package__ = None, __tags__ = None, **variables):
         
-        module = self.translate(__script__, __file__, __package__, __tags__, **variables)
-        return module.dom.render()
+        builtins = self.import_builtins(__file__, __package__)
+        module = HyModule(runtime = self, script = __script__, filename = __file__, package  = __package__)
+        return module.render(builtins, __tags__, **variables)
+        
+    def render_iter(self, __script__, __file__ = None, __package__ = None, __tags__ = None, **variables):
+        """
+        Like render(), but returns an iterator of output chunks that concatenate to the rendered document.
+        With the "compiler" backend, chunks are produced incrementally during translation, so that large documents can be
+        sent to a client piece by piece, without holding the entire output in memory (see HypertagAST.render_iter()).
+        """
+        builtins = self.import_builtins(__file__, __package__)
+        module = HyModule(runtime = self, script = __script__, filename = __file__, package  = __package__)
+        return module.render_iter(builtins, __tags__, **variables)
+        
+    async def render_async(self, __script__, __file__ = None, __package__ = None, __tags__ = None, **variables):
+        """
+        Like render(), but a coroutine to be awaited inside an event loop, e.g., in an ASGI application.
+        Context variables can be awaitables or asynchronous iterables, and with the "compiler" backend,
+        results of function calls inside the script are awaited if awaitable, and `for` blocks iterate
+        over asynchronous iterables (see HypertagAST.render_async()).
+        """
+        builtins = self.import_builtins(__file__, __package__)
+        module = HyModule(runtime = self, script = __script__, filename = __file__, package  = __package__)
+        return await module.render_async(builtins, __tags__, **variables)
+        
+    def compile(self, __script__, __file__ = None, __package__ = None):
+        """
+        Parse a given script and return as a Template that can be translated or rendered many times,
+        with different variables, without repeated parsing.
+        """
+        return Template(self, __script__, __file__, __package__)
         
 
@@ -207,6 +207,19 @@ class Context(MultiDict):
     in_prolog = True        # True inside the document prolog, i.e., from the document beginning till the first block
                             # different than a context specification or a comment
     
+    frames = None           # stack of sizes of the frames being allocated: of the document, and of the (nested) hypertag definitions
+                            # that enclose the current node; a frame is pushed and popped directly by <xblock_def> nodes during analyse()
+    
+    def __init__(self):
+        super(Context, self).__init__()
+        self.frames = [0]
+        
+    def allocate(self):
+        """Allocate a position for a new slot in the top-most frame. Return (level, index) of the slot."""
+        index = self.frames[-1]
+        self.frames[-1] += 1
+        return len(self.frames) - 1, index
+    
     def add_refdepth(self, d, symbol = None):
         """Update self.ref_depth with the depth of one more definition of a variable/hypertag.
         'symbol': optional name of the variable/hypertag being referenced, for debugging.
@@ -349,42 +362,39 @@ class Context(MultiDict):
 #####  STATE
 #####
 
-# UNDEFINED = ('UNDEFINED',)      # token that marks a variable hasn't been assigned a value, yet; similar to Python:
-#                                 # UnboundLocalError: local variable 'x' referenced before assignment
+UNDEFINED = ('UNDEFINED',)      # token that marks a slot hasn't been assigned a value, yet; similar to Python:
+                                # UnboundLocalError: local variable 'x' referenced before assignment
+MISSING   = ('MISSING',)        # token that marks a hypertag attribute whose value is not known in advance: it was not passed
+                                # by the caller, and its default value must be computed on every call
 
 class State:
     """
-    State of translation/rendering, as a dict of Slots and their current values.
-    Substitute for a Stack when keeping a history of frames is not necessary and values can be indexed
-    by nodes of an AST instead of integer positions in a stack. State class resembles Context more than Stack.
+    State of translation/rendering: a frame of values of slots, as a list indexed by Slot.index, plus a link
+    to the parent frame. The document is translated in a single frame (level 0), and every expansion of a native hypertag
+    creates a new frame whose parent is the frame where the hypertag was defined (lexical scoping), so that recursive
+    and concurrent expansions don't overwrite each other's values. A slot's value is kept in the frame at Slot.level.
     """
-    values = None       # dict of (slot, value) pairs
+    values  = None      # list of values of slots in this frame; UNDEFINED for slots that have not been assigned yet
+    parent  = None      # State of the enclosing frame; None for the document's frame
+    level   = 0         # no. of frames above this one: 0 for the document, 1 for a hypertag defined at the top level, etc.
+    globals = None      # dict of global symbols (built-ins) and their values, assigned to slots when translation begins
+    context = None      # dict of symbols passed by the caller as a dynamic context, for `context` blocks
+    flat    = False     # True if the output DOM is only rendered, never returned to the caller, so that hypertags can be expanded
+                        # without wrapper nodes, see NODES.xtag_expand.inline
     
     # current indentation string, as a combination of ' ' and '\t' characters;
     # initial \n is used to mark that an indentation is absolute rather than relative to a parent node
     indentation = '\n'
     
-    def __init__(self, values = None):
-        self.values = values.copy() if values else {}   #odict()
-
-    def __contains__(self, slot):
-        return slot in self.values
+    def __init__(self, size = 0, parent = None):
+        """Create a frame of `size` slots on top of a `parent` frame, or a document's frame if parent is None."""
+        self.values = [UNDEFINED] * size
+        if parent is not None:
+            self.parent  = parent
+            self.level   = parent.level + 1
+            self.globals = parent.globals
+            self.context = parent.context
 
-    def __getitem__(self, slot):
-        return self.values[slot]
-
-    def __setitem__(self, slot, value):
-        #assert slot not in self.values     # this assert is not true inside "for" loops
-        self.values[slot] = value
-        
-    def copy(self):
-        dup = State()
-        dup.values = self.values.copy()
-        return dup
-        
-    def update(self, values):
-        self.values.update(values)
-        
     def indent(self, whitechar):
         self.indentation += whitechar
     
@@ -392,28 +402,16 @@ class State:
         assert self.indentation[-1] == whitechar, 'Trying to dedent a different character than was appended'
         self.indentation = self.indentation[:-1]
     
-    # def savepoint(self):
-    #     return len(self.values)
-    #
-    # def rollback(self, savepoint):
-    #     """
-    #     Does NOT rollback indentation, which must always be reset manually through dedent().
-    #     """
-    #     size = len(self.values)
-    #     if size == savepoint: return
-    #     if size < savepoint: raise Exception("State.rollback(), can't rollback to a point (%s) that is higher than the current size (%s)" % (savepoint, size))
-    #     for _ in range(size - savepoint):
-    #         self.values.popitem()
-    
     
 class Slot:
     """
     Representation of a variable or a tag for assignments.
-    Slot instances are used as keys inside `state` during translation to uniquely identify variables and tags.
+    Every slot is a fixed position, (level, index), inside the list-backed frames (State) used during translation:
+    `level` selects the frame - the current one or one of its parents - and `index` the position in its `values`.
     Slots do NOT hold values by themselves (!), they only indicate where to save a current value inside `state`.
     
-    Created during analysis of definition / assignment / import blocks; provides global identification
-    of a symbol inside `state` during translation; enables correct name scoping and dynamic re-assignment of the actual
+    Created during analysis of definition / assignment / import blocks, when the position is allocated in the frame
+    of the enclosing hypertag definition; enables correct name scoping and dynamic re-assignment of the actual
     value or reference during translate(), so that imports and hypertag definitions can be placed inside
     control blocks (i.e., dynamic name resolution of hypertags and imported symbols is possible).
     """
@@ -423,12 +421,15 @@ class Slot:
     primary = None      # 1st definition of this symbol, if self represents a re-assignment (override)
     depth   = None      # ctx.regular_depth of this slot, for correct identification of re-assignments that occur
                         # at the same depth (in the same namespace)
+    level   = None      # level of the frame (State) that holds the value of this slot: no. of hypertag definitions enclosing the slot
+    index   = None      # position of this slot's value in State.values of the frame
     
     def __init__(self, symbol, ctx):
         assert len(symbol) >= 2 and symbol[0] in '$%'
         self.name   = symbol[1:]
         self.symbol = symbol
         self.depth  = ctx.regular_depth
+        self.level, self.index = ctx.allocate()
 
         link = ctx.get(symbol)
         
@@ -441,11 +442,18 @@ class Slot:
         ctx.push(symbol, self)
         
     def set(self, state, value):
-        state[self.primary or self] = value
+        """Assign `value` in the frame of this slot: `state` or one of its parents. KeyError if the frame is not accessible from `state`."""
+        while state.level > self.level: state = state.parent
+        if state.level != self.level: raise KeyError(self.symbol)
+        state.values[self.index] = value
         
     def get(self, state):
         """Raises KeyError if this slot is uninitialized in `state`."""
-        return state[self.primary or self]
+        while state.level > self.level: state = state.parent
+        if state.level != self.level: raise KeyError(self.symbol)
+        value = state.values[self.index]
+        if value is UNDEFINED: raise KeyError(self.symbol)
+        return value
     
 
 class ValueSlot(Slot):
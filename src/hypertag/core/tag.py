@@ -17,8 +17,12 @@ class Tag:
     """
     name = None         # [str] name that indentifies this tag in a DOM and can be used in DOM selectors
     
-    pure = True         # if True, the tag is assumed to always return the same result for the same arguments (no side effects),
-                        # which enables caching of expand() calls and compactification of DOM nodes tagged with this tag
+    pure = False        # if True, the tag is assumed to always return the same result for the same arguments (no side effects),
+                        # which enables caching of expand() calls and compactification of DOM nodes tagged with this tag;
+                        # must be declared explicitly by subclasses, as a tag that's wrongly assumed pure is rendered only once
+    
+    dom = True          # if False, expand() only calls body.render() and never inspects the DOM structure of the body,
+                        # so the tag can be expanded during direct-to-string rendering, when no DOM is constructed
     
     def expand(self, body, attrs, kwattrs):
         """
@@ -34,6 +38,16 @@ class Tag:
         """
         raise NotImplementedError
 
+    def split(self, attrs, kwattrs):
+        """
+        Support for streamed rendering, where the body is rendered incrementally and never passed to expand() as a whole.
+        If the output of expand() consists of a fixed head and tail with the rendered body placed in between
+        - and a newline inserted before the tail if the body starts with a newline, like in markup tags -
+        this method should return the pair of strings: (head, tail). Otherwise, None should be returned (default).
+        Void tags should return None, as well. Invalid attributes should be reported like in expand().
+        """
+        return None
+
     def __call__(self, body_string = None, *attrs, **kwattrs):
         """
         Wrapper around expand() to let the tag be used like a function and to allow its direct rendering,
@@ -47,12 +61,16 @@ class Tag:
 ########################################################################################################################################################
 
 class TagFunction(Tag):
-    """A wrapper that creates a Tag instance from a function. The `body` attribute is passed as a string to the function."""
+    """
+    A wrapper that creates a Tag instance from a function. The `body` attribute is passed as a string to the function.
+    With pure=True, the function is declared to always return the same result for the same arguments, see Tag.pure.
+    """
     
-    def __init__(self, fun, dom = False):
+    def __init__(self, fun, dom = False, pure = False):
         self.fun  = fun
         self.name = fun.__name__
         self.dom  = dom
+        self.pure = pure
     
     def expand(self, body, attrs, kwattrs):
         if not self.dom: body = body.render()
@@ -63,6 +81,8 @@ class Null(Tag):
     """Null tag '.' is represented in the DOM tree. Its expand() passes the body unchanged."""
     
     name = 'null'
+    dom  = False
+    pure = True
     
     def expand(self, body, attrs, kwattrs):
         return body.render()
@@ -85,6 +105,8 @@ class Markup(Tag):
     name = None         # tag <name> to be printed into markup; may differ from the Hypertag name used inside a script (!)
     void = False        # True if this tag is void: the `body` in expand() should be empty and the element is rendered as self-closing: <NAME />
     mode = 'HTML'       # (X)HMTL compatibility mode: either 'HTML' or 'XHTML'
+    dom  = False
+    pure = True
     
     def __init__(self, name = None, void = False, mode = 'HTML'):
         if name: self.name = name
@@ -96,12 +118,14 @@ class Markup(Tag):
         if attrs: raise TypeErrorEx("markup tag '%s' does not accept positional attributes" % self.name)
         return self._expand(self.name, body, kwattrs)
         
+    def split(self, attrs, kwattrs):
+        
+        if attrs: raise TypeErrorEx("markup tag '%s' does not accept positional attributes" % self.name)
+        return self._split(self.name, kwattrs)
+        
     def _expand(self, name, body, kwattrs):
         
-        # render attributes
-        kwattrs = filter(None, map(self._render_attr, kwattrs.items()))
-        tag = ' '.join([name] + list(kwattrs))
-
+        tag  = self._tag(name, kwattrs)
         body = body.render()
         
         # render output
@@ -114,6 +138,15 @@ class Markup(Tag):
             nl = '\n' if body[:1] == '\n' else ''
             return "<%s>" % tag + body + nl + "</%s>" % name
 
+    def _split(self, name, kwattrs):
+        if self.void: return None
+        return "<%s>" % self._tag(name, kwattrs), "</%s>" % name
+        
+    def _tag(self, name, kwattrs):
+        """Contents of the opening tag: name and rendered attributes."""
+        kwattrs = filter(None, map(self._render_attr, kwattrs.items()))
+        return ' '.join([name] + list(kwattrs))
+
     def _render_attr(self, name_value):
         
         name, value = name_value
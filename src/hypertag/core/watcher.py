@@ -0,0 +1,185 @@
+"""
+Background watchers of script files that push invalidation of cached modules to a loader as soon as a file changes,
+so that the loader itself does not need to check the files (os.stat) on every import.
+
+@author:  Marcin Wojnarski
+"""
+
+import os, sys, struct, select, threading, ctypes, ctypes.util
+
+
+#####################################################################################################################################################
+#####
+#####  WATCHERS
+#####
+
+class Watcher:
+    """
+    Base class for watchers. A watcher runs a daemon thread that monitors the files of scripts added with add(),
+    and calls `callback(location)` for every location whose file was modified, replaced, or removed.
+    Use Watcher.create() to instantiate the best watcher available on the current platform.
+    """
+
+    callback  = None    # function to be called with a location of every modified file; called from the watcher's thread
+    locations = None    # dict of {absolute file path: location} of the watched scripts
+
+    def __init__(self, callback):
+        self.callback  = callback
+        self.locations = {}
+        self._lock     = threading.Lock()
+        self._thread   = threading.Thread(target = self._run, name = self.__class__.__name__, daemon = True)
+        self._thread.start()
+
+    @staticmethod
+    def create(callback, interval = 1.0):
+        """Return an InotifyWatcher on Linux, or a PollingWatcher that checks the files every `interval` seconds otherwise."""
+        if InotifyWatcher.available():
+            return InotifyWatcher(callback)
+        return PollingWatcher(callback, interval)
+
+    def add(self, location):
+        """Start watching the file of a given `location`. Should be called *before* the file is read."""
+        with self._lock:
+            self.locations[os.path.abspath(location)] = location
+
+    def stop(self):
+        """Stop the watcher's thread and wait until it finishes."""
+        self._stop()
+        self._thread.join()
+
+    def _notify(self, path):
+        location = self.locations.get(path)
+        if location is not None:
+            self.callback(location)
+
+    def _run(self):
+        raise NotImplementedError
+
+    def _stop(self):
+        raise NotImplementedError
+
+
+class InotifyWatcher(Watcher):
+    """
+    Watcher that receives notifications from the Linux kernel (inotify) about changes in the folders of the watched files.
+    The watcher's thread is blocked in select() until an event arrives, so no system calls are made while files don't change.
+    """
+
+    # event types that indicate a modification of a file inside a watched folder, see `man inotify`
+    IN_MODIFY       = 0x00000002
+    IN_ATTRIB       = 0x00000004
+    IN_CLOSE_WRITE  = 0x00000008
+    IN_MOVED_FROM   = 0x00000040
+    IN_MOVED_TO     = 0x00000080
+    IN_CREATE       = 0x00000100
+    IN_DELETE       = 0x00000200
+    IN_NONBLOCK     = os.O_NONBLOCK
+    IN_CLOEXEC      = getattr(os, 'O_CLOEXEC', 0)
+
+    MASK  = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    EVENT = struct.Struct('iIII')       # header of struct inotify_event: wd, mask, cookie, len; followed by `len` bytes of name
+
+    _libc = None        # C library with inotify functions, loaded on first use
+
+    @classmethod
+    def available(cls):
+        if not sys.platform.startswith('linux'): return False
+        if cls._libc is None:
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno = True)
+                libc.inotify_init1, libc.inotify_add_watch
+                cls._libc = libc
+            except (OSError, AttributeError):
+                cls._libc = False
+        return bool(cls._libc)
+
+    def __init__(self, callback):
+        self.folders = {}                       # dict of {watch descriptor: absolute folder path}
+        self._fd = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self._fd < 0: raise OSError(ctypes.get_errno(), "inotify_init1() failed")
+        self._wake = os.pipe()                  # written to by stop() to wake up the thread blocked in select()
+        super(InotifyWatcher, self).__init__(callback)
+
+    def add(self, location):
+        folder = os.path.dirname(os.path.abspath(location))
+        with self._lock:
+            if folder not in self.folders.values():
+                wd = self._libc.inotify_add_watch(self._fd, os.fsencode(folder), self.MASK)
+                if wd < 0: raise OSError(ctypes.get_errno(), "inotify_add_watch() failed for %s" % folder)
+                self.folders[wd] = folder
+        super(InotifyWatcher, self).add(location)
+
+    def _stop(self):
+        os.write(self._wake[1], b'x')
+
+    def _run(self):
+        try:
+            while True:
+                ready, _, _ = select.select([self._fd, self._wake[0]], [], [])
+                if self._wake[0] in ready: break
+                try:
+                    data = os.read(self._fd, 64 * 1024)
+                except BlockingIOError:
+                    continue
+                for path in self._paths(data):
+                    self._notify(path)
+        finally:
+            os.close(self._fd)
+            for fd in self._wake: os.close(fd)
+
+    def _paths(self, data):
+        """Decode a buffer of inotify events and return a list of absolute paths of the files affected."""
+        paths, pos = [], 0
+        while pos < len(data):
+            wd, mask, cookie, length = self.EVENT.unpack_from(data, pos)
+            pos += self.EVENT.size
+            name = data[pos : pos + length].rstrip(b'\0')
+            pos += length
+            folder = self.folders.get(wd)
+            if folder and name:
+                paths.append(os.path.join(folder, os.fsdecode(name)))
+        return paths
+
+
+class PollingWatcher(Watcher):
+    """
+    Portable watcher that checks modification times and sizes of the watched files every `interval` seconds.
+    The checks are made in the watcher's thread, not during imports.
+    """
+
+    interval   = None   # time in seconds between two checks of all files
+    signatures = None   # dict of {absolute file path: (mtime, size)} from the last check
+
+    def __init__(self, callback, interval = 1.0):
+        self.interval   = interval
+        self.signatures = {}
+        self._stopped   = threading.Event()
+        super(PollingWatcher, self).__init__(callback)
+
+    def add(self, location):
+        path = os.path.abspath(location)
+        with self._lock:
+            self.signatures[path] = self._signature(path)
+        super(PollingWatcher, self).add(location)
+
+    def _stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            with self._lock:
+                signatures = list(self.signatures.items())
+            for path, signature in signatures:
+                current = self._signature(path)
+                if current != signature:
+                    self.signatures[path] = current
+                    self._notify(path)
+
+    @staticmethod
+    def _signature(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
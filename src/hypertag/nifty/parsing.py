@@ -6,6 +6,7 @@ LICENSE: MIT
 '''
 
 import copy
+from bisect import bisect_right
 from .util import isstring, escape, flatten
 
 
@@ -27,9 +28,7 @@ class ParserError(Exception):
         if node:
             self.node, self.pos, self.text = node, node.pos, node.text(self.MAXLEN)
         if self.pos:                                            # calculate the line number and column of self.pos, if possible
-            prefix = node.fulltext[:self.pos[1]]
-            self.line = prefix.count('\n') + 1
-            self.column = len(prefix) - prefix.rfind('\n')
+            self.line, self.column = node.locate(self.pos[1])
         msg = self.make_msg(msg) or msg
         if cause: msg += " because of %s: %s" % (type(cause).__name__, cause)
         super(ParserError, self).__init__(msg)
@@ -66,6 +65,7 @@ class Tree(object):
     text    = None              # full text of the input string fed to the parser
     ast     = None              # raw AST generated by the parser; for read access by the client
     root    = None              # root node of the final tree after rewriting
+    offsets = None              # positions in `text` where subsequent lines begin; created on the first call to locate()
     
     def __init__(self, text = None, ast = None, stopAfter = None):
         """Build Tree, either from input 'text' (will be parsed to raw AST and then rewritten to Tree), 
@@ -81,6 +81,7 @@ class Tree(object):
         self._compact_ = _split(self._compact_)
         
         self.text = text
+        self.offsets = None
         self.ast = self.parse(text) if text else ast                # parse input text to raw AST; keep AST for reference by the client
         if stopAfter == "parse": return
         
@@ -104,6 +105,23 @@ class Tree(object):
         if isstring(node): return prefix + node
         return prefix + node.info(), [Tree.info(n, depth+1) for n in node.children]
 
+    def locate(self, pos):
+        """
+        Line number and column (both 1-based) of a given position in self.text. The lines are found by bisection
+        in a table of line offsets, which is built once, so the cost doesn't depend on how far in the text `pos` is.
+        """
+        if self.offsets is None:
+            text = self.text or ''
+            offsets = [0]
+            start = text.find('\n')
+            while start >= 0:
+                offsets.append(start + 1)
+                start = text.find('\n', start + 1)
+            self.offsets = offsets
+        
+        line = bisect_right(self.offsets, pos)
+        return line, pos - self.offsets[line - 1] + 1
+
     def parse(self, text):
         "Parses raw text (string) into a syntax tree built of custom node classes (self.Tree). Can be overridden in subclasses."
         return self.parser.parse(text)
@@ -153,17 +171,21 @@ class Tree(object):
         
         @property
         def line(self):
-            """
-            Line number in `fulltext` where this node's match begins.
-            NOTE: this method scans all fulltext up to self.pos, which can be costly.
-            """
-            prefix = self.fulltext[:self.pos[0]]
-            return prefix.count('\n') + 1
+            """Line number in `fulltext` where this node's match begins."""
+            return self.locate(self.pos[0])[0]
 
         @property
         def column(self):
-            prefix = self.fulltext[:self.pos[0]]
-            return len(prefix) - prefix.rfind('\n')
+            """Column in `fulltext` where this node's match begins."""
+            return self.locate(self.pos[0])[1]
+
+        def locate(self, pos):
+            """(line, column) of a position in `fulltext`. Uses the tree's table of line offsets (Tree.locate()) if possible."""
+            tree = self.tree
+            if tree is not None and tree.text is self.fulltext:
+                return tree.locate(pos)
+            prefix = self.fulltext[:pos]
+            return prefix.count('\n') + 1, len(prefix) - prefix.rfind('\n')
 
         def __init__(self, tree, astnode): 
             self.tree = tree
@@ -187,9 +209,18 @@ class Tree(object):
             """
             
         def _setup_all(self):
-            """Recursive bottom-up initialization of nodes with calls to custom setup() methods, no arguments (!)."""
-            for child in self.children: child._setup_all()
-            self.setup()
+            """
+            Bottom-up initialization of nodes with calls to custom setup() methods, no arguments (!).
+            Children are set up before parents, in the order of a recursive traversal, but with an explicit stack.
+            """
+            order = []                      # pre-order, right-to-left; reversed, it gives a post-order, left-to-right
+            stack = [self]
+            while stack:
+                node = stack.pop()
+                order.append(node)
+                stack.extend(node.children)
+            for node in reversed(order):
+                node.setup()
 
         def text(self, maxlen = None):
             """The substring of source text matched by this node, or its leading 'maxlen' characters if maxlen != None. 
@@ -216,17 +247,18 @@ class Tree(object):
             return self.children[idx] if len(self.children) > idx else None
         
         def _enrich(self):
-            """Recursively enrich nodes with basic semantic information. Called right after rewriting."""
+            """Enrich all nodes of the subtree with basic semantic information. Called right after rewriting. Non-recursive."""
             
-            prev = None
-            for child in self.children:
-                child.parent = self
-                child.sibling_prev = prev
-                if prev: prev.sibling_next = child
-                prev = child
-
-            for child in self.children:
-                child._enrich()
+            nodes = [self]
+            while nodes:
+                node = nodes.pop()
+                prev = None
+                for child in node.children:
+                    child.parent = node
+                    child.sibling_prev = prev
+                    if prev: prev.sibling_next = child
+                    prev = child
+                nodes.extend(node.children)
 
         def analyse(self, ctx):
             """Top-down semantic analysis of the tree. 'ctx' is the opening Context (pre-context) of the current node. 
@@ -304,6 +336,7 @@ class ParsimoniousTree(Tree):
                                 # leaf nodes (static strings) will be removed entirely from the tree, i.e., ignored rather than reduced
     _reduce_string_ = True      # if a node to be reduce has no children but matched a non-empty part of the text, shall it be replaced with a string node
                                 # instead of raising an exception? 
+    _rewritten = None           # during rewrite(): a stack of rewritten subtrees of raw AST nodes that await their parent
 
     class reduced(Tree.string):
         "Like Tree.string, but adapted to reducing Parsimonious AST nodes."
@@ -314,9 +347,33 @@ class ParsimoniousTree(Tree):
         
 
     def rewrite(self, astnode):
+        """
+        Convert a node of raw AST and all its subtree into appropriate subclasses of ``Tree.node``.
+        The subtree is traversed bottom-up with an explicit stack instead of recursion, so that deeply nested input
+        doesn't exhaust the interpreter's stack: rewritten children are pushed onto self._rewritten
+        and popped from there by _rewriteNode() when their parent is created.
+        """
+        if astnode is None: return None
+        order = []                                                  # pre-order, right-to-left; reversed, it gives a post-order, left-to-right
+        stack = [astnode]
+        while stack:
+            node = stack.pop()
+            order.append(node)
+            if node.expr_name not in self._ignore_:                 # subtrees of ignored nodes are dropped without rewriting
+                stack.extend(node.children)
+        
+        rewritten = self._rewritten = []
+        try:
+            for node in reversed(order):
+                rewritten.append(self._rewriteSingle(node))
+            return rewritten.pop()
+        finally:
+            del self._rewritten
+    
+    def _rewriteSingle(self, astnode):
+        "Rewrite a single node of raw AST whose children have been rewritten already."
         def flat(): return self._rewriteNode(astnode)[-1]       # flattening: return children instead of the node
             
-        if astnode is None: return None
         name = astnode.expr_name
         if not name and self._reduce_anonym_: return flat()     # flatten nodes without names; leaf nodes (static strings) removed entirely
         if name in self._ignore_: return []                     # remove nodes listed in _ignore_, together with their subtrees
@@ -327,7 +384,7 @@ class ParsimoniousTree(Tree):
             raise ParserError("Trying to reduce a node that has no children but consumed a non-empty part of the input at position (%s,%s): %s" % 
                               (astnode.start, astnode.end, astnode))
         
-        # find corresponding inner class of the tree and instantiate (this will recursively rewrite nodes down the tree)
+        # find corresponding inner class of the tree and instantiate (children are taken from self._rewritten)
         nodeclass = getattr(self.NODES or self, 'x' + name)
         node = nodeclass(self, astnode)
     
@@ -337,7 +394,13 @@ class ParsimoniousTree(Tree):
         return node
     
     def _rewriteNode(self, astnode):
-        children = flatten(self.rewrite(c) for c in astnode.children)
+        count = len(astnode.children)
+        if count:
+            rewritten = self._rewritten
+            children = flatten(rewritten[-count:])
+            del rewritten[-count:]
+        else:
+            children = []
         return (astnode.start, astnode.end), astnode.expr_name, children        # pos, type, children
     
 
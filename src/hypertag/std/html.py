@@ -63,11 +63,15 @@ class CustomTag(Markup):
     name = "custom"
 
     def expand(self, body, attrs, kwattrs):
+        return self._expand(self._name(attrs), body, kwattrs)
+
+    def split(self, attrs, kwattrs):
+        return self._split(self._name(attrs), kwattrs)
+        
+    def _name(self, attrs):
         if not attrs: raise TypeErrorEx("the %%custom tag requires a positional attribute with a desired output name of a tag")
         if len(attrs) > 1: raise TypeErrorEx("the %%custom tag accepts exactly one positional attribute, not %s" % len(attrs))
-        
-        name = attrs[0]
-        return self._expand(name, body, kwattrs)
+        return attrs[0]
 
         
 register.tag(CustomTag())
@@ -92,5 +96,9 @@ class comment(Markup):
         # a newline is added at the end, otherwise
         nl = '\n' if body[:1] == '\n' else ''
         return "<!--" + body + nl + "-->"
+
+    def split(self, attrs, kwattrs):
+        if attrs or kwattrs: raise TypeErrorEx("'comment' tag does not accept attributes")
+        return "<!--", "-->"
     
     
\ No newline at end of file
@@ -12,13 +12,14 @@ class Registry:
     def tag(self, obj):
         """
         Register a given object (Tag subclass, Tag instance, tag function), as a tag by adding to self.tags.
-        Tag subclasses are instantiated before adding to self.tags. Functions are wrapped up in TagFunction.
+        Tag subclasses are instantiated before adding to self.tags. Functions are wrapped up in TagFunction
+        and declared pure: all standard tag functions return the same output for the same body and attributes.
         """
         if isinstance(obj, type):           # instantiate tag classes
             tag  = obj()
             name = tag.name
         elif isfunction(obj):
-            tag  = TagFunction(obj)
+            tag  = TagFunction(obj, pure = True)
             name = obj.__name__
         else:
             tag  = obj
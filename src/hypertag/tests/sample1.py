@@ -4,3 +4,19 @@ x = 155
 def f(a):
     return a * x
 
+
+
+from hypertag.core.tag import Tag
+
+class Stamp(Tag):
+    """An impure tag: outputs the body followed by a counter of expansions."""
+    name  = 'stamp'
+    dom   = False
+    count = 0
+    
+    def expand(self, body, attrs, kwattrs):
+        out = body.render() + str(self.count)
+        self.count += 1
+        return out
+
+__tags__ = {'stamp': Stamp()}
@@ -0,0 +1,203 @@
+"""
+Performance benchmarks of Hypertag. Not a part of the test suite, run manually from the root project folder:
+$
+$  python3 -m tests.benchmark [NAME ...]
+$
+Every benchmark prints a table of timings. Absolute numbers depend on the machine, only their relations are meaningful.
+"""
+
+import sys, time, gc
+from textwrap import dedent
+
+from hypertag import HyperHTML
+
+
+#####################################################################################################################################################
+#####
+#####  UTILITIES
+#####
+
+def timeit(fun, repeat = 5):
+    """Minimum wall time of `repeat` calls to fun(), in seconds. Garbage collection is disabled during measurement."""
+    best = None
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fun()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+    finally:
+        if enabled: gc.enable()
+    return best
+
+# sample page of a web application, for parsing benchmarks
+PAGE = """
+    %Item @body name price tags=()
+        li .item
+            b | $name
+            | costs {price * 1.23 : round(2)} {'(on sale)' if price < 10 else ''}
+            for tag in tags:
+                i .tag #$tag | $tag
+            @ body
+    div .catalog
+        if items
+            ul
+                for name, price in items
+                    Item name price tags=['a', 'b']
+                        ! <hr>
+        else
+            p | No items.
+"""
+
+
+#####################################################################################################################################################
+#####
+#####  BENCHMARKS
+#####
+
+def bench_text_blocks(sizes = (100, 1000, 5000, 20000)):
+    """
+    Rendering of scripts that consist of N text blocks, with the interpreter backend, which computes the column
+    of every text block on each render. The cost per block should stay flat as the script grows.
+    """
+    print("%8s %12s %14s" % ('blocks', 'render [ms]', 'per block [us]'))
+    for N in sizes:
+        script = "context $x\n" + ''.join("div\n    | line %d $x\n" % i for i in range(N))
+        template = HyperHTML(backend = 'interpreter').compile(script)
+        elapsed = timeit(lambda: template.render(x = 1), repeat = 3)
+        print("%8d %12.1f %14.2f" % (N, elapsed * 1000, elapsed / N * 1e6))
+
+def bench_positions(sizes = (100, 1000, 5000, 20000)):
+    """
+    Lookup of (line, column) source positions of all text blocks in a script of N blocks, as done when reporting errors.
+    The cost per lookup should stay flat as the script grows.
+    """
+    from hypertag.core.ast import NODES
+    print("%8s %12s %14s" % ('blocks', 'lookup [ms]', 'per block [us]'))
+    for N in sizes:
+        script = "context $x\n" + ''.join("div\n    | line %d $x\n" % i for i in range(N))
+        ast = HyperHTML(backend = 'interpreter').compile(script).ast
+        blocks, stack = [], [ast.root]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, NODES.block_text): blocks.append(node)
+            stack.extend(node.children or ())
+        elapsed = timeit(lambda: [(node.line, node.column) for node in blocks], repeat = 3)
+        print("%8d %12.1f %14.2f" % (N, elapsed * 1000, elapsed / N * 1e6))
+
+def bench_parsing(sizes = (10, 100, 1000)):
+    """
+    Parsing (without analysis) of scripts made of N copies of a sample page (PAGE) with both parsers: Parsimonious and the native one.
+    """
+    from hypertag.core.runtime import HyModule
+    print("%8s %16s %12s %8s" % ('pages', 'parsimonious[ms]', 'native[ms]', 'speedup'))
+    for N in sizes:
+        script = "context $items\n" + dedent(PAGE) * N
+        times = []
+        for parser in ('parsimonious', 'native'):
+            runtime = HyperHTML(parser = parser)
+            times.append(timeit(lambda: runtime.parse(script, HyModule(runtime = runtime, script = script)), repeat = 3))
+        print("%8d %16.1f %12.1f %8.1f" % (N, times[0] * 1000, times[1] * 1000, times[0] / times[1]))
+
+def bench_reparse(sizes = (10, 100)):
+    """
+    Parsing of a script made of N copies of the sample page (PAGE) after one block was edited:
+    from scratch vs. incrementally, with unchanged top-level blocks copied from the AST of the previous version.
+    """
+    from hypertag.core.runtime import HyModule
+    print("%8s %13s %16s %16s %8s" % ('pages', 'parser', 'from scratch[ms]', 'incremental[ms]', 'speedup'))
+    for N in sizes:
+        script = "context $items\n" + dedent(PAGE) * N
+        edited = script.replace('No items.', 'No items found.', 1)
+        for parser in ('parsimonious', 'native'):
+            runtime  = HyperHTML(parser = parser)
+            previous = runtime.parse(script, HyModule(runtime = runtime, script = script), incremental = True)
+            full = timeit(lambda: runtime.parse(edited, HyModule(runtime = runtime, script = edited)), repeat = 3)
+            incr = timeit(lambda: runtime.parse(edited, HyModule(runtime = runtime, script = edited), previous), repeat = 3)
+            print("%8d %13s %16.1f %16.1f %8.1f" % (N, parser, full * 1000, incr * 1000, full / incr))
+
+
+def bench_rewrite(sizes = (10, 100)):
+    """
+    Rewriting of a raw Parsimonious AST of N copies of the sample page (PAGE) to NODES, in raw nodes per second:
+    generic ParsimoniousTree.rewrite() vs. HypertagAST.rewrite() with a precomputed dispatch table.
+    """
+    from parsimonious.exceptions import ParseError
+    from hypertag.nifty.parsing import ParsimoniousTree
+    from hypertag.core.ast import HypertagAST
+    from hypertag.core.runtime import HyModule
+    print("%8s %10s %18s %18s %8s" % ('pages', 'raw nodes', 'generic[nodes/s]', 'hypertag[nodes/s]', 'speedup'))
+    for N in sizes:
+        script  = "context $items\n" + dedent(PAGE) * N
+        runtime = HyperHTML()
+        tree    = HypertagAST(script, HyModule(runtime = runtime, script = script))
+        raw     = tree.parser['document'].match_core(tree.text, 0, {}, ParseError(tree.text))
+        count, stack = 0, [raw]
+        while stack:
+            count += 1
+            stack.extend(stack.pop().children)
+        generic  = timeit(lambda: ParsimoniousTree.rewrite(tree, raw), repeat = 3)
+        hypertag = timeit(lambda: tree.rewrite(raw), repeat = 3)
+        print("%8d %10d %18.0f %18.0f %8.1f" % (N, count, count / generic, count / hypertag, generic / hypertag))
+
+def bench_calls(sizes = (1000, 10000)):
+    """
+    Rendering of N calls to small hypertags with positional, keyword and default attributes, with both backends.
+    """
+    script = """
+        context $N
+        %icon name size=16 title='' | i .icon #$name | $size
+        %field @body label value type='text'
+            label | $label
+            input type=$type value=$value
+            @body
+        for i in range(N)
+            icon 'check'
+            icon 'star' size=24
+            field 'Name' value=i
+                | note
+    """
+    print("%8s %13s %12s %14s" % ('calls', 'backend', 'render [ms]', 'per call [us]'))
+    for N in sizes:
+        for backend in ('interpreter', 'compiler'):
+            template = HyperHTML(backend = backend).compile(dedent(script))
+            elapsed  = timeit(lambda: template.render(N = N // 3), repeat = 3)
+            print("%8d %13s %12.1f %14.2f" % (N, backend, elapsed * 1000, elapsed / N * 1e6))
+
+def bench_loops(sizes = (1000, 10000)):
+    """
+    Rendering of a table of N rows whose cells are mostly loop-invariant, with the interpreter backend:
+    without vs. with loop-invariant expressions and blocks cached during the loop (Runtime.hoist).
+    """
+    script = """
+        context $settings
+        context $rows
+        %icon name | i .icon #$name
+        for row in rows
+            tr
+                td | {settings.STATIC_URL + 'logo.png'}
+                td : icon 'check'
+                td | $row
+    """
+    class Settings:
+        STATIC_URL = '/static/'
+    print("%8s %14s %14s %8s" % ('rows', 'plain [ms]', 'hoisted [ms]', 'speedup'))
+    for N in sizes:
+        times = []
+        for hoist in (False, True):
+            template = HyperHTML(backend = 'interpreter', hoist = hoist).compile(dedent(script))
+            times.append(timeit(lambda: template.render(settings = Settings, rows = range(N)), repeat = 3))
+        print("%8d %14.1f %14.1f %8.1f" % (N, times[0] * 1000, times[1] * 1000, times[0] / times[1]))
+
+
+BENCHMARKS = {name[6:]: fun for name, fun in globals().items() if name.startswith('bench_')}
+
+
+if __name__ == '__main__':
+
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        print('\n%s: %s' % (name, BENCHMARKS[name].__doc__.strip().splitlines()[0]))
+        BENCHMARKS[name]()
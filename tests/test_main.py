@@ -8,9 +8,13 @@ $
 """
 
 # import unittest
-import os, re, pytest
+import os, sys, re, gc, pickle, asyncio, threading, pytest
 
-from hypertag import HyperHTML
+from hypertag import HyperHTML, TagFunction
+from hypertag.core.runtime import Runtime, HyModule, HyLoader, PyLoader
+from hypertag.core.ast import NODES, Grammar
+from hypertag.core.watcher import InotifyWatcher
+from hypertag.core.errors import NameErrorEx, SyntaxErrorEx, ModuleNotFoundEx
 
 
 #####################################################################################################################################################
@@ -27,6 +31,12 @@ def merge_spaces(s, pat = re.compile(r'\s+')):
 
 FILE_PKG = {'__file__': __file__, '__package__': __package__}
 
+@pytest.fixture(autouse = True, params = Runtime.BACKENDS)
+def backend(request, monkeypatch):
+    """Every test is executed twice: with the interpreter and with the compiler backend of Runtime."""
+    monkeypatch.setattr(Runtime, 'backend', request.param)
+    return request.param
+
 
 #####################################################################################################################################################
 #####
@@ -1422,8 +1432,7 @@ def test_024_import():
 def test_025_empty_control():
     """
     Empty control blocks (missing body) are considered by Hypertag as syntactically correct.
-    This is necessary for detailed error reporting: method HypertagAST._locate_error() relies on the fact
-    that truncating an arbitrary number of trailing lines of a script never introduces syntax errors
+    As a consequence, truncating an arbitrary number of trailing lines of a script never introduces syntax errors
     unless they already have been present in the preceeding lines.
     """
     src = """
@@ -1681,6 +1690,853 @@ def test_035_expr_block():
     """
     assert render(src).strip() == "{12: '34'}"
 
+def test_036_compile():
+    runtime = HyperHTML()
+    src = """
+        context $name
+        %greet who
+            p | Hello $who
+        greet name
+    """
+    template = runtime.compile(src)
+    assert template.render(name = 'Ala').strip() == "<p>Hello Ala</p>"
+    assert template.render(name = 'Ola').strip() == "<p>Hello Ola</p>"
+    
+    module = template.translate(name = 'kot')
+    assert module.dom.render().strip() == "<p>Hello kot</p>"
+    assert '%greet' in module.symbols
+    
+    with pytest.raises(AttributeError):
+        template.script = "| changed"
+
+def test_037_context_values():
+    src = """
+        context $x, $y as z
+        | {x + z}
+    """
+    template = HyperHTML().compile(src)                 # context values are not needed during compilation
+    assert template.render(x = 1, y = 2).strip() == "3"
+    assert template.render(x = 'a', y = 'b').strip() == "ab"
+    
+    with pytest.raises(Exception, match = "symbol '\\$y' not found in context"):
+        template.render(x = 1)
+
+def test_038_cache_pickle(tmp_path, monkeypatch):
+    from hypertag.core.ast import HypertagAST
+    src = """
+        context $x
+        %H a
+            b | $a
+        for i in range(x):
+            H i
+    """
+    out = "<b>0</b> <b>1</b>"
+    
+    # pickling of a compiled template
+    template = HyperHTML().compile(src)
+    clone = pickle.loads(pickle.dumps(template))
+    assert merge_spaces(clone.render(x = 2)) == out
+    
+    # on-disk cache of parsed scripts; no parsing takes place when the script is found in cache
+    folder = tmp_path / 'cache'
+    assert merge_spaces(HyperHTML(cache = str(folder)).compile(src).render(x = 2)) == out
+    assert len(os.listdir(folder)) == 1
+    
+    calls = []
+    parse = HypertagAST._parse
+    monkeypatch.setattr(HypertagAST, '_parse', lambda self, *args, **kwargs: calls.append(self) or parse(self, *args, **kwargs))
+    assert merge_spaces(HyperHTML(cache = str(folder)).compile(src).render(x = 2)) == out
+    assert calls == []
+    
+    # a modified script is parsed and stored in the cache as a new entry
+    modified = src.replace("b | $a", "u | $a")
+    assert merge_spaces(HyperHTML(cache = str(folder)).compile(modified).render(x = 2)) == "<u>0</u> <u>1</u>"
+    assert len(calls) == 1 and len(os.listdir(folder)) == 2
+    assert merge_spaces(HyperHTML(cache = str(folder)).compile(modified).render(x = 2)) == "<u>0</u> <u>1</u>"
+    assert len(calls) == 1
+    monkeypatch.undo()
+    
+    # failures of storing an entry are treated as cache misses, and no temporary files are left
+    def fail(*args, **kwargs): raise pickle.PicklingError("can't pickle")
+    monkeypatch.setattr(HypertagAST, 'dumps', fail)
+    assert merge_spaces(HyperHTML(cache = str(folder)).compile(src.replace("b | $a", "s | $a")).render(x = 2)) == "<s>0</s> <s>1</s>"
+    monkeypatch.undo()
+    monkeypatch.setattr(pickle, 'dump', fail)                  # fails after the temporary file was created
+    assert merge_spaces(HyperHTML(cache = str(folder)).compile(src.replace("b | $a", "i | $a")).render(x = 2)) == "<i>0</i> <i>1</i>"
+    monkeypatch.undo()
+    assert len(os.listdir(folder)) == 2
+    
+    # scripts imported from files are cached in __pycache__, like Python modules
+    (tmp_path / 'module.hy').write_text("%G x\n    i | $x\n")
+    src = """
+        from .module import %G
+        G 5
+    """
+    runtime = HyperHTML(cache = True)
+    assert runtime.render(src, __file__ = str(tmp_path / 'main.py')).strip() == "<i>5</i>"
+    assert len(os.listdir(tmp_path / '__pycache__')) == 1
+
+
+def test_039_compiler_backend():
+    src = """
+        context $rows
+        %cell @body cls='c'
+            td class=cls
+                @body
+        for r in rows
+            $ n, name = r
+            cell | $n
+            cell cls='x' | {name:str.upper}
+            if n > 1
+                $ big = True
+        | {big}
+    """
+    out = """<td class="c"> 1 </td> <td class="x"> A </td> <td class="c"> 2 </td> <td class="x"> B </td> True"""
+    template = HyperHTML(backend = 'compiler').compile(src)
+    assert template.ast.compile() is not None
+    assert merge_spaces(template.render(rows = [(1, 'a'), (2, 'b')])) == out
+    
+    with pytest.raises(Exception, match = "variable 'big' referenced before assignment"):
+        template.render(rows = [(1, 'a')])
+    with pytest.raises(ValueError):
+        Runtime(backend = 'unknown')
+
+def test_040_direct_rendering():
+    src = """
+        context $items
+        %box @body title
+            div class='box'
+                if title
+                    h1 | $title
+                @body
+        div
+            for i in items
+                if i % 2
+                    < p | odd $i
+                else
+                    box title=i
+                        b : i | even
+                          $i
+            ... p / <br>
+        span
+            . | x
+    """
+    direct = HyperHTML(backend = 'compiler').compile(src)
+    dom    = HyperHTML(backend = 'compiler', direct = False).compile(src)
+    assert direct.ast.compile(direct = True, builtins = direct.runtime.import_builtins()) is not None
+    assert direct.render(items = [1, 2, 3]) == dom.render(items = [1, 2, 3])
+    assert dom.ast.compiled_direct is None
+    
+    # hypertags that use their body as a DOM disable direct rendering
+    src = """
+        %H @body
+            @body[0]
+        H
+            p | first
+            p | second
+    """
+    template = HyperHTML(backend = 'compiler').compile(src)
+    assert merge_spaces(template.render()) == "<p>first</p>"
+    assert template.ast.compiled_direct is False
+    
+    # ...unless direct rendering is forced: then, such a body is converted to a DOM of Text nodes
+    src = """
+        %H @body
+            @body[1]
+            @body[0]
+        H
+            i | first
+            b | x
+    """
+    forced = HyperHTML(backend = 'compiler', direct = True).compile(src)
+    dom    = HyperHTML(backend = 'compiler', direct = False).compile(src)
+    assert merge_spaces(forced.render()) == merge_spaces(dom.render()) == "<b>x</b> <i>first</i>"
+    assert forced.ast.compiled_direct
+
+def test_041_streaming():
+    src = """
+        context $items
+        %row x
+            td | $x
+        table
+            for i in items
+                tr
+                    row x=i
+        comment
+            | end
+    """
+    out = """
+        <table>
+            <tr>
+                <td>1</td>
+            </tr>
+            <tr>
+                <td>2</td>
+            </tr>
+        </table>
+        <!--
+            end
+        -->
+    """
+    template = HyperHTML(backend = 'compiler').compile(src)
+    chunks = list(template.stream(items = [1, 2]))
+    assert ''.join(chunks) == template.render(items = [1, 2])
+    assert merge_spaces(''.join(chunks)) == merge_spaces(out)
+    assert len(chunks) == 3                 # one chunk per loop iteration, plus the tail of the document
+    
+    # HyperHTML.render_iter() parses the script on the fly; non-splittable tags are rendered in one piece
+    src = """
+        context $n
+        div
+            for i in range(n)
+                | $i
+    """
+    assert ''.join(HyperHTML().render_iter(src, n = 3)) == render(src, n = 3)
+
+def test_042_async_rendering(backend):
+    async def fetch(x):
+        await asyncio.sleep(0)
+        return x * 10
+    
+    if backend == 'interpreter':                # awaitable results of function calls are only supported by the compiler
+        fetch = lambda x: x * 10
+    
+    async def rows(n):
+        for i in range(n):
+            await asyncio.sleep(0)
+            yield i
+    
+    src = """
+        context $title, $rows, $fetch
+        %cell x
+            td | { fetch(x) }
+        h1 | $title
+        table
+            for i in rows
+                tr
+                    cell x=i
+    """
+    out = """
+        <h1>Report</h1>
+        <table>
+            <tr>
+                <td>0</td>
+            </tr>
+            <tr>
+                <td>10</td>
+            </tr>
+        </table>
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        text = loop.run_until_complete(HyperHTML().render_async(src, title = asyncio.sleep(0, 'Report'), rows = rows(2), fetch = fetch))
+        assert merge_spaces(text) == merge_spaces(out)
+        
+        # a compiled template; synchronous values are accepted, too
+        template = HyperHTML().compile(src)
+        text = loop.run_until_complete(template.render_async(title = 'Report', rows = [0, 1], fetch = fetch))
+        assert merge_spaces(text) == merge_spaces(out)
+    finally:
+        loop.close()
+
+def test_043_compactification():
+    src = """
+        context $user
+        %H @body
+            | {body[0].tag.name}
+        div .nav
+            a href='/home' | Home
+            H
+                p .x | static
+        p | Hello $user
+        ul
+            li : i | one
+            < li | two
+    """
+    out = """
+        <div class="nav">
+            <a href="/home">Home</a>
+            p
+        </div>
+        <p>Hello Ala</p>
+        <ul>
+            <li><i>one</i></li>
+        <li>two</li>
+        </ul>
+    """
+    template = HyperHTML().compile(src)
+    blocks = [c.block for c in template.ast.root.children if isinstance(c, NODES.xblock)][-4:]
+    assert [type(b).__name__ for b in blocks] == ['xblock_def', 'xblock_struct', 'xblock_struct', 'merged']
+    assert [type(c.block).__name__ for c in blocks[1].body.children if isinstance(c, NODES.xblock)] == ['merged', 'xblock_struct']
+    assert merge_spaces(template.render(user = 'Ala')) == merge_spaces(out)
+    assert template.render(user = 'Ala') == HyperHTML(compact = False).render(src, user = 'Ala')
+    
+    # the body of a hypertag occurrence can be inspected as a DOM, so its pre-rendered blocks are not used in translation
+    H = [c.block for c in blocks[1].body.children if isinstance(c, NODES.xblock)][-1]
+    p = [c.block for c in H.body.children if isinstance(c, NODES.xblock)][-1]
+    assert isinstance(p, NODES.merged) and p.exposed
+    
+    # pickled templates contain the original blocks, they are compactified again after unpickling
+    assert pickle.loads(pickle.dumps(template)).render(user = 'Ala') == template.render(user = 'Ala')
+    
+    # custom tags are impure unless declared otherwise (Tag.pure), so their blocks are not pre-rendered
+    from hypertag.tests.sample1 import __tags__ as tags
+    tags['stamp'].count = 0
+    template = HyperHTML().compile("from hypertag.tests.sample1 import %stamp\nstamp | n")
+    assert [template.render().strip() for _ in range(3)] == ['n0', 'n1', 'n2']
+    
+    upper = TagFunction(lambda body: body.upper(), pure = True)
+    assert upper.pure and not TagFunction(lambda body: body).pure
+
+def test_044_source_positions():
+    src = "context $x\n" + ''.join("div\n    p\n      | line %d $x\n" % i for i in range(50)) + "i | $x"
+    template = HyperHTML(compact = False).compile(src)
+    blocks, stack = [], [template.ast.root]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, NODES.block_text): blocks.append(node)
+        stack.extend(node.children or ())
+    assert len(blocks) == 51
+    
+    # positions found with the line-offset table are the same as found by scanning the text before the node
+    for node in blocks:
+        prefix = node.fulltext[:node.pos[0]]
+        assert node.line == prefix.count('\n') + 1
+        assert node.column == node.pos[0] - prefix.rfind('\n')
+    
+    # error messages report positions in the original (not preprocessed) source
+    with pytest.raises(NameErrorEx, match = 'line 152, column 7'):
+        HyperHTML().compile(src[:-2] + "$y")
+
+def test_045_grammar_cache():
+    from hypertag.core.ast import Grammar
+    src = "context $x\np | \u2768 $x \u2769"
+    t1 = HyperHTML().compile(src)
+    t2 = HyperHTML().compile(src + ' and $x')
+    assert t1.ast.parser is t2.ast.parser is not Grammar.default
+    assert t1.render(x = 1) == "<p>\u2768 1 \u2769</p>"
+    assert pickle.loads(pickle.dumps(t1)).ast.parser is t1.ast.parser
+    
+    # the cache is bounded, least recently used grammars are dropped
+    size, Grammar.CACHE_SIZE = Grammar.CACHE_SIZE, 1
+    try:
+        Grammar.get(Grammar.special_chars(''.join(Grammar.CHARS_DEFAULT)))
+        assert len(Grammar.cache) == 1 and tuple(t1.ast.parser.symbols.values()) not in Grammar.cache
+    finally:
+        Grammar.CACHE_SIZE = size
+
+def test_046_native_parser():
+    """The hand-written parser produces the same trees (or the same syntax errors) as Parsimonious for all scripts in this file."""
+    import ast
+    
+    def signature(value):
+        if isinstance(value, NODES.node):
+            state = value.__getstate__()
+            return [type(value).__name__] + [(attr, signature(state[attr]) if attr == 'children' else link(state[attr]))
+                                             for attr in state if attr not in ('tree', 'fulltext')]
+        return [signature(child) for child in value]
+    
+    def link(value):
+        if isinstance(value, NODES.node): return type(value).__name__, value.pos
+        if isinstance(value, (list, tuple)): return [link(v) for v in value]
+        if isinstance(value, dict): return {k: link(v) for k, v in value.items()}
+        return type(value).__name__ if type(value).__repr__ is object.__repr__ else repr(value)
+    
+    def parse(parser, script):
+        runtime = HyperHTML(parser = parser)
+        try:
+            return signature(runtime.parse(script, HyModule(runtime = runtime, script = script)).root)
+        except Exception as ex:
+            return "%s: %s" % (type(ex).__name__, ex)
+    
+    with open(__file__, encoding = 'utf-8') as f:
+        scripts = [node.value for node in ast.walk(ast.parse(f.read())) if isinstance(node, ast.Constant) and isinstance(node.value, str)]
+    
+    assert len(scripts) > 400
+    for script in scripts:
+        assert parse('native', script) == parse('parsimonious', script), script
+    
+    with pytest.raises(ValueError, match = 'unknown parser'):
+        HyperHTML(parser = 'peg')
+
+def test_047_blockwise_parsing():
+    """Scripts are parsed one top-level block at a time; no raw AST is retained, and syntax errors are still reported."""
+    src = """
+        context $n
+        %H x
+            b | $x
+        for i in range($n):
+            H x=$i
+        -- comment
+        
+        $k = $n * 2
+        p | $k
+    """
+    for parser in Runtime.PARSERS:
+        runtime = HyperHTML(parser = parser)
+        ast = runtime.parse(src, HyModule(runtime = runtime, script = src))
+        assert ast.ast is None
+        assert all(node.astnode is None for node in ast.root.children)
+        assert re.sub(r'\s+', '', runtime.render(src, n = 2)) == "<b>0</b><b>1</b><p>4</p>"
+        
+        with pytest.raises(SyntaxErrorEx, match = 'line 12'):
+            runtime.render(src + "    p\n  | x\n")
+    
+    src = "  | indented\n  | document\n"
+    assert HyperHTML(parser = 'parsimonious').render(src) == HyperHTML(parser = 'native').render(src)
+
+def test_048_incremental_parsing(tmp_path, monkeypatch):
+    """Only the top-level blocks that changed are parsed again; the rest are copied from the previous version of the script."""
+    src = """
+        context $x
+        %H a
+            i | $a
+        p | first
+        H $x
+        div
+            | last
+    """
+    setups = []
+    setup  = NODES.xblock.setup
+    monkeypatch.setattr(NODES.xblock, 'setup', lambda self: setups.append(self) or setup(self))
+    
+    for parser in Runtime.PARSERS:
+        runtime  = HyperHTML(parser = parser, incremental = True)
+        template = runtime.compile(src)
+        
+        for edited, parsed in [(src.replace('first', 'second'), 1),                     # a block was modified
+                               (src.replace('p | first', 'p | first\n        b | new'), 1),      # a block was inserted, the next ones are shifted
+                               (src.replace('p | first', 'if $x\n            | a\n        else\n            | b'), 3)]:    # a block with 2 nested blocks
+            del setups[:]
+            updated = template.recompile(edited)
+            assert len(setups) == parsed
+            
+            compiled = runtime.compile(edited)
+            assert updated.render(x = 5) == compiled.render(x = 5)
+            assert [node.pos for node in updated.ast.root.children] == [node.pos for node in compiled.ast.root.children]
+            
+        assert 'first' in template.render(x = 5)                # the previous template is not affected
+        
+        # an unchanged block is parsed again if the next line can extend it: here, `else` gets a body
+        template = runtime.compile("context $x\nif $x\n    | a\nelse\n| b\n")
+        assert template.recompile("context $x\nif $x\n    | a\nelse\n    | b\n").render(x = 1).strip() == "a"
+    
+    # HyLoader.reload() re-reads a script that was imported before
+    (tmp_path / 'module.hy').write_text("%G x\n    i | $x\n%F\n    | F\n")
+    src = """
+        from .module import %G
+        G 5
+    """
+    runtime = HyperHTML(incremental = True)
+    assert runtime.render(src, __file__ = str(tmp_path / 'main.py')).strip() == "<i>5</i>"
+    
+    (tmp_path / 'module.hy').write_text("%G x\n    b | $x\n%F\n    | F\n")
+    loader = runtime.loaders[0]
+    del setups[:]
+    module = loader.reload(str(tmp_path / 'module.hy'), runtime)
+    assert len(setups) == 2                                     # the modified block of %G and its nested block
+    assert loader.cache[str(tmp_path / 'module.hy')] is module
+    assert runtime.render(src, __file__ = str(tmp_path / 'main.py')).strip() == "<b>5</b>"
+
+def test_049_syntax_error_location(monkeypatch):
+    """Syntax errors are located in the original script from a single failed parse, without re-parsing parts of the script."""
+    calls = []
+    preprocess = Grammar.preprocess
+    monkeypatch.setattr(Grammar, 'preprocess', lambda self, *args, **kw: calls.append(1) or preprocess(self, *args, **kw))
+    
+    block = "div .box\n    p | item $x\n    for i in [1,2]\n        b | $i\n"
+    for parser in Runtime.PARSERS:
+        runtime = HyperHTML(parser = parser)
+        for src, line, column, snippet in [(block * 50 + "div\n    p | {x\n" + block * 50, 202, 11, "p | {x"),
+                                           ("div\n  p\n    i | ok\n   b", 4, 4, "b"),                  # inconsistent dedent
+                                           ("div\n    p\n    %%% comment", 3, 6, "%%% comment")]:
+            del calls[:]
+            with pytest.raises(SyntaxErrorEx, match = re.escape('at line %s, column %s: %s' % (line, column, snippet))):
+                runtime.translate(src, x = 1)
+            assert len(calls) == 1
+
+def test_050_deep_nesting():
+    """Deeply nested scripts are processed without a permanent change of Python's recursion limit."""
+    limit = sys.getrecursionlimit()
+    depth = 300
+    src = ''.join('  ' * i + 'div\n' for i in range(depth)) + '  ' * depth + '| x\n'
+    out = '<div>' * depth + 'x' + '</div>' * depth
+    for parser in Runtime.PARSERS:
+        template = HyperHTML(parser = parser).compile(src)
+        assert re.sub(r'\s+', '', template.render()) == out
+        assert re.sub(r'\s+', '', pickle.loads(pickle.dumps(template)).render()) == out
+    assert sys.getrecursionlimit() == limit
+
+def test_051_auto_reload(tmp_path):
+    """Cached scripts are re-read after they, or the scripts they import, were modified on disk."""
+    (tmp_path / 'helper.hy').write_text("%H x\n    i | $x\n")
+    (tmp_path / 'module.hy').write_text("from .helper import %H\n%G x\n    H $x\n")
+    src = """
+        from .module import %G
+        G 5
+    """
+    main = str(tmp_path / 'main.py')
+    loader = HyLoader(interval = 0)
+    runtime = HyperHTML(loaders = [loader, PyLoader])
+    assert runtime.render(src, __file__ = main).strip() == "<i>5</i>"
+    
+    module = loader.cache[str(tmp_path / 'module.hy')]
+    assert runtime.render(src, __file__ = main).strip() == "<i>5</i>"
+    assert loader.cache[str(tmp_path / 'module.hy')] is module           # unchanged files are not read again
+    
+    (tmp_path / 'helper.hy').write_text("%H x\n    b | [$x]\n")            # the indirectly imported script is modified
+    assert runtime.render(src, __file__ = main).strip() == "<b>[5]</b>"
+    assert loader.cache[str(tmp_path / 'module.hy')] is not module      # ...so the dependent module is read again, too
+    
+    # with a long interval, modifications are not noticed until the next check
+    loader.interval = 3600
+    (tmp_path / 'helper.hy').write_text("%H x\n    u | $x\n")
+    assert runtime.render(src, __file__ = main).strip() == "<b>[5]</b>"
+    for stamp in loader.stamps.values(): stamp[1] -= 3600
+    assert runtime.render(src, __file__ = main).strip() == "<u>5</u>"
+
+def test_052_watcher(tmp_path, monkeypatch):
+    """A watcher evicts modified scripts and their dependents from the loader's cache, and imports make no file system calls."""
+    src = """
+        from .module import %G
+        G 5
+    """
+    main = str(tmp_path / 'main.py')
+    for inotify in (True, False):
+        if inotify and not InotifyWatcher.available(): continue
+        if not inotify: monkeypatch.setattr(InotifyWatcher, 'available', classmethod(lambda cls: False))
+        
+        (tmp_path / 'helper.hy').write_text("%H x\n    i | $x\n")
+        (tmp_path / 'module.hy').write_text("from .helper import %H\n%G x\n    H $x\n")
+        changed = threading.Event()
+        evicted = []
+        loader  = HyLoader(interval = 0.01, watch = True)
+        loader.on_change = lambda locations: evicted.extend(locations) or changed.set()
+        runtime = HyperHTML(loaders = [loader, PyLoader])
+        assert runtime.render(src, __file__ = main).strip() == "<i>5</i>"
+        template = runtime.compile(src, __file__ = main)
+        assert template.render().strip() == "<i>5</i>"
+        
+        stats, stat = [], os.stat
+        with monkeypatch.context() as patch:                        # the watcher's thread may call os.stat() in the meantime
+            patch.setattr(os, 'stat', lambda path, *args, **kw: threading.current_thread() is threading.main_thread()
+                                                                 and stats.append(path) or stat(path, *args, **kw))
+            assert runtime.render(src, __file__ = main).strip() == "<i>5</i>"
+            assert template.render().strip() == "<i>5</i>"
+        assert stats == []
+        
+        (tmp_path / 'helper.hy').write_text("%H x\n    b | [$x]\n")
+        assert changed.wait(10)
+        assert sorted(evicted) == [str(tmp_path / 'helper.hy'), str(tmp_path / 'module.hy')]
+        assert runtime.render(src, __file__ = main).strip() == "<b>[5]</b>"
+        
+        # a compiled template that imported the modified script is analysed again on the next render
+        ast = template.ast
+        assert template.render().strip() == "<b>[5]</b>"
+        assert template.ast is not ast
+        ast = template.ast
+        assert template.render().strip() == "<b>[5]</b>" and template.ast is ast
+        loader.unwatch()
+
+def test_053_import_graph(tmp_path, monkeypatch):
+    """The runtime records which module imported which; dependents of a module are invalidated with it and pre-warmed after it."""
+    (tmp_path / 'base.hy').write_text("%B x\n    i | $x\n")
+    (tmp_path / 'left.hy').write_text("from .base import %B\n%L x\n    B $x\n")
+    (tmp_path / 'right.hy').write_text("from .base import %B\n%R x\n    B $x\n")
+    (tmp_path / 'top.hy').write_text("from .left import %L\nfrom .right import %R\n%T x\n    L $x\n    R $x\n")
+    (tmp_path / 'other.hy').write_text("%O\n    | other\n")
+    src = """
+        from .top import %T
+        from .other import %O
+        T 5
+    """
+    main = str(tmp_path / 'main.py')
+    loc  = lambda name: str(tmp_path / (name + '.hy'))
+    runtime = HyperHTML(loaders = [HyLoader(interval = None), PyLoader])
+    assert re.sub(r'\s+', '', runtime.render(src, __file__ = main)) == "<i>5</i><i>5</i>"
+    
+    graph = runtime.graph
+    assert graph.imports[loc('top')] == {loc('left'), loc('right')}
+    assert graph.dependents[loc('base')] == {loc('left'), loc('right')}
+    
+    order = graph.order([loc('top')])
+    assert set(order) == {loc('top'), loc('left'), loc('right'), loc('base')}
+    assert order[0] == loc('base') and order[-1] == loc('top')
+    
+    evicted = runtime.invalidate(loc('base'))
+    assert sorted(evicted) == sorted([loc('base'), loc('left'), loc('right'), loc('top')])
+    assert set(runtime.loaders[0].cache) == {loc('other')}
+    
+    reads = []
+    read_script = HyLoader._read_script
+    monkeypatch.setattr(HyLoader, '_read_script', lambda self, location, *args: reads.append(location) or read_script(self, location, *args))
+    
+    modules = runtime.preload()
+    assert reads[0] == loc('base') and reads[-1] == loc('top') and len(reads) == 4
+    assert [module.location for module in modules if module.location in reads] == reads
+    
+    del reads[:]
+    assert re.sub(r'\s+', '', runtime.render(src, __file__ = main)) == "<i>5</i><i>5</i>"
+    assert reads == []
+    
+    # compiled templates are recorded in the graph, too, under a synthetic key, until they're garbage-collected
+    template = runtime.compile(src, __file__ = main)
+    key = template.module.key
+    assert graph.imports[key] == {loc('top'), loc('other')}
+    assert key in graph.affected(loc('base')) and key in graph.affected(loc('other'))
+    assert graph.order([key])[-1] == key
+    assert len(runtime.preload()) == 5                  # templates are not loaded by loaders
+    del template
+    gc.collect()
+    assert key not in graph.imports and all(key not in referrers for referrers in graph.dependents.values())
+
+def test_054_resolution_cache(tmp_path, monkeypatch):
+    """HyLoader caches locations of resolved import paths, and paths that could not be resolved."""
+    (tmp_path / 'module.hy').write_text("%G x\n    i | $x\n")
+    (tmp_path / 'pkg').mkdir()
+    (tmp_path / 'pkg' / '__init__.py').write_text("")
+    (tmp_path / 'pkg' / 'widgets.hy').write_text("%W\n    | $__package__\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    
+    calls = []
+    resolve = HyLoader._resolve
+    monkeypatch.setattr(HyLoader, '_resolve', lambda self, path, *args: calls.append(path) or resolve(self, path, *args))
+    
+    loader  = HyLoader(interval = None)
+    runtime = HyperHTML(loaders = [loader, PyLoader])
+    main    = str(tmp_path / 'main.py')
+    src     = "from module import %G\nfrom pkg.widgets import %W\nG 5\nW"
+    for _ in range(3):
+        assert runtime.render(src, __file__ = main).split() == ["<i>5</i>", "pkg"]      # pkg.widgets found through the package
+    assert 'module' in calls and 'pkg.widgets' in calls and len(calls) == len(set(calls))     # built-in modules, too
+    
+    # a missing module is looked up only once...
+    for _ in range(2):
+        with pytest.raises(ModuleNotFoundEx):
+            runtime.render("from missing import %M\nM", __file__ = main)
+    assert calls.count('missing') == 1
+    
+    # ...until an invalidation of the cache
+    (tmp_path / 'missing.hy').write_text("%M\n    | found\n")
+    loader.invalidate(str(tmp_path / 'module.hy'))
+    assert runtime.render("from missing import %M\nM", __file__ = main).strip() == "found"
+    assert calls.count('missing') == 2 and calls.count('module') == 1
+    assert runtime.render(src, __file__ = main).split() == ["<i>5</i>", "pkg"]
+    assert calls.count('module') == 2 and calls.count('pkg.widgets') == 2             # positive entries are dropped, too
+    
+    # absolute paths are resolved again after a change of the current folder
+    for name in 'ab':
+        (tmp_path / name).mkdir()
+        (tmp_path / name / 'local.hy').write_text("%L\n    | " + name + "\n")
+    for name in 'abab':
+        monkeypatch.chdir(tmp_path / name)
+        assert runtime.render("from local import %L\nL", __file__ = main).strip() == name
+    
+    # results of a resolve() function are not cached, as they may depend on the referrer
+    def resolve_by_referrer(path, referrer):
+        if path != 'local': return None
+        name = os.path.basename(referrer.filename)[0]
+        return str(tmp_path / name / 'local.hy')
+    runtime = HyperHTML(loaders = [HyLoader(resolve_by_referrer, interval = None), PyLoader])
+    for name in 'abab':
+        assert runtime.render("from local import %L\nL", __file__ = str(tmp_path / (name + '.py'))).strip() == name
+
+def test_055_threads(tmp_path):
+    """A runtime and its compiled templates can be shared by concurrent threads, including imports and imported hypertags."""
+    (tmp_path / 'module.hy').write_text("%G x\n    for i in range(20)\n        | $x\n")
+    src = """
+        context $x
+        from .module import %G
+        G $x
+    """
+    switch = sys.getswitchinterval()
+    sys.setswitchinterval(1e-5)                         # force frequent switching between threads
+    try:
+        runtime  = HyperHTML()
+        main     = str(tmp_path / 'main.py')
+        template = runtime.compile(src, main)
+        errors, start = [], threading.Barrier(8)
+        
+        def worker(n):
+            try:
+                start.wait()
+                for i in range(10):
+                    x = n * 100 + i
+                    assert template.render(x = x).split() == [str(x)] * 20
+                    assert runtime.render(src, main, x = x).split() == [str(x)] * 20
+            except Exception as ex:
+                errors.append(ex)
+        
+        threads = [threading.Thread(target = worker, args = (n,)) for n in range(8)]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        assert not errors
+        assert len(runtime.loaders[0].cache) == 1
+    finally:
+        sys.setswitchinterval(switch)
+
+def test_056_frames():
+    """Every expansion of a hypertag has its own frame of attributes and local variables, also on the interpreter backend."""
+    src = """
+        %H x f
+            $y = x * 10
+            | $x {f(None, x + 1, f) if x < 3 else ''} $y
+        H 0 %H
+    """
+    assert render(src).split() == ['0', '1', '2', '3', '30', '20', '10', '0']
+    
+    # hypertags defined inside hypertags read symbols of the frames they were defined in
+    src = """
+        $z = 5
+        %Outer a
+            %Inner b
+                | $a $b $z
+            Inner (a + 1)
+            Inner (a + 2)
+        Outer 1
+        Outer 10
+    """
+    assert render(src).split() == ['1', '2', '5', '1', '3', '5', '10', '11', '5', '10', '12', '5']
+
+
+def test_057_bindings():
+    """Actual attributes of hypertags are bound to slots by precomputed bindings: at call sites, or cached per hypertag."""
+    src = """
+        $ z = 7
+        %H @body a b=1 c='x' d=z
+            | $a $b $c $d
+            @body
+        H 0
+        H 0 2 c='y'
+        H d=8 a=0
+            | body
+        $f = %H
+        | {f(None, 5)}
+        | {f(None, 5, d=9)}
+    """
+    assert merge_spaces(render(src)) == "0 1 x 7 0 2 y 7 0 1 x 8 body 5 1 x 7 5 1 x 9"
+
+    # attributes of the DOM node of an expansion: positional ones named after the hypertag's attributes, defaults excluded
+    dom = HyperHTML().translate(src).dom
+    nodes = [node for node in dom.walk() if node.tag and node.tag.name == 'H']
+    assert [node.kwattrs for node in nodes] == [{'a': 0}, {'a': 0, 'b': 2, 'c': 'y'}, {'d': 8, 'a': 0}]
+
+    errors = [("H", "missing a required positional attribute 'a'"),
+              ("H 1 2 3", "takes 2 positional attributes but 3 were given"),
+              ("H 1 a=2", "got multiple values for attribute 'a'"),
+              ("H 1 e=2", "got an unexpected keyword attribute 'e'"),
+              ("H 1 body=2", "direct assignment to body attribute 'body'"),
+              ("| {f(None)}", "missing a required positional attribute 'a'")]
+    for call, error in errors:
+        with pytest.raises(Exception, match = error):
+            render("%H @body a b=1\n    | $a\n$f = %H\n" + call)
+    with pytest.raises(Exception, match = "non-empty body passed to a void hypertag 'V'"):
+        render("%V a\n    | $a\nV 1\n    | body")
+
+
+def test_058_inline():
+    """Calls of hypertags whose output is only rendered insert the output without a wrapper node; rendering is unchanged."""
+    src = """
+        %H @body x
+            i | $x
+            @body
+        %E x
+            $y = x
+            H y
+        %W @body
+            @body
+        H 1
+        div : H 2
+            | inner
+            p | deep
+        ...H 3
+        div
+            < H 4
+                b | bold
+        for i in range(2)
+            H i
+            E i
+            p : H i | one-liner
+        W : H 5
+    """
+    template = HyperHTML().compile(src)
+    assert template.render() == HyperHTML(compact = False).render(src)
+    
+    calls, stack = [], [template.ast.root]
+    while stack:
+        node = stack.pop(0)
+        if isinstance(node, NODES.xtag_expand) and node.name == 'H': calls.append(node)
+        stack = list(node.children or ()) + stack
+    assert [call.inline for call in calls] == [False, True, True, True, True, True, True, False]
+    
+    # the DOM returned by translate() keeps nodes of all hypertag calls
+    dom = template.translate().dom
+    assert len([node for node in dom.walk() if node.tag and node.tag.name == 'H']) == 11
+
+def test_059_loop_invariants():
+    """With Runtime.hoist, expressions and blocks that don't depend on variables assigned in a loop are cached during its execution."""
+    class Settings:
+        URL = '/static/'
+        n   = 3
+    src = """
+        context $s
+        %icon name | i .icon #$name
+        $x = 1
+        for row in [[1, 2], [3, 4]]
+            a href={s.URL + 'img'} | {x * 10}
+            icon 'check'
+            $x = x + 1
+            for i in row
+                if i > 1
+                    p | {s.n / (i - 1)} {s.URL[1:]} {row[0] * 2} $i
+        $j = 2
+        while j
+            b | {s.n + 1} {j * 2}
+            $j = j - 1
+    """
+    template = HyperHTML(hoist = True).compile(src)
+    assert template.render(s = Settings) == HyperHTML(compact = False).render(src, s = Settings)
+    
+    hoisted, stack = set(), [template.ast.root]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, (NODES.expression_root, NODES.xblock)) and node.hoisted:
+            hoisted.add(node.text().strip())
+        stack.extend(node.children or ())
+    assert hoisted == {"s.URL + 'img'", "icon 'check'", "'check'", "s.URL[1:]", "row[0] * 2", "s.n + 1"}
+    
+    # loops with possible side effects are not optimized
+    src = """
+        $items = [1]
+        for i in range(3)
+            $ items.append(i)
+            | {items[0] + 1} {len(items)}
+    """
+    assert merge_spaces(HyperHTML(hoist = True).render(src)) == "2 2 2 3 2 4"
+    
+    # hoisting is disabled by default, as iteration over a stateful iterator or generator may have side effects
+    class Counter:
+        i = 0
+        def __iter__(self): return self
+        def __next__(self):
+            if self.i >= 3: raise StopIteration
+            self.i += 1
+            return self.i
+    def numbers(s):
+        for i in range(3):
+            s.n = i
+            yield i + 1
+    src = """
+        context $c
+        context $s
+        context $numbers
+        for r in c
+            | {c.i * 1}
+        for k in numbers(s)
+            | $k {s.n * 1}
+    """
+    assert merge_spaces(render(src, c = Counter(), s = Settings(), numbers = numbers)) == "1 2 3 1 0 2 1 3 2"
+
 
 #####################################################################################################################################################
 